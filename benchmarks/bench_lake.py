@@ -0,0 +1,303 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# Throughput benchmark of the Fortran lake model (simulated years per second)
+#
+# Every case is built and run headlessly in its own scratch directory:
+#   full   - the configuration as shipped
+#   nospin - nspin = 0, so spin-up time = full - nospin
+#   noio   - writes to units 50/51 commented out, so output I/O = full - noio
+#
+# Usage (from the repository root):
+#   python benchmarks/bench_lake.py --out bench_lake.json
+#   python benchmarks/bench_lake.py --lakes Malawi --forcings climatology \
+#       --fflags "-O2" "-O3 -march=native" --source env_heatflux.f90
+#   python benchmarks/bench_lake.py --params "" "adapt_flag=.true."
+#   python benchmarks/bench_lake.py --grids "" stretched
+# The third form compares include parameter settings (engine modes) of
+# the same source; "" is the configuration as shipped. The last compares
+# the uniform 1 m grid ("") with a stretched grid (lake_run.stretched_grid)
+# or a lake_grid.txt file given by its path.
+#====================================================================
+
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import lake_run
+
+LAKES = lake_run.TEMPLATES
+FORCINGS = {
+    'climatology': {'Malawi': 'ERA_INTERIM_climatology_Malawi_2yr.txt',
+                    'Tanganyika': 'ERA_INTERIM_climatology_Tang_2yr.txt'},
+    '1979-2016': {'Malawi': 'ERA_INTERIM_1979_2016_Malawi.txt',
+                  'Tanganyika': 'ERA_INTERIM_1979_2016_Tanganyika_BIASCORRECT.txt'},
+}
+SURF = 'ERA-HIST-Tlake_surf.dat'
+TPROF = 'ERA-HIST-Tlake_Tprof.dat'
+
+
+def render_source(text, strip_output=False):
+    '''
+    Model source with the include pointed at the staged lake.inc and,
+    optionally, every write to the output units commented out.
+    '''
+    text = lake_run.render_source(text)
+    if not strip_output:
+        return text
+    lines = text.split('\n')
+    inside = False
+    for i, line in enumerate(lines):
+        code = line.split('!')[0].rstrip()
+        if inside or re.match(r'\s*write\s*\(\s*5[01]\s*,', line, re.I):
+            lines[i] = '!' + line
+            inside = code.endswith('&')
+    return '\n'.join(lines)
+
+
+def render_include(text, forcing, nspin=None, params=None):
+    '''
+    Include file reading the staged forcing file, with nspin and the
+    parameters in params overridden.
+    '''
+    parameters = dict(params or {})
+    parameters['nspin'] = nspin
+    return lake_run.render_include(text, parameters, datafile=forcing)
+
+
+def parse_params(text):
+    '''
+    'name=value,name=value' as a dict of include parameters.
+    '''
+    params = {}
+    for item in text.split(','):
+        if item.strip():
+            name, value = item.split('=', 1)
+            params[name.strip()] = value.strip()
+    return params
+
+
+def parameter_of(include, name):
+    found = re.findall(r'parameter\s*\(\s*%s\s*=\s*(\d+)\s*\)' % name, include, flags=re.I)
+    return int(found[-1]) if found else 0
+
+
+def nspin_of(include):
+    return parameter_of(include, 'nspin')
+
+
+def grid_of(name, include, params):
+    '''
+    Layer grid of a --grids entry: None for the uniform grid, the
+    stretched grid to depth_begin, or the path of a grid file.
+    '''
+    if not name:
+        return None
+    if name == 'stretched':
+        depth = params.get('depth_begin') or parameter_of(include, 'depth_begin')
+        return lake_run.stretched_grid(float(depth))
+    return os.path.join(ROOT, name)
+
+
+def forcing_years(path):
+    return len(np.unique(np.loadtxt(path, usecols=0)))
+
+
+def children_cpu():
+    if resource is None:
+        return 0.
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def build_and_run(directory, source, include, forcing, fc, fflags, strip_output=False, nspin=None,
+                  timeout=None, params=None, grid=None):
+    '''
+    Stages, compiles and runs one case in directory.
+    OUTPUT: dict of compile, wall and CPU seconds, or an 'error'
+    '''
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(ROOT, source)) as file:
+        text = render_source(file.read(), strip_output)
+    with open(os.path.join(directory, 'lake.f90'), 'w') as file:
+        file.write(text)
+    with open(os.path.join(ROOT, include)) as file:
+        text = render_include(file.read(), 'forcing.txt', nspin, params)
+    with open(os.path.join(directory, 'lake.inc'), 'w') as file:
+        file.write(text)
+    shutil.copy(os.path.join(ROOT, forcing), os.path.join(directory, 'forcing.txt'))
+    if grid is not None:
+        lake_run.write_grid(os.path.join(directory, lake_run.GRID), grid)
+
+    start = time.perf_counter()
+    build = subprocess.run([fc] + fflags.split() + ['-ffree-line-length-none', 'lake.f90', '-o', 'lake'],
+                           cwd=directory, capture_output=True, text=True)
+    compile_time = time.perf_counter() - start
+    if build.returncode != 0:
+        return {'error': 'compile failed: ' + build.stderr.strip()[-2000:]}
+
+    cpu = children_cpu()
+    start = time.perf_counter()
+    try:
+        run = subprocess.run([os.path.join(directory, 'lake')], cwd=directory, capture_output=True,
+                             text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'error': 'timed out after %s s' % timeout}
+    wall = time.perf_counter() - start
+    if run.returncode != 0:
+        return {'error': 'run failed: ' + (run.stderr or run.stdout).strip()[-2000:]}
+    return {'compile': compile_time, 'wall': wall, 'cpu': children_cpu() - cpu}
+
+
+def bench_case(workdir, lake, forcing_name, source, fc, fflags, parts, timeout, params='', grid=''):
+    include = LAKES[lake]
+    forcing = FORCINGS[forcing_name][lake]
+    with open(os.path.join(ROOT, include)) as file:
+        text = file.read()
+    nspin = nspin_of(text)
+    # spin-up replays the first forcing year nspin + 1 times
+    years = forcing_years(os.path.join(ROOT, forcing))
+    result = {'lake': lake, 'forcing': forcing_name, 'source': source, 'fc': fc, 'fflags': fflags,
+              'params': params, 'grid': grid, 'nspin': nspin, 'forcing_years': years,
+              'simulated_years': years + nspin + 1}
+    params = parse_params(params)
+    grid = grid_of(grid, text, params)
+    if grid is not None and not isinstance(grid, str):
+        result['layers'] = len(grid)
+
+    full_dir = os.path.join(workdir, 'full')
+    full = build_and_run(full_dir, source, include, forcing, fc, fflags, timeout=timeout, params=params,
+                         grid=grid)
+    if 'error' in full:
+        result['error'] = full['error']
+        return result, None
+    result.update(compile=full['compile'], wall=full['wall'], cpu=full['cpu'],
+                  years_per_second=result['simulated_years'] / full['wall'])
+    surf = np.loadtxt(os.path.join(full_dir, SURF), ndmin=2)
+    result['output_bytes'] = sum(os.path.getsize(os.path.join(full_dir, name)) for name in (SURF, TPROF))
+
+    if 'nospin' in parts and nspin > 0:
+        nospin = build_and_run(os.path.join(workdir, 'nospin'), source, include, forcing, fc, fflags,
+                               nspin=0, timeout=timeout, params=params, grid=grid)
+        if 'error' not in nospin:
+            # the two runs differ by nspin replays of the first year
+            per_year = max(full['wall'] - nospin['wall'], 0.) / nspin
+            result['spinup'] = per_year * (nspin + 1)
+            result['main_run'] = full['wall'] - result['spinup']
+    if 'noio' in parts:
+        noio = build_and_run(os.path.join(workdir, 'noio'), source, include, forcing, fc, fflags,
+                             strip_output=True, timeout=timeout, params=params, grid=grid)
+        if 'error' not in noio:
+            result['output_io'] = max(full['wall'] - noio['wall'], 0.)
+    return result, surf
+
+
+def metadata(fcs):
+    versions = {}
+    for fc in fcs:
+        try:
+            versions[fc] = subprocess.run([fc, '--version'], capture_output=True,
+                                          text=True).stdout.split('\n')[0]
+        except OSError:
+            versions[fc] = None
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'date': dt.datetime.now().isoformat(timespec='seconds'),
+            'machine': platform.platform(), 'python': platform.python_version(), 'compilers': versions}
+
+
+def report(result):
+    config = ' '.join(part for part in (result['fc'], result['fflags'], result['params'], result['grid'])
+                      if part)
+    if 'error' in result:
+        print('%-11s %-12s %-20s %-24s ERROR %s' % (result['lake'], result['forcing'], result['source'],
+                                                   config, result['error'].split('\n')[0]))
+        return
+    print('%-11s %-12s %-20s %-24s %6.3f yr/s  wall %7.1f s  spin-up %7s  main %7s  I/O %6s  dTsurf %s (rms %s)' % (
+        result['lake'], result['forcing'], result['source'], config,
+        result['years_per_second'], result['wall'],
+        '%.1f s' % result['spinup'] if 'spinup' in result else '-',
+        '%.1f s' % result['main_run'] if 'main_run' in result else '-',
+        '%.1f s' % result['output_io'] if 'output_io' in result else '-',
+        '%.2g' % result['max_dTsurf'] if 'max_dTsurf' in result else '-',
+        '%.2g' % result['rms_dTsurf'] if 'rms_dTsurf' in result else '-'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput benchmark of the Fortran lake model')
+    parser.add_argument('--lakes', nargs='*', default=sorted(LAKES), choices=sorted(LAKES))
+    parser.add_argument('--forcings', nargs='*', default=sorted(FORCINGS), choices=sorted(FORCINGS))
+    parser.add_argument('--source', nargs='*', default=['env_heatflux.f90'],
+                        help='model sources to compare (engine variants)')
+    parser.add_argument('--fc', nargs='*', default=['gfortran'], help='Fortran compilers to compare')
+    parser.add_argument('--fflags', nargs='*', default=['-O2'], help='compiler flag sets to compare')
+    parser.add_argument('--params', nargs='*', default=[''],
+                        help='include parameter settings to compare, each "name=value,name=value"')
+    parser.add_argument('--grids', nargs='*', default=[''],
+                        help='layer grids to compare: "" (uniform 1 m), stretched, or a grid file')
+    parser.add_argument('--parts', nargs='*', default=['nospin', 'noio'], choices=['nospin', 'noio'],
+                        help='extra runs used to split spin-up and output I/O time')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds allowed per model run')
+    parser.add_argument('--keep', help='keep the run directories under this path')
+    parser.add_argument('--out', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    workroot = args.keep or tempfile.mkdtemp(prefix='bench_lake_')
+    results = []
+    try:
+        for lake in args.lakes:
+            for forcing in args.forcings:
+                reference = None
+                for source in args.source:
+                    for fc in args.fc:
+                        for fflags in args.fflags:
+                            for params in args.params:
+                                for grid in args.grids:
+                                    name = '%s_%s_%d' % (lake, forcing, len(results))
+                                    result, surf = bench_case(os.path.join(workroot, name), lake, forcing,
+                                                              source, fc, fflags, args.parts, args.timeout,
+                                                              params, grid)
+                                    # results of every variant against the first one of the configuration
+                                    if surf is not None:
+                                        if reference is None:
+                                            reference = surf
+                                        elif surf.shape == reference.shape:
+                                            diff = surf[:, 1] - reference[:, 1]
+                                            result['max_dTsurf'] = float(np.max(np.abs(diff)))
+                                            result['rms_dTsurf'] = float(np.sqrt(np.mean(diff ** 2)))
+                                    results.append(result)
+                                    report(result)
+                                    sys.stdout.flush()
+    finally:
+        if not args.keep:
+            shutil.rmtree(workroot, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump({'meta': metadata(args.fc), 'results': results}, file, indent=2)
+    if any('error' in result for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
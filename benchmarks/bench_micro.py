@@ -0,0 +1,179 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# Micro-benchmarks of the sensor, archive and output-loading hot paths
+#
+# Usage (from the repository root):
+#   python benchmarks/bench_micro.py --out bench_micro.json
+#   python benchmarks/bench_micro.py --compare bench_micro.json --threshold 1.25
+# The second form exits with status 1 if any case is slower than the stored
+# run by more than the threshold factor.
+#====================================================================
+
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES = os.path.join(ROOT, 'samples')
+sys.path.insert(0, ROOT)
+
+import sensor_carbonate as carb
+import sensor_gdgt as gdgt
+import sensor_leafwax as leafwax
+import lake_archive_bioturb as bio
+import lake_archive_compact as comp
+import lake_io
+
+SEED = 20240101
+
+
+def surf_file(directory, scale):
+    '''
+    Surf.dat output scaled to scale times the shipped sample, by repeating
+    its years with the day counter carried on.
+    '''
+    rows = np.loadtxt(os.path.join(SAMPLES, 'ERA-HIST-Tlake_surf.dat'))
+    blocks = []
+    for k in range(scale):
+        block = rows.copy()
+        block[:, 0] += k * (rows[-1, 0] + 30.)
+        blocks.append(block)
+    path = os.path.join(directory, 'surf_x%d.dat' % scale)
+    np.savetxt(path, np.concatenate(blocks), fmt='%11.4f')
+    return path
+
+
+def cases(scale, directory):
+    '''
+    (name, callable, number of calls per timing) for every benchmark.
+    Inputs are built from the samples/ files and tiled by scale.
+    '''
+    rng = np.random.RandomState(SEED)
+
+    surf = np.loadtxt(os.path.join(SAMPLES, 'ERA-HIST-Tlake_surf.dat'))
+    lst = np.tile(surf[:, 1], 200 * scale) + rng.normal(0., 0.1, 200 * scale * len(surf))
+    dDp = np.tile(np.loadtxt(os.path.join(SAMPLES, 'IsoGSM_dDP_1953_2012.txt')), 10 * scale)
+
+    found = []
+    for model in ('ONeil', 'Kim-ONeil', 'ErezLuz', 'Bemis', 'Lynch'):
+        found.append(('carb_sensor[%s]' % model,
+                      lambda model=model: carb.carb_sensor(lst, -2., isoflag=1, model=model), 20))
+    for model in ('TEX86-tierney', 'TEX86-loomis', 'MBT-R'):
+        found.append(('gdgt_sensor[%s]' % model,
+                      lambda model=model: gdgt.gdgt_sensor(lst, lst, model=model), 20))
+    found.append(('wax_sensor', lambda: leafwax.wax_sensor(np.tile(dDp, 20), 0.7, 0.3), 20))
+
+    def wax_uncertainty():
+        np.random.seed(SEED)
+        return leafwax.wax_uncertainty(dDp, 0.7, 0.3)
+    found.append(('wax_uncertainty', wax_uncertainty, 1))
+
+    for years in (200 * scale, 1000 * scale, 3000 * scale):
+        series = np.sin(np.arange(years) / 50.)
+
+        def turbo(years=years, series=series):
+            np.random.seed(SEED)
+            return bio.bioturbation(np.ones(years) * 20, series, np.ones(years) * 10, 10)
+        found.append(('bioturbation[%d]' % years, turbo, 1))
+
+        def turbo_stream(years=years, series=series):
+            stream = [(np.ones(years) * 20, series, np.ones(years) * 10)]
+            return bio.bioturbation_stream(stream, 10, 10, 20, seed=SEED)
+        found.append(('bioturbation_stream[%d]' % years, turbo_stream, 1))
+
+    for num in (100, 10000 * scale):
+        found.append(('porosity[%d]' % num, lambda num=num: comp.porosity(10., 0.95, num=num), 50))
+        found.append(('compaction[%d]' % num, lambda num=num: comp.compaction(50., 20000, 0.95, num=num), 50))
+
+    for factor in (1, 10 * scale):
+        path = surf_file(directory, factor)
+
+        def load(path=path):
+            time, data = [], []
+            lake_io.get_output_data(time, data, 1, path)
+            return time, data
+        found.append(('get_output_data[x%d]' % factor, load, 5))
+
+    days = list(range(15, 365 * 40 * scale, 30))  # ints, as read by get_output_data
+    found.append(('convert_to_monthly', lambda: lake_io.convert_to_monthly(days, 1979), 5))
+    monthly = [list(np.sin(np.arange(len(days)) / 6.).tolist())] * 3
+    found.append(('convert_to_annual', lambda: lake_io.convert_to_annual(monthly, 1979), 5))
+    return found
+
+
+def run(scale=1, repeat=5, only=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, func, number in cases(scale, directory):
+            if only and not any(pattern in name for pattern in only):
+                continue
+            times = np.array(timeit.repeat(func, number=number, repeat=repeat)) / number
+            results[name] = {'min': float(times.min()), 'median': float(np.median(times)),
+                             'repeat': repeat, 'number': number}
+            print('%-32s %12.6f s  (median %.6f s)' % (name, times.min(), np.median(times)))
+    return results
+
+
+def metadata(scale):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'date': dt.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.platform(), 'scale': scale, 'seed': SEED}
+
+
+def compare(results, baseline, threshold):
+    '''
+    Cases slower than the baseline by more than threshold (on the minimum
+    time, which is the least noisy statistic).
+    '''
+    slower = []
+    for name, now in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = now['min'] / baseline[name]['min']
+        flag = ' REGRESSION' if ratio > threshold else ''
+        print('%-32s %7.2fx%s' % (name, ratio, flag))
+        if ratio > threshold:
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the PRYSM lake PSM')
+    parser.add_argument('--scale', type=int, default=1, help='multiplier of the input sizes')
+    parser.add_argument('--repeat', type=int, default=5, help='timings per case')
+    parser.add_argument('--only', nargs='*', help='run only cases whose name contains one of these')
+    parser.add_argument('--out', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown factor counted as a regression')
+    args = parser.parse_args()
+
+    results = run(args.scale, args.repeat, args.only)
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump({'meta': metadata(args.scale), 'results': results}, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline['meta'].get('scale') != args.scale:
+            sys.exit('baseline was run with --scale %s' % baseline['meta'].get('scale'))
+        slower = compare(results, baseline['results'], args.threshold)
+        if slower:
+            sys.exit('%d case(s) regressed by more than %.2fx' % (len(slower), args.threshold))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,94 +13,36 @@
                 ps_in(2),rh_in(2), deutprec_in(2), deutrun_in(2), &
                 o18prec_in(2), o18run_in(2)  !Ashling
       integer j,nsteps,ispin
+      logical eof
 
+      if (timing_flag) call timer_init
+      if (timing_flag) call timer_start (it_run)
       call file_open ! open input and output files
       call init_lake ! initialize lake variables
-      !data_input_filename = 'C:/Users/xueya/Downloads/LakeModelGUI/Tanganyika.txt'
-      !data_input_filename = 'CCSM-HIST-Mlake.txt'
-!	  Begin Ashling
-      !Read in data based on 
-      if (wb_flag) then
-        !variable lake depth, with or without isotopes
-        if(deutflag.and..not.o18flag) then
-          !read for deut only
-          read(15,*,end=998) year(1),day(1),ta_in(1),dp_in(1),   &
-                         ua_in(1),sw_in(1),rlwd_in(1),ps_in(1),       &
-                         prec_in(1), deutprec_in(1), &
-                         runin_in(1), deutrun_in(1)
-        else if(o18flag.and..not.deutflag) then
-          !read for o18 only
-          read(15,*,end=998) year(1),day(1),ta_in(1),dp_in(1),   &
-                         ua_in(1),sw_in(1),rlwd_in(1),ps_in(1),       &
-                         prec_in(1), o18prec_in(1), &
-                         runin_in(1), o18run_in(1)          
-        else if(o18flag.and.deutflag) then
-          !read for deut and o18      
-          read(15,*,end=998) year(1),day(1),ta_in(1),dp_in(1),   &
-                         ua_in(1),sw_in(1),rlwd_in(1),ps_in(1),       &
-                         prec_in(1), deutprec_in(1), o18prec_in(1), &
-                         runin_in(1), deutrun_in(1), o18run_in(1)
-        else
-          !only wb_flag
-           read(15,*,end=998) year(1),day(1),ta_in(1),dp_in(1),   &
-                         ua_in(1),sw_in(1),rlwd_in(1),ps_in(1),       &
-                         prec_in(1),runin_in(1)
-        end if
-      else
-        !not variable lake depth, no isotopes
-        read(15,*,end=998) year(1),day(1),ta_in(1),dp_in(1),   &
-                         ua_in(1),sw_in(1),rlwd_in(1),ps_in(1)
-        runin_in(1)=0.0
-        prec_in(1)=0.0
-      end if
-
-
-      call datain (ta_in(1),dp_in(1),ua_in(1),sw_in(1),rlwd_in(1),  &
-                   ps_in(1),prec_in(1),runin_in(1),qa_in(1),rh_in(1))
-
- 150  if (wb_flag) then
-        !variable lake depth, with or without isotopes
-        if(deutflag.and..not.o18flag) then
-          !read for deut only
-          read(15,*,end=998) year(2),day(2),ta_in(2),dp_in(2),   &
-                         ua_in(2),sw_in(2),rlwd_in(2),ps_in(2),       &
-                         prec_in(2), deutprec_in(2), &
-                         runin_in(2), deutrun_in(2)
-        else if(o18flag.and..not.deutflag) then
-          !read for o18 only
-          read(15,*,end=998) year(2),day(2),ta_in(2),dp_in(2),   &
-                         ua_in(2),sw_in(2),rlwd_in(2),ps_in(2),       &
-                         prec_in(2), o18prec_in(2), &
-                         runin_in(2), o18run_in(2)          
-        else if(o18flag.and.deutflag) then
-          !read for deut and o18      
-          read(15,*,end=998) year(2),day(2),ta_in(2),dp_in(2),   &
-                         ua_in(2),sw_in(2),rlwd_in(2),ps_in(2),       &
-                         prec_in(2), deutprec_in(2), o18prec_in(2), &
-                         runin_in(2), deutrun_in(2), o18run_in(2)
-        else
-          !only wb_flag
-           read(15,*,end=998) year(2),day(2),ta_in(2),dp_in(2),   &
-                         ua_in(2),sw_in(2),rlwd_in(2),ps_in(2),       &
-                         prec_in(2),runin_in(2)
-        end if
-      else
-        !not variable lake depth, no isotopes
-        read(15,*,end=998) year(2),day(2),ta_in(2),dp_in(2),   &
-                         ua_in(2),sw_in(2),rlwd_in(2),ps_in(2)
-        runin_in(2)=0.0
-        prec_in(2)=0.0
-      end if
-
-!     End Ashling
-
-      call datain (ta_in(2),dp_in(2),ua_in(2),sw_in(2),rlwd_in(2),   &
-                   ps_in(2),prec_in(2),runin_in(2),qa_in(2),rh_in(2))
+      ispin = 0
+      if (timing_flag) call timer_start (it_read)
+      call read_forcing (1, year, day, ta_in, dp_in, ua_in, sw_in, rlwd_in, &
+                         ps_in, prec_in, runin_in, deutprec_in, deutrun_in, &
+                         o18prec_in, o18run_in, qa_in, rh_in, eof)
+      if (timing_flag) call timer_stop (it_read)
+      if (eof) goto 998
+
+ 150  continue
+      if (timing_flag) call timer_start (it_read)
+      call read_forcing (2, year, day, ta_in, dp_in, ua_in, sw_in, rlwd_in, &
+                         ps_in, prec_in, runin_in, deutprec_in, deutrun_in, &
+                         o18prec_in, o18run_in, qa_in, rh_in, eof)
+      if (timing_flag) call timer_stop (it_read)
+      if (eof) goto 998
 
       nsteps = 24*60*60/int(dt) * int((day(2)-day(1)))
 !     Begin Ashling
 !     Added isotopes_i
-      do j=1,nsteps
+!     j counts steps of dt; a step covers nsub of them (see step_size)
+      j = 0
+      do while (j.lt.nsteps)
+         call step_size (nsteps-j)
+         j = j+nsub
          xtime = real(j)/nsteps
          call tendency (j,nsteps,ta_in,ta_i,qa_in,qa_i,ua_in,ua_i,   &
                         sw_in,sw_i,rlwd_in,rlwd_i,ps_in,ps_i,        &
@@ -114,16 +56,18 @@
 		   julian = day(1)
 		 end if
 
+         if (timing_flag) call timer_start (it_main)
          call lake_main(xtime,julian,ta_i,ua_i,qa_i,ps_i,  &
-                        prec_i,sw_i,rlwd_i,runin_i,rh_i,nsteps,&
+                        prec_i*nsub,sw_i,rlwd_i,runin_i*nsub,rh_i,nsteps,&
                         deutprec_i,o18prec_i,deutrun_i,o18run_i)
+         if (timing_flag) call timer_stop (it_main)
       enddo
 !     End Ashling
 
       if (ispin.le.nspin.and.year(2).ne.year(1)) then
         ispin = ispin+1
 		day(1) = 1
-        rewind 15
+        rewind iforce
         goto 150
       end if
 	  
@@ -132,7 +76,11 @@
 
       goto 150
  998  continue
+      if (timing_flag) call timer_stop (it_run)
+      if (timing_flag) call timer_report
 
+      close(iforce)
+      close(50)
       close(51)
       stop
       end
@@ -152,8 +100,8 @@
       implicit none
       include 'Malawi.inc'
       real lnetw,lneti,lui,lu,julian,ps,prec,sw,rlwd,      &         !SD HEATBUDGET DELETED SWW, LUW
-           rh,runin,tempice,hice,hsnow,fracice,t,tcutoff,u2w,t2w,     &
-           q2w,ti,u2i,t2i,q2i,ta_i,qa_i,ua_i,ta,ua,qa,taC,albs,albi,  &
+           rh,runin,tempice,hice,hsnow,fracice,tcutoff,u2w,t2w,       &
+           q2w,u2i,t2i,q2i,ta_i,qa_i,ua_i,ta,ua,qa,taC,albs,albi,     &
            albw,swi,tin,tcutk,hicedum,delq,evapw,evapi,   &
            qhi,qei,delqs,tkw,tki,evap,qe,qh,qbot,qw,qnetice,evaps,    &
 		   qew,qhw,sww,luw,                                          &
@@ -161,20 +109,37 @@
            deutprec,deutrun,runout,hsprv,snowmelt,o18snow,deutsnow,   &
            tdepth1,tdepth2,xtime,rain,snowadd, &
            deutrun_i, deutprec_i, o18prec_i, o18run_i !Ashling
-      integer mixmax,i_shuf,k,iwater,mixdep,j,dep_inc,islice,&
+      integer mixmax,k,iwater,mixdep,j,dep_inc,islice,&
               isave_d,nsteps
       logical snow_flag,melt_flag
-      dimension t(max_dep,2), de(max_dep), dnsty(max_dep), ti(max_dep,2)
+      dimension de(max_dep), dnsty(max_dep)
 
 ! =================================================================
 !        1. initialize and read in info from previous dt
 ! =================================================================
 
-      i_shuf = 1   ! grab info from common block
-      call shuffle (xtime, julian, i_shuf, depth, d_frac, tempice, &
-                    hice, hsnow, fracice, t, snow_flag, o18snow,  &
-                    deutsnow, surf_a, ti, mixmax, evap, runout,   &
-                    melt_flag, nsteps, qew, qhw, sww, luw)
+!     the column profiles (temp_a, ti_a, trace) live in the common
+!     block and are updated in place; only the scalars are fetched
+      depth   = depth_a
+      d_frac  = d_fraca
+      tempice = tempi_a
+      hice    = hice_a
+      hsnow   = amax1(0.,hsnow_a)
+      snow_flag = snow_flag_a
+      melt_flag = melt_flag_a
+      o18snow = o18snow_a
+      deutsnow = deutsnow_a
+      fracice = fraci_a
+      surf_a =surfarea_a
+      mixmax = mixmax_a
+      if (depth.ne.grid_depth) call layer_areas (depth)
+
+!     the ice fraction starts from the fractional-cover average.  There
+!     is no separate ice-free path: lake_ice, ice_form and the ice
+!     fraction's column pass already run only with ice, lake_albedo
+!     also sets the water albedo, and column_avg changes the column
+!     even without ice; skipping the rest saved no measurable time
+      trace_i(1:depth,:) = trace(1:depth,:)
 
       call salt_init (ps, Tcutoff, trace(1,n_trace)) ! freezing point
 
@@ -183,10 +148,10 @@
 
       if (bndry_flag) then
          if (fracice.lt.1.0)                                           &
-            call bndry_flux (ta_i, qa_i, ps, ua_i, t(1,1), Tcutoff,    &
+            call bndry_flux (ta_i, qa_i, ps, ua_i, temp_a(1,1), Tcutoff,    &
                              u2w, t2w, q2w, hice)
          if (fracice.gt.0.0)                                           &
-            call bndry_flux (ta_i, qa_i, ps, ua_i, ti(1,1), Tcutoff,   &
+            call bndry_flux (ta_i, qa_i, ps, ua_i, ti_a(1,1), Tcutoff,   &
                              u2i, t2i, q2i, hice)
          ta = t2w*(1-fracice) + t2i*(fracice)
          qa = q2w*(1-fracice) + q2i*(fracice)
@@ -200,9 +165,9 @@
       taC= ta - 273.15     ! convert weighted air temp to C
 
       do k=1,depth
-        t(k,2) = t(k,1)
-        ti(k,1)= t(k,1)
-        ti(k,2)= ti(k,1)
+        temp_a(k,2) = temp_a(k,1)
+        ti_a(k,1)= temp_a(k,1)
+        ti_a(k,2)= ti_a(k,1)
       enddo
 
 ! ======================================================================
@@ -258,11 +223,13 @@
 !======================================================================
 ! ==== 4.1 calculate fluxes for open water ============================
 
-      tin=t(1,1)+273.15     ! surface water T in kelvin
+      tin=temp_a(1,1)+273.15     ! surface water T in kelvin
       Tcutk=Tcutoff+273.15  ! freezing point in kelvin
       hicedum=0.0           ! send ice=0.0 to latsens for open water calc
+      if (timing_flag) call timer_start (it_latsens)
       call latsens (tin, Tcutk, hicedum, ta, qa, ua, ps, delq,  &
                     evapw, Qhw)
+      if (timing_flag) call timer_stop (it_latsens)
       Qew = -evapw*Le
 
 ! ==== 4.2 adjust fluxes for ice cover ================================
@@ -280,7 +247,7 @@
 
       if (trace(1,n_trace).gt.0.0) then  ! adjust for salinity
         call salt_evap (trace(1,n_trace), evapw, qa, delq,  &
-                        ps, Tcutoff, hice, t(1,1), delqs )
+                        ps, Tcutoff, hice, temp_a(1,1), delqs )
         Qew = -evapw*Le
       endif
 
@@ -288,7 +255,7 @@
 !     5. Calculate long wave fluxes over ice and water
 !============================================================
 
-      tkw=273.15+t(1,1)
+      tkw=273.15+temp_a(1,1)
       tki=273.15+tempice
       luw= -0.97*delta*tkw**4. ! long wave up from water surface
       lui= -0.97*delta*tki**4. ! long wave up from ice  surface
@@ -300,10 +267,13 @@
 !         within fraction that already has ice
 !=============================================================
 
-      if (fracice.gt.0.0 .or. hsnow .gt. 0.0)  &
+      if (fracice.gt.0.0 .or. hsnow .gt. 0.0) then
+        if (timing_flag) call timer_start (it_ice)
         call lake_ice (rlwd, tempice, Qhi, Qei, Tcutoff, swi, hice, &
-                       hsnow, snowmelt, ti(1,1), qbot, qw, evapi, &
+                       hsnow, snowmelt, ti_a(1,1), qbot, qw, evapi, &
                        qnetice, fracice, evaps)
+        if (timing_flag) call timer_stop (it_ice)
+      endif
 !     if (fracice.eq.0.0.and.hsnow.le.0.0) &
       qnetice=0. ! set to zero, used only for iceform now
       fracice=amax1(0.,fracice)
@@ -315,12 +285,20 @@
 
       if (fracprv.lt.1.0) then ! at least some open water
         iwater=1 ! signal that open water calculation
-        call eddy (iwater, ua, t, de, depth, trace)
-        call temp_profile (iwater, qbot, qw, t, sww, lnetw, Qew, &
+        if (timing_flag) call timer_start (it_eddy)
+        call eddy (iwater, ua, temp_a, de, depth, trace)
+        if (timing_flag) call timer_stop (it_eddy)
+        if (timing_flag) call timer_start (it_temp)
+        call temp_profile (iwater, qbot, qw, temp_a, sww, lnetw, Qew, &
                            Qhw, de, depth, trace)
+        if (timing_flag) call timer_stop (it_temp)
+        if (timing_flag) call timer_start (it_tracer)
         call tracer_profile (de, depth, iwater)
+        if (timing_flag) call timer_stop (it_tracer)
         mixdep  = 1
-        call tracer_mixer(t, dnsty, depth, trace, mixdep, iwater)
+        if (timing_flag) call timer_start (it_mixer)
+        call tracer_mixer(temp_a, dnsty, depth, trace, mixdep, iwater)
+        if (timing_flag) call timer_stop (it_mixer)
         if (mixdep.gt.mixmax) mixmax=mixdep
       endif  ! if there is open water present
 
@@ -330,22 +308,32 @@
 
       if (fracprv.gt.0.0) then ! if  there is ice present
         iwater=0 ! signal that not an open water calculation
-        call eddy (iwater, ua, ti, de, depth, trace_i)
-        call temp_profile (iwater, qbot, qw, ti, swi, lneti, Qei,  &
+        if (timing_flag) call timer_start (it_eddy)
+        call eddy (iwater, ua, ti_a, de, depth, trace_i)
+        if (timing_flag) call timer_stop (it_eddy)
+        if (timing_flag) call timer_start (it_temp)
+        call temp_profile (iwater, qbot, qw, ti_a, swi, lneti, Qei,  &
                            Qhi, de, depth, trace_i)
+        if (timing_flag) call timer_stop (it_temp)
+        if (timing_flag) call timer_start (it_tracer)
         call tracer_profile (de, depth, iwater)
+        if (timing_flag) call timer_stop (it_tracer)
         mixdep = 1
-        call tracer_mixer (ti, dnsty, depth, trace_i, mixdep, iwater)
+        if (timing_flag) call timer_start (it_mixer)
+        call tracer_mixer (ti_a, dnsty, depth, trace_i, mixdep, iwater)
+        if (timing_flag) call timer_stop (it_mixer)
         if (mixdep.gt.mixmax) mixmax = mixdep
       endif  ! if there is ice fraction
+      mixdep_step = mixdep
+      tfrz_step = Tcutoff
 
 !==============================================================
 !     10. Calculate ice formation in open water fraction
 !==============================================================
 
-      if (fracprv.lt.1.0 .and.t(1,1).lt.Tcutoff) then
+      if (fracprv.lt.1.0 .and.temp_a(1,1).lt.Tcutoff) then
         if (iceflag) then
-          call ice_form (ps, qnetice, t, depth, Tcutoff, fracprv,  &
+          call ice_form (ps, qnetice, temp_a, depth, Tcutoff, fracprv,  &
                          trace, fracadd, fracice, hice)
          fracice = fracice+fracadd  ! add to frac from lakeice
          hsnow = hsnow*fracprv/fracice  ! conserve snow
@@ -363,8 +351,10 @@
 !     11.  Average ice and water columns
 !==============================================================
 
-      call column_avg (depth, t, ti, trace, trace_i, fracprv)
+      if (timing_flag) call timer_start (it_avg)
+      call column_avg (depth, temp_a, ti_a, trace, trace_i, fracprv)
       call tracer_avg (depth, fracprv)
+      if (timing_flag) call timer_stop (it_avg)
 
 !==============================================================
 !      12.1 DO WATER AND SALT BALANCE
@@ -372,8 +362,8 @@
 
       if (wb_flag) then
 
-      tdepth1 = t(depth,1)
-      tdepth2 = t(depth,2)
+      tdepth1 = temp_a(depth,1)
+      tdepth2 = temp_a(depth,2)
       isave_d = depth
 
       call water_balance (depth, d_frac, rain, evapw*(1.-fracprv),  &
@@ -382,8 +372,8 @@
 
       if (dep_inc.gt.0) then  ! check about adding new lake layers
          do islice=1,dep_inc  ! add new lake layers
-           t(isave_d+islice,1)=tdepth1 ! set temperature of new layers
-           t(isave_d+islice,2)=tdepth2
+           temp_a(isave_d+islice,1)=tdepth1 ! set temperature of new layers
+           temp_a(isave_d+islice,2)=tdepth2
          enddo
       endif
 
@@ -395,12 +385,12 @@
 
       if (o18flag) then
         call O18 (runin, runout, surf_a, rain, evapw*   &
-                 (1.-fracprv), rh, t, o18prec, o18run,  &
+                 (1.-fracprv), rh, temp_a, o18prec, o18run,  &
                  o18snow, snowmelt*rhosnow/rhowat)
       endif
       if (deutflag) then
         call D2H (runin, runout, surf_a, rain, evapw*   &
-                 (1.-fracprv), rh, t, deutprec, deutrun,&
+                 (1.-fracprv), rh, temp_a, deutprec, deutrun,&
                  deutsnow, snowmelt*rhosnow/rhowat)
       endif
       if (hsprv.gt.0.0 .and.hsnow.eq.0) then  ! all snow gone this dt
@@ -413,15 +403,143 @@
 !      13.  Place updated info back into common blocks
 !==============================================================
 
-      i_shuf = 2   ! put/get info in the common block
-
       evap = evapw*(1.-fracprv)+evapi*(fracprv)
       if (snowmelt.lt.0) melt_flag=.True.
       if (snowmelt.ge.0) melt_flag=.False.
-      call shuffle (xtime,julian,i_shuf, depth, d_frac, tempice,  &
-                    hice, hsnow, fracice, t, snow_flag, o18snow,  &
-                    deutsnow, surf_a, ti, mixmax, evap, runout,   &
-                    melt_flag, nsteps, qew, qhw, sww, luw)
+
+      depth_a = depth
+      d_fraca = d_frac
+      tempi_a = tempice
+      hice_a  = hice
+      hsnow_a = amax1(0.,hsnow)
+      snow_flag_a = snow_flag
+      melt_flag_a = melt_flag
+      fraci_a  = fracice
+      o18snow_a = o18snow
+      deutsnow_a = deutsnow
+      surfarea_a =surf_a
+      mixmax_a =mixmax
+
+      if (timing_flag) call timer_start (it_output)
+      call accum_output (xtime, julian, depth, d_frac, fracice, hice, &
+                         hsnow, mixmax, evap, runout, nsteps, qew,   &
+                         qhw, sww, luw)
+      if (timing_flag) call timer_stop (it_output)
+
+      return
+      end
+
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+!                       ACCUM_OUTPUT
+! adds the state at the end of a time step to the daily averages,
+! weighted by the nsub steps of dt it covers, and writes them out
+! at the end of each day
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+      subroutine accum_output (xtime,day,depth,d_frac,fracice,hice, &
+                               hsnow,mixmax,evap,runout,nsteps,qew, &
+                               qhw,sww,luw)
+      implicit none
+      include 'Malawi.inc'
+      real fracice,hice,hsnow,evap,runout,xtime,day,econv,qew, &
+           qhw,sww,luw
+      integer mixmax,nsteps,k
+
+      mix_ave = mix_ave+mixmax*nsub
+      tsurf_ave = tsurf_ave+temp_a(1,1)*nsub
+      fice_ave = fice_ave+fracice*nsub
+      evap_ave = evap_ave+evap*nsub
+      hice_ave = hice_ave+hice*nsub
+      hsnow_ave = hsnow_ave+hsnow*nsub
+      o18_ave = o18_ave+trace(1,1)*nsub
+      deut_ave = deut_ave+trace(1,2)*nsub
+      runout_sum = runout_sum+runout
+      qew_ave = qew_ave+Qew*nsub         !SD HEAT BUDGET ADD
+      qhw_ave = qhw_ave+Qhw*nsub         !SD HEAT BUDGET ADD
+      luw_ave = luw_ave+luw*nsub         !SD HEAT BUDGET ADD
+      sww_ave = sww_ave+sww*nsub         !SD HEAT BUDGET ADD
+!		print *, qew_ave
+
+      temp_ave(1:depth) = temp_ave(1:depth)+temp_a(1:depth,1)*nsub
+
+      if (xtime.eq.1.) then    ! print daily averages
+         econv = 60.*60.*24      ! convert from mm/s to mm/day
+
+! Begin Ashling          
+! Fixed so that oxygen and hydrogen isotopes can be written separetely 
+! Moved format inside of if so that it formats correctly
+! I removed ice from my output; would need to be added back in; format adjusted accordingly
+         if (o18flag.and.deutflag) then
+        write(51,361) day,tsurf_ave/nsteps,&
+         				 fice_ave/nsteps,&
+                       evap_ave*econv/nsteps,&
+                       mix_ave/nsteps,&
+                       hice_ave/nsteps,hsnow_ave/nsteps,&
+                       o18_ave/nsteps, &
+                       deut_ave/nsteps,runout_sum,mixmax,&
+                       depth,d_frac
+!         write(51,361) day,tsurf_ave/nsteps,&
+!                         evap_ave*econv/nsteps,&
+!                         mix_ave/nsteps,&
+!                         o18_ave/nsteps, &
+!                         deut_ave/nsteps,runout_sum,mixmax,&
+!                         depth,d_frac
+  361      format(F9.2,1x,9(F7.2,1x),2(I5,1x),F6.2)                             
+!          write(50,*) day,((temp_ave(k)/48.),k=1,depth)
+         write(50,362) day,((temp_ave(k)/nsteps),k=1,depth)
+!sd		   write(52,362) day,((o18pro_ave(k)/nsteps),k=1,depth)
+!sd		   write(53,362) day,((deutpro_ave(k)/nsteps),k=1,depth)
+  362      format(58(F11.2,1x))           
+         else if (o18flag.and..not.deutflag) then 
+       write(51,371) day,tsurf_ave/nsteps,&
+                       evap_ave*econv/nsteps,&
+                       mix_ave/nsteps,&
+                       o18_ave/nsteps, &
+                       runout_sum,mixmax,&
+                       depth,d_frac
+  371      format(F9.2,1x,5(F6.2,1x),2(I5,1x),F6.2) 
+         write(50,372) day,((temp_ave(k)/nsteps),k=1,depth)    
+  372      format(58(F11.2,1x))                                
+         else if (.not.o18flag.and.deutflag) then
+       write(51,381) day,tsurf_ave/nsteps,&
+                       evap_ave*econv/nsteps,&
+                       mix_ave/nsteps,&
+                       deut_ave/nsteps, &
+                       runout_sum,mixmax,&
+                       depth,d_frac
+  381      format(F9.2,1x,5(F6.2,1x),2(I5,1x),F6.2)  
+         write(50,382) day,((temp_ave(k)/nsteps),k=1,depth)   
+  382      format(58(F11.2,1x))                               
+         else
+!SD           write(51,391) day,tsurf_ave/nsteps,mix_ave/nsteps,&
+!SD                         evap_ave*econv/nsteps,mixmax,depth
+         write(51,391) day,tsurf_ave/nsteps,mix_ave/nsteps,&          !SD HEAT BUDGET
+                       evap_ave*econv/nsteps,qew_ave/nsteps, &
+                       qhw_ave/nsteps,sww_ave/nsteps, &
+                       luw_ave/nsteps,mixmax,depth
+         write(50,392) day,((temp_ave(k)/nsteps),k=1,depth)
+  391      format(8(F11.4,1x),2(i3,1x))
+  392      format(58(F11.2,1x)) !Here change the temperature profile format.           
+         end if
+
+! End Ashling
+
+         mix_ave=0.0
+         tsurf_ave=0.0
+         fice_ave = 0.0
+         evap_ave = 0.0
+         hice_ave = 0.0
+         hsnow_ave = 0.0
+         o18_ave = 0.0
+         deut_ave = 0.0
+         mixmax_a = 1
+         runout_sum = 0.0
+         qew_ave = 0.0         !SD HEAT BUDGET ADD
+         qhw_ave = 0.0         !SD HEAT BUDGET ADD
+		   sww_ave = 0.0         !ENERGY BUDGET ADD
+		   luw_ave = 0.0         !ENERGY BUDGET ADD
+         temp_ave = 0.0
+      endif
 
       return
       end
@@ -457,7 +575,9 @@
       tposs=b
 199   t=tposs
       tlat=t+273.15   ! switch to kelvin
+      if (timing_flag) call timer_start (it_latsens)
       call latsens (tlat,tcutoff,hice,ta,qa,ua,psurf,delq,evap,qsen)
+      if (timing_flag) call timer_stop (it_latsens)
       hsen=qsen
       qlat=-evap*Lei
       qmet=rlwd-emis*delta*t4(t)+qsen+qlat
@@ -511,7 +631,7 @@
 
       cappa = rair/cpair
       tfac = 1./(sigma**cappa)   ! correction factor for temp at za
-      cdmaxa = 100./(2.*dt)
+      cdmaxa = 100./(2.*dtstep)
 
       pa = sigma*psurf                    ! pressure at za
       rhoa = pa / (rair*ta*(1.+(rvap/rair-1.)*qa))  ! air density
@@ -582,14 +702,13 @@
       real salt_mx (max_dep),temp,fracprv,dnstyw,dnstyi,cpw,cpi,z
 
       do j=1,depth
-        call density(t(j,1),salty(j,n_trace),dnstyw)
-        call density(ti(j,1),salty(j,n_trace),dnstyi)
-        call specheat(t(j,1),salty(j,n_trace),cpw)
-        call specheat(ti(j,1),saltyi(j,n_trace),cpi)
+        call density_layer(j,1,t(j,1),salty(j,n_trace),dnstyw)
+        call density_layer(j,2,ti(j,1),salty(j,n_trace),dnstyi)
+        call specheat_layer(j,1,t(j,1),salty(j,n_trace),cpw)
+        call specheat_layer(j,2,ti(j,1),saltyi(j,n_trace),cpi)
         dnstyw=dnstyw+1000.
         dnstyi=dnstyi+1000.
-        z=dz
-        if (j.eq.1) z=surf
+        z=zl(j)
         temp=((1.-fracprv)*t(j,1)*z*dnstyw*cpw+   &
           fracprv*ti(j,1)*z*dnstyi*cpi)/          &
           ((z*dnstyw*cpw+z*dnstyi*cpi)*0.5)
@@ -597,7 +716,7 @@
         salt_mx(j) = (1.-fracprv)*salty(j,n_trace) +  &
                  fracprv*saltyi(j,n_trace)
         t(j,1)=temp
-        call density (t(j,1),salt_mx(j),dnsty(j))
+        call density_layer (j,1,t(j,1),salt_mx(j),dnsty(j))
       enddo
 
       return
@@ -634,8 +753,8 @@
        runindeut = runin_len * deutrun
        precdeut = rain * deutprec
        trace(1,2)=(trace (1,2)*dexch+   &
-          runindeut-runoutdeut+precdeut-evapdeut/1.e3*dt+snowdeut)/ &
-          (dexch + runin_len-runout + rain - evap/1.e3*dt+hs*rhosnow/&
+          runindeut-runoutdeut+precdeut-evapdeut/1.e3*dtstep+snowdeut)/ &
+          (dexch + runin_len-runout + rain - evap/1.e3*dtstep+hs*rhosnow/&
            rhowat)
 
        return
@@ -703,6 +822,28 @@
       return
       end
 
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+!                  DENSITY_LAYER
+!  density of layer k of the open water (icol=1) or ice (icol=2)
+!  column, from the cache unless its temperature or salinity changed
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+      subroutine density_layer (k,icol,ts,ss,rhostps)
+      implicit none
+      include 'Malawi.inc'
+      integer k,icol
+      real ts,ss,rhostps
+
+      if (ts.ne.eos_td(k,icol) .or. ss.ne.eos_sd(k,icol)) then
+        call density (ts,ss,eos_rho(k,icol))
+        eos_td(k,icol) = ts
+        eos_sd(k,icol) = ss
+      endif
+      rhostps = eos_rho(k,icol)
+
+      return
+      end
+
 !~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 !                     EDDY
 !   computes eddy diffusion profile
@@ -722,7 +863,7 @@
       integer k,iwater
 
       do k=1,depth
-         call density (t(k,1),salty(k,n_trace),dnsty(k))
+         call density_layer (k,2-iwater,t(k,1),salty(k,n_trace),dnsty(k))
       enddo
 
       if (iwater.ne.1) then ! if ice fraction, no de just dm
@@ -730,7 +871,7 @@
           de(k)=dm
         enddo
         return !  no further calculations needed
-      open(unit=15,file='C:/Users/xueya/Downloads/LakeModelGUI/Tanganyika.txt',status='old')
+      endif
 
       u=amax1(u2,0.5) ! avoid NAN in ks
       ks=6.6*sqrt(abs(sin(xlat*raddeg)))*u**(-1.84)
@@ -739,14 +880,10 @@
 
       radmax=4.e4 ! limits Ri to 10
       do k= 1,depth-1
-        if (k .eq. 1) then  ! for surface layer different depth
-          zhalf=(surf+dz)*0.5
-        else
-          zhalf=dz
-        endif
+        zhalf=(zl(k)+zl(k+1))*0.5
         dpdz=(dnsty(k+1)-dnsty(k))/zhalf
         N2=(dpdz/(1.e3+dnsty(k)))*grav
-        z=surf+float(k-1)*dz
+        z=zbot(k)
         if ((ks*z)/ws.gt.40.) then
           rad = radmax  ! avoid NAN
         else
@@ -777,7 +914,7 @@
       include 'Malawi.inc'
 
 !      input files
-      open(unit=15,file=datafile, status='old')
+      open(unit=iforce,file=datafile, status='old')
       !End Ashling
 
 !      output files
@@ -850,15 +987,14 @@
       sum=0.
       do j=1,depth
         if (t(j,1).lt.Tcutoff) then
-           call density (t(j,1),salty(j,n_trace),dnsty)
-           call specheat (t(j,1),salty(j,n_trace),cp)
-           extra=(Tcutoff-t(j,1))*dz*(dnsty+1.e3)*cp
-           if (j.eq.1) extra=(Tcutoff-t(j,1))*surf*(dnsty+1.e3)*cp
+           call density_layer (j,1,t(j,1),salty(j,n_trace),dnsty)
+           call specheat_layer (j,1,t(j,1),salty(j,n_trace),cp)
+           extra=(Tcutoff-t(j,1))*zl(j)*(dnsty+1.e3)*cp
            t(j,1)=Tcutoff
            sum=sum+extra
         endif
       enddo
-      qnetice=(sum/dt)*(1.0-fracprv) ! heat flux absorbed into ice
+      qnetice=(sum/dtstep)*(1.0-fracprv) ! heat flux absorbed into ice
       if (fracprv.le.0.0) hi=fracmin
       di=sum/(fusion*rhoice) ! thickness of new ice
       fracadd=(di/fracmin)*(1.0-fracprv) ! convert to fracadd
@@ -898,6 +1034,61 @@
       return
       end
 
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+!                INIT_GRID
+!    layer thicknesses of the column, surface layer first: surf
+!    and then dz, or the thicknesses listed one per line in
+!    lake_grid.txt (e.g. thin layers near the surface thickening
+!    with depth in a deep lake). The listed layers must add up to
+!    the starting depth of the lake, which is then counted in
+!    layers (depth_a); a lake on its own grid keeps a fixed depth
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+      subroutine init_grid
+
+      implicit none
+      include 'Malawi.inc'
+      integer k,n
+      real thick
+
+      inquire (file='lake_grid.txt', exist=grid_file)
+      if (.not.grid_file) then
+        zl(1)=surf
+        zbot(1)=surf
+        do k=2,max_dep
+          zl(k)=dz
+          zbot(k)=surf+float(k-1)*dz
+        enddo
+      else
+        if (wb_flag) then
+          print *, 'lake_grid.txt: needs a fixed lake depth (wb_flag = .false.)'
+          stop
+        endif
+        open (unit=igrid, file='lake_grid.txt', status='old')
+        n=0
+ 10     read (igrid,*,end=20) thick
+        if (n.eq.max_dep .or. thick.le.0.) then
+          print *, 'lake_grid.txt: more than max_dep layers or a layer <= 0 m'
+          stop
+        endif
+        n=n+1
+        zl(n)=thick
+        zbot(n)=thick
+        if (n.gt.1) zbot(n)=zbot(n-1)+thick
+        goto 10
+ 20     close (igrid)
+        if (n.lt.3 .or. abs(zbot(n)-(surf+float(depth_a-1)*dz)).gt.0.01) then
+          print *, 'lake_grid.txt: needs 3 or more layers adding up to', &
+                   surf+float(depth_a-1)*dz, ' m'
+          stop
+        endif
+        depth_a=n
+      endif
+      grid_depth=0 ! layer areas are set by layer_areas on first use
+
+      return
+      end
+
 !~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 !                INIT_LAKE
 !    initialize lake
@@ -915,6 +1106,7 @@
 
       depth_a = depth_begin
       salty_a = salty_begin
+      call init_grid  ! layer thicknesses; sets depth_a for a grid file
 
 !==============================================================
 !     2. Initialize lake temp and tracer profiles
@@ -922,10 +1114,10 @@
 
 ! Begin Ashling
       do k=1,depth_a
-          temp_a(k)= tempinit 
-          trace_a(k,1)= o18init 
-          trace_a(k,2)= deutinit 
-          trace_a(k,3)= salty_a  ! salinity
+          temp_a(k,1)= tempinit 
+          trace(k,1)= o18init 
+          trace(k,2)= deutinit 
+          trace(k,3)= salty_a  ! salinity
       enddo
  ! End Ashling
 
@@ -956,6 +1148,15 @@
       evap_ave = 0.0   ! holds lake evap for time ave
       hice_ave = 0.0   ! holds ice height for time ave
 
+      eos_td = huge(1.)  ! empty equation of state cache
+      eos_tc = huge(1.)
+
+      nadapt = 1         ! time steps start at dt (see step_size)
+      mixdep_step = 1
+      mixdep_prev = 1
+      tstep_prev = tempinit
+      tfrz_step = 0.0
+
       return
       end
 
@@ -1060,8 +1261,8 @@
 !     1.  Calculate surface fluxes, update tempice
 !=============================================================
 
-       condqw = rhowat * cpw_ice * surf / (qwtau*2.)
-       evapl=evapi*dt/1000.  ! convert from mm/sec to m (over this dt)
+       condqw = rhowat * cpw_ice * zl(1) / (qwtau*2.)
+       evapl=evapi*dtstep/1000.  ! convert from mm/sec to m (over this dt)
        tprev=tempice          ! keep track of incoming t0
        qmet=radlwd-emis*delta*t4(tprev)+qsen+qlat
 !     1a. Calculate surface fluxes, update tempice
@@ -1103,7 +1304,7 @@
           evapl=0.0                   ! all evapl used in removing snow
           evaps=evapi                 ! all ice evap to snow
         else     ! evapl is greater than snow thickness
-          evaps=hs*(rhosnow/rhowat)*1.e3/dt  ! make a rate
+          evaps=hs*(rhosnow/rhowat)*1.e3/dtstep  ! make a rate
           evapl=evapl-hs*(rhosnow/rhowat)
           hs=0.0
         endif
@@ -1116,9 +1317,9 @@
 !===============================================================
 
       if (hs.gt.0.0) then
-        ds=(-qmelts/(rhosnow*fusion))*dt  ! ds < 0, melting
+        ds=(-qmelts/(rhosnow*fusion))*dtstep  ! ds < 0, melting
         if (-ds.gt.hs) then  ! then have to melt ice too
-          qmeltsx=qmelts-(hs*rhosnow*fusion/dt)  ! enery remaining for ice
+          qmeltsx=qmelts-(hs*rhosnow*fusion/dtstep)  ! enery remaining for ice
           hs=0.0             ! set snow to zero
         else
           hs=hs+ds
@@ -1131,12 +1332,12 @@
 
       if (hs.le.0.0) then   ! if there is ice at the surface
         disurf=((-qmelts/(rhoice*fusion))+     &
-               (-qmeltsx/(rhoice*fusion)))*dt+ & ! add extra from snow
+               (-qmeltsx/(rhoice*fusion)))*dtstep+ & ! add extra from snow
                (-evapl*(rhowat/rhoice))      ! add remaining evap length
       else
         disurf=0.0
       endif
-      dibot=(qmeltb/(rhoice*fusion))*dt  ! no minus here
+      dibot=(qmeltb/(rhoice*fusion))*dtstep  ! no minus here
 
 !==================================================================
 !     4.4  Adjust ice thickness and fraction
@@ -1163,7 +1364,7 @@
           if (fracice.lt.fraclim.and.df.le.0.0) then
             xfrac=fracice ! all remaining ice is extra
             diextra=xfrac*fracmin/1.0 ! convert this to a thickness
-            extraf=-diextra*rhoice*fusion*(1./dt)
+            extraf=-diextra*rhoice*fusion*(1./dtstep)
             qw=qw-extraf  ! adjust flux from water for heating
             qnetice=qnetice+extraf
             fracice=0.0  ! set frac, thickness and snow to 0.0
@@ -1218,6 +1419,43 @@
       return
       end
 
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+!                     LAYER_AREAS
+!     hypsometric area of each layer of a lake depth layers
+!     deep. area is tabulated every dz below the sill: a layer
+!     of the uniform grid takes its table value, a layer from
+!     lake_grid.txt the mean of the table over its depth range
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+      subroutine layer_areas (depth)
+
+      implicit none
+      include 'Malawi.inc'
+      integer k,i
+      real s0,top,bot,sum
+
+      if (.not.grid_file) then
+        do k=1,depth
+          area_l(k)=area(k+max_dep-depth)
+        enddo
+      else
+        s0=float(max_dep)*dz-zbot(depth) ! depth of the lake surface below the sill
+        do k=1,depth
+          top=s0
+          if (k.gt.1) top=s0+zbot(k-1)
+          bot=s0+zbot(k)
+          sum=0.
+          do i=max(1,int(top/dz)+1),min(max_dep,int(bot/dz-1.e-4)+1)
+            sum=sum+area(i)*(amin1(bot,float(i)*dz)-amax1(top,float(i-1)*dz))
+          enddo
+          area_l(k)=sum/(bot-top)
+        enddo
+      endif
+      grid_depth=depth
+
+      return
+      end
+
 !~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 !                        O18
 !     computes O18 balance in the surface layer
@@ -1249,10 +1487,75 @@
       runin_o18  = runin_len * o18run
       preco18 = rain * o18prec
       trace(1,1)=(trace (1,1)*dexch+   &
-           runin_o18-runout_o18+preco18-evapo18/1.e03*dt+  &
+           runin_o18-runout_o18+preco18-evapo18/1.e03*dtstep+  &
            snowo18)/ (dexch+runin_len-runout+rain-       &
-           evap/1.e03*dt+hs*rhosnow/rhowat)
+           evap/1.e03*dtstep+hs*rhosnow/rhowat)
+
+      return
+      end
+
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+!                   READ_FORCING
+!     reads forcing record i (1 or 2) from unit iforce, with the
+!     columns selected by wb_flag, deutflag and o18flag, and
+!     converts it with DATAIN. eof is true at the end of the file.
+!     The only routine that reads the forcing file.
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+      subroutine read_forcing (i, year, day, ta_in, dp_in, ua_in, sw_in, &
+                               rlwd_in, ps_in, prec_in, runin_in, &
+                               deutprec_in, deutrun_in, o18prec_in, &
+                               o18run_in, qa_in, rh_in, eof)
+
+      implicit none
+      include 'Malawi.inc'
+      integer i
+      real year(2),day(2),ta_in(2),dp_in(2),ua_in(2),sw_in(2),  &
+           rlwd_in(2),ps_in(2),prec_in(2),runin_in(2),          &
+           deutprec_in(2),deutrun_in(2),o18prec_in(2),o18run_in(2), &
+           qa_in(2),rh_in(2)
+      logical eof
+
+      eof = .false.
+      if (wb_flag) then
+        !variable lake depth, with or without isotopes
+        if(deutflag.and..not.o18flag) then
+          !read for deut only
+          read(iforce,*,end=99) year(i),day(i),ta_in(i),dp_in(i),   &
+                         ua_in(i),sw_in(i),rlwd_in(i),ps_in(i),       &
+                         prec_in(i), deutprec_in(i), &
+                         runin_in(i), deutrun_in(i)
+        else if(o18flag.and..not.deutflag) then
+          !read for o18 only
+          read(iforce,*,end=99) year(i),day(i),ta_in(i),dp_in(i),   &
+                         ua_in(i),sw_in(i),rlwd_in(i),ps_in(i),       &
+                         prec_in(i), o18prec_in(i), &
+                         runin_in(i), o18run_in(i)
+        else if(o18flag.and.deutflag) then
+          !read for deut and o18
+          read(iforce,*,end=99) year(i),day(i),ta_in(i),dp_in(i),   &
+                         ua_in(i),sw_in(i),rlwd_in(i),ps_in(i),       &
+                         prec_in(i), deutprec_in(i), o18prec_in(i), &
+                         runin_in(i), deutrun_in(i), o18run_in(i)
+        else
+          !only wb_flag
+          read(iforce,*,end=99) year(i),day(i),ta_in(i),dp_in(i),   &
+                         ua_in(i),sw_in(i),rlwd_in(i),ps_in(i),       &
+                         prec_in(i),runin_in(i)
+        end if
+      else
+        !not variable lake depth, no isotopes
+        read(iforce,*,end=99) year(i),day(i),ta_in(i),dp_in(i),   &
+                         ua_in(i),sw_in(i),rlwd_in(i),ps_in(i)
+        runin_in(i)=0.0
+        prec_in(i)=0.0
+      end if
+
+      call datain (ta_in(i),dp_in(i),ua_in(i),sw_in(i),rlwd_in(i),  &
+                   ps_in(i),prec_in(i),runin_in(i),qa_in(i),rh_in(i))
+      return
 
+ 99   eof = .true.
       return
       end
 
@@ -1303,175 +1606,6 @@
       return
       end
 
-!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-!                       SHUFFLE
-! shuffles data to and from common block
-!c~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-
-      subroutine shuffle (xtime,day,i_shuf,depth,d_frac,tempice,   &
-                          hice,hsnow,fracice,t_shuf,snow_flag, &
-                          o18snow,deutsnow,surf_a,ti_shuf,mixmax,   &
-                          evap,runout,melt_flag,nsteps,qew,qhw,sww,luw)
-      implicit none
-      include 'Malawi.inc'
-      real tempice,hice,hsnow,fracice,surf_a,evap,xtime,day, &
-           t_shuf (max_dep,2),ti_shuf(max_dep,2),econv,runout,&
-           o18snow,deutsnow,qew,qhw,sww,luw
-      logical snow_flag,melt_flag
-      integer k,i_shuf,i_trace,mixmax,nsteps
-
-!     print *, qew, qhw, sww, luw
-      if (i_shuf.eq.1) then  ! get info from common block
-        depth   = depth_a
-        d_frac  = d_fraca
-        tempice = tempi_a
-        hice    = hice_a
-        hsnow   = amax1(0.,hsnow_a)
-        snow_flag = snow_flag_a
-        melt_flag = melt_flag_a
-        o18snow = o18snow_a
-        deutsnow = deutsnow_a
-        fracice = fraci_a
-        surf_a =surfarea_a
-        mixmax = mixmax_a
-
-        do k = 1, depth
-           t_shuf(k,1) = temp_a (k)
-           ti_shuf(k,1) = ti_a (k)
-           do i_trace = 1,n_trace
-             trace(k,i_trace) = trace_a (k,i_trace) ! for open water frac
-             trace_i(k,i_trace) = trace_a (k,i_trace)  ! for ice frac
-           enddo
-        enddo
-      else if (i_shuf.eq.2) then ! place info in common blocks
-        depth_a = depth
-        d_fraca = d_frac
-        tempi_a = tempice
-        hice_a  = hice
-        hsnow_a = amax1(0.,hsnow)
-        snow_flag_a = snow_flag
-        melt_flag_a = melt_flag
-        fraci_a  = fracice
-        o18snow_a = o18snow
-        deutsnow_a = deutsnow
-        surfarea_a =surf_a
-        mixmax_a =mixmax
-        do k = 1, depth
-           temp_a (k) = t_shuf(k,1)
-           ti_a(k) = ti_shuf(k,1)
-           do i_trace = 1,n_trace
-             trace_a(k,i_trace) = trace(k,i_trace)
-           enddo
-        enddo
-
-        mix_ave = mix_ave+mixmax
-        tsurf_ave = tsurf_ave+t_shuf(1,1)
-        fice_ave = fice_ave+fracice
-        evap_ave = evap_ave+evap
-        hice_ave = hice_ave+hice
-        hsnow_ave = hsnow_ave+hsnow
-        o18_ave = o18_ave+trace_a(1,1)
-        deut_ave = deut_ave+trace_a(1,2)
-        runout_sum = runout_sum+runout
-        qew_ave = qew_ave+Qew         !SD HEAT BUDGET ADD
-        qhw_ave = qhw_ave+Qhw         !SD HEAT BUDGET ADD
-        luw_ave = luw_ave+luw         !SD HEAT BUDGET ADD
-        sww_ave = sww_ave+sww         !SD HEAT BUDGET ADD
-!		print *, qew_ave
-
-        do k=1,depth
-           temp_ave(k)=temp_ave(k)+temp_a(k)
-!sd		  ! o18pro_ave(k)=o18pro_ave(k)+trace_a(k,1)
-!sd 	  ! deutpro_ave(k)=deutpro_ave(k)+trace_a(k,2)
-        end do
-
-        if (xtime.eq.1.) then    ! print daily averages
-           econv = 60.*60.*24      ! convert from mm/s to mm/day
-
-! Begin Ashling          
-! Fixed so that oxygen and hydrogen isotopes can be written separetely 
-! Moved format inside of if so that it formats correctly
-! I removed ice from my output; would need to be added back in; format adjusted accordingly
-           if (o18flag.and.deutflag) then
-          write(51,361) day,tsurf_ave/nsteps,&
-           				 fice_ave/nsteps,&
-                         evap_ave*econv/nsteps,&
-                         mix_ave/nsteps,&
-                         hice_ave/nsteps,hsnow_ave/nsteps,&
-                         o18_ave/nsteps, &
-                         deut_ave/nsteps,runout_sum,mixmax,&
-                         depth,d_frac
-!         write(51,361) day,tsurf_ave/nsteps,&
-!                         evap_ave*econv/nsteps,&
-!                         mix_ave/nsteps,&
-!                         o18_ave/nsteps, &
-!                         deut_ave/nsteps,runout_sum,mixmax,&
-!                         depth,d_frac
-  361      format(F9.2,1x,9(F7.2,1x),2(I5,1x),F6.2)                             
-!          write(50,*) day,((temp_ave(k)/48.),k=1,depth)
-           write(50,362) day,((temp_ave(k)/nsteps),k=1,depth)
-!sd		   write(52,362) day,((o18pro_ave(k)/nsteps),k=1,depth)
-!sd		   write(53,362) day,((deutpro_ave(k)/nsteps),k=1,depth)
-  362      format(58(F11.2,1x))           
-           else if (o18flag.and..not.deutflag) then 
-         write(51,371) day,tsurf_ave/nsteps,&
-                         evap_ave*econv/nsteps,&
-                         mix_ave/nsteps,&
-                         o18_ave/nsteps, &
-                         runout_sum,mixmax,&
-                         depth,d_frac
-  371      format(F9.2,1x,5(F6.2,1x),2(I5,1x),F6.2) 
-           write(50,372) day,((temp_ave(k)/nsteps),k=1,depth)    
-  372      format(58(F11.2,1x))                                
-           else if (.not.o18flag.and.deutflag) then
-         write(51,381) day,tsurf_ave/nsteps,&
-                         evap_ave*econv/nsteps,&
-                         mix_ave/nsteps,&
-                         deut_ave/nsteps, &
-                         runout_sum,mixmax,&
-                         depth,d_frac
-  381      format(F9.2,1x,5(F6.2,1x),2(I5,1x),F6.2)  
-           write(50,382) day,((temp_ave(k)/nsteps),k=1,depth)   
-  382      format(58(F11.2,1x))                               
-           else
-!SD           write(51,391) day,tsurf_ave/nsteps,mix_ave/nsteps,&
-!SD                         evap_ave*econv/nsteps,mixmax,depth
-           write(51,391) day,tsurf_ave/nsteps,mix_ave/nsteps,&          !SD HEAT BUDGET
-                         evap_ave*econv/nsteps,qew_ave/nsteps, &
-                         qhw_ave/nsteps,sww_ave/nsteps, &
-                         luw_ave/nsteps,mixmax,depth
-           write(50,392) day,((temp_ave(k)/nsteps),k=1,depth)
-  391      format(8(F11.4,1x),2(i3,1x))
-  392      format(58(F11.2,1x)) !Here change the temperature profile format.           
-           end if
-
-! End Ashling
-
-           mix_ave=0.0
-           tsurf_ave=0.0
-           fice_ave = 0.0
-           evap_ave = 0.0
-           hice_ave = 0.0
-           hsnow_ave = 0.0
-           o18_ave = 0.0
-           deut_ave = 0.0
-           mixmax_a = 1
-           runout_sum = 0.0
-           qew_ave = 0.0         !SD HEAT BUDGET ADD
-           qhw_ave = 0.0         !SD HEAT BUDGET ADD
-		   sww_ave = 0.0         !ENERGY BUDGET ADD
-		   luw_ave = 0.0         !ENERGY BUDGET ADD
-           do k=1,max_dep
-             temp_ave(k)=0.0
-!sd			 o18pro_ave(k)=0.0
-!sd			 deutpro_ave(k)=0.0
-           end do
-        endif
-      endif
-
-      return
-      end
-
 !~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 !                        SOLAR_DEC
 !  computes the solar declination angle from the julian date.
@@ -1514,6 +1648,69 @@
       return
       end
 
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+!                  SPECHEAT_LAYER
+!  specific heat of layer k of the open water (icol=1) or ice (icol=2)
+!  column, from the cache unless its temperature or salinity changed
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+      subroutine specheat_layer (k,icol,t,s,cpts)
+      implicit none
+      include 'Malawi.inc'
+      integer k,icol
+      real t,s,cpts
+
+      if (t.ne.eos_tc(k,icol) .or. s.ne.eos_sc(k,icol)) then
+        call specheat (t,s,eos_cp(k,icol))
+        eos_tc(k,icol) = t
+        eos_sc(k,icol) = s
+      endif
+      cpts = eos_cp(k,icol)
+
+      return
+      end
+
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+!                      STEP_SIZE
+!  length of the next time step, in steps of dt (nsub) and in
+!  seconds (dtstep); always dt unless adapt_flag is true. The
+!  adaptive step doubles while the surface temperature and the
+!  mixing depth changed by less than half of adapt_dtemp and
+!  adapt_dmix over the last step, halves when either change is
+!  over its tolerance (the step is not repeated), and is dt while
+!  there is ice or snow or the column is within noice_margin of
+!  freezing. It is at most adapt_nmax steps of dt and ends at the
+!  next forcing record (nleft steps of dt away), so the tendencies
+!  and the daily output see the same step boundaries as before
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+      subroutine step_size (nleft)
+
+      implicit none
+      include 'Malawi.inc'
+      integer nleft
+      real change
+
+      if (adapt_flag) then
+        change = amax1(abs(temp_a(1,1)-tstep_prev)/adapt_dtemp,  &
+                       abs(float(mixdep_step-mixdep_prev))/adapt_dmix)
+        if (fraci_a.gt.0.0 .or. hsnow_a.gt.0.0 .or.  &
+            minval(temp_a(1:depth_a,1)).le.tfrz_step+noice_margin) then
+          nadapt = 1
+        else if (change.gt.1.0) then
+          nadapt = max(1,nadapt/2)
+        else if (change.lt.0.5) then
+          nadapt = min(2*nadapt,adapt_nmax)
+        endif
+        tstep_prev = temp_a(1,1)
+        mixdep_prev = mixdep_step
+      endif
+      nsub = min(nadapt,nleft)
+      dtstep = dt*nsub
+
+      return
+      end
+
 !~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 !                      TEMP_PROFILE
 !   computes diffusive mixing of temperature profile
@@ -1527,7 +1724,7 @@
       include 'Malawi.inc'
       real qbot,qw,sw,lnet,Qe,Qh,area_2,t1,cnextra,swtop,    &
            dist12,area_1,top,bot
-      integer az,k,iwater,ktop
+      integer az,k,iwater
 
       parameter (az = 1000 ) ! length of arrays first dimensioned here
       real t(depth,2), de(depth), dnsty(depth)
@@ -1536,26 +1733,25 @@
       real told(az), tnew(az)
       real salty(max_dep,n_trace)
 
-! z is an array of delz with depth
+! z is an array of delz with depth (the layer grid zl, see init_grid)
 ! zhalf is array of delz between i and i+1
 ! so, zhalf(3) = dist from mid of 3 to mid of 4
 ! zhalf = .5*(dz(i)+dz(i+1))
-! here all 1 except for zhalf(1) = .8
+! all dz for the uniform grid except for zhalf(1) = .5*(surf+dz)
 
       dist12=surf*0.5+dz*0.5 ! dist for grad t calc between
-      ktop = max_dep-depth  ! index value of lake surface
 
       do k= 1,depth ! init density, spec_ht, zhalf through col
         t(k,2)=t(k,1)
         told(k)=t(k,1)
-        call density(t(k,1),salty(k,n_trace),dnsty(k))
-        call specheat(t(k,1),salty(k,n_trace),cpz(k))
-        z(k)=dz
-        zhalf(k)=dz
+        call density_layer(k,2-iwater,t(k,1),salty(k,n_trace),dnsty(k))
+        call specheat_layer(k,2-iwater,t(k,1),salty(k,n_trace),cpz(k))
+        z(k)=zl(k)
       enddo
-
-        z(1)=surf                ! make top slice z = surf
-        zhalf(1)=0.5*(z(1)+z(2)) ! calc zhalf between 1 and 2
+      do k=1,depth-1
+        zhalf(k)=0.5*(z(k)+z(k+1))
+      enddo
+      zhalf(depth)=z(depth)
 
 !-----------------------------------------------------------------------
 !   2. calculate d array, which includes heating terms
@@ -1565,90 +1761,96 @@
 
 !   2.1   First do top slice of column
            k = 1
-           area_1 =(area(k+ktop) + area(k+ktop)) /2.
+           area_1 =(area_l(k) + area_l(k)) /2.
 ! 0.6m above base of dz is almost = to where basin area is assigned
-           area_2 =(area(k+ktop) + area(k+ktop+1)) / 2.
+           area_2 =(area_l(k) + area_l(k+1)) / 2.
           if (iwater.eq.1) then  ! open water calculation
            t1 = sw*beta +   &
-                (1.-beta)*sw*(1.-exp(-eta*surf))*area_2/area(k+ktop) +  &
-                (Lnet+Qe+Qh) * area_1/area(k+ktop)
+                (1.-beta)*sw*(1.-exp(-eta*z(1)))*area_2/area_l(k) +  &
+                (Lnet+Qe+Qh) * area_1/area_l(k)
           else                   ! calculation beneath ice
            t1 = qbot*beta +       &
-                (1.-beta)*qbot*(1.-exp(-eta*surf))*area_2/area(k+ktop) - &
-                qw * area_1/area(k+ktop)
+                (1.-beta)*qbot*(1.-exp(-eta*z(1)))*area_2/area_l(k) - &
+                qw * area_1/area_l(k)
           endif
 
-        cnextra = 0.5 * area_2/area(k+ktop) * & ! for k = 1, top slice in column
-       ((de(1)/zhalf(1)) * (dt/z(1)) * (t(2,1) - t(1,1)))
+        cnextra = 0.5 * area_2/area_l(k) * & ! for k = 1, top slice in column
+       ((de(1)/zhalf(1)) * (dtstep/z(1)) * (t(2,1) - t(1,1)))
 
-        d(1) = t(1,1)+t1*dt/((1.e3+dnsty(1))*cpz(1)*z(1))+cnextra
+        d(1) = t(1,1)+t1*dtstep/((1.e3+dnsty(1))*cpz(1)*z(1))+cnextra
 
 !   2.2   Remainder of water column, excluding top and bottom slice
        swtop = qbot   ! use ice value
        if (iwater.eq.1) swtop = sw ! set to water value if wat frac.
        do  k=2,depth-1           ! loop through water column
-         top = (surf+(k-2)*dz)
-         bot = (surf+(k-1)*dz)
-         area_1 =(area(k+ktop-1) + area(k+ktop)) / 2.
-         area_2 =(area(k+ktop) + area(k+ktop+1)) / 2.
+         top = zbot(k-1)
+         bot = zbot(k)
+         area_1 =(area_l(k-1) + area_l(k)) / 2.
+         area_2 =(area_l(k) + area_l(k+1)) / 2.
          t1 = (1.-beta)*swtop*  &
-              ((area_1*exp(-eta*top)-area_2*exp(-eta*bot))/area(k+ktop))
+              ((area_1*exp(-eta*top)-area_2*exp(-eta*bot))/area_l(k))
 
 !      terms below reversed for C-N
 
-         cnextra = 0.5 *1./area(k+ktop)*  &
-             (((de(k)/zhalf(k))*(dt/z(k))*(t(k+1,1)-t(k,1))) *area_2 -  &
-             ((de(k-1)/zhalf(k-1))*(dt/z(k))*(t(k,1)-t(k-1,1)))*area_1)
-         d(k) = t(k,1)+t1*dt/((1.e3+dnsty(k))*cpz(k)*z(k))+cnextra
+         cnextra = 0.5 *1./area_l(k)*  &
+             (((de(k)/zhalf(k))*(dtstep/z(k))*(t(k+1,1)-t(k,1))) *area_2 -  &
+             ((de(k-1)/zhalf(k-1))*(dtstep/z(k))*(t(k,1)-t(k-1,1)))*area_1)
+         d(k) = t(k,1)+t1*dtstep/((1.e3+dnsty(k))*cpz(k)*z(k))+cnextra
 
        enddo                   ! do next slice in column
 
 !    2.3  Bottom slice of the water column
 !         No mud heating
       k=depth
-      area_1 =(area(k+ktop-1) + area(k+ktop)) / 2.
+      area_1 =(area_l(k-1) + area_l(k)) / 2.
       swtop = qbot   ! use ice value
       if (iwater.eq.1) swtop = sw ! set to water value if wat frac.
-      top = (surf+(k-2)*dz)
-      t1 = (1.-beta)*swtop*(exp(-eta*top))*area_1/area(k+ktop)
-      cnextra = 0.5 * area_1/area(k+ktop) * &  ! for k = depth
-       ((de(k-1)/zhalf(k-1)) * (dt/z(k)) * (t(k,1) - t(k-1,1)))
-      d(k) = t(k,1)+t1*dt/((1.e3+dnsty(k))*cpz(k)*z(k))+cnextra
+      top = zbot(k-1)
+      t1 = (1.-beta)*swtop*(exp(-eta*top))*area_1/area_l(k)
+      cnextra = 0.5 * area_1/area_l(k) * &  ! for k = depth
+       ((de(k-1)/zhalf(k-1)) * (dtstep/z(k)) * (t(k,1) - t(k-1,1)))
+      d(k) = t(k,1)+t1*dtstep/((1.e3+dnsty(k))*cpz(k)*z(k))+cnextra
 
 !-----------------------------------------------------------------------
 !   3. calculate arrays for tridiagonal matrix, top and bot slice seperate
 !------------------------------------------------------------------------
 
       k = 1  ! do top slice
-      area_2 =(area(k+ktop) + area(k+ktop+1)) / 2.
+      area_2 =(area_l(k) + area_l(k+1)) / 2.
       b(1) = -0.5 * (de(1)/zhalf(1)) *   &
-              (dt/z(1)) * area_2/area(k+ktop)
+              (dtstep/z(1)) * area_2/area_l(k)
       a(1) = 1. - b(1)  ! no factor of 0.5 here, already done
 
       do  k = 2,depth-1 ! do all but top and bottom slices
-        area_1 =(area(k+ktop-1) + area(k+ktop)) / 2.
-        area_2 =(area(k+ktop) + area(k+ktop+1)) / 2.
+        area_1 =(area_l(k-1) + area_l(k)) / 2.
+        area_2 =(area_l(k) + area_l(k+1)) / 2.
         b(k) = -0.5 * (de(k)/zhalf(k)) *  &
-              (dt/z(k))*area_2/area(k+ktop)
+              (dtstep/z(k))*area_2/area_l(k)
         c(k) = -0.5 * (de(k-1)/zhalf(k-1)) *  &
-              (dt/z(k))*area_1/area(k+ktop)
+              (dtstep/z(k))*area_1/area_l(k)
         a(k) = 1. - b(k) - c(k) ! no 0.5 here, already done
       enddo
       k=depth  ! do bottom slice
-      area_1 =(area(k+ktop-1) + area(k+ktop)) / 2.
+      area_1 =(area_l(k-1) + area_l(k)) / 2.
       c(depth) = -0.5 * (de(depth)/zhalf(depth) ) *  &
-              (dt/z(depth)) * area_1/area(k+ktop)
+              (dtstep/z(depth)) * area_1/area_l(k)
       a(depth) = 1. - c(depth)
 
 !-------------------------------------------------------------
-!    4. call matrix solution, and reset temp and density arrays
+!    4. factor the matrix, keeping the factors for the tracers in
+!       tracer_profile, solve and reset temp and density arrays
 !-------------------------------------------------------------
 
-       call tridiag_solve(1,1,depth,c,a,b,d,tnew)
+       call tridiag_factor (depth, c, a, b, dif_alpha, dif_gamma)
+       do k = 2, depth
+          dif_sub(k) = c(k)
+       enddo
+       call tridiag_subst (1, 1, depth, dif_sub, dif_alpha, dif_gamma, &
+                           d, tnew)
        do k = 1, depth  ! change temps and densities
           t(k,2) = tnew(k)
           t(k,1) = t(k,2)
-          call density (t(k,2),salty(k,n_trace),dnsty(k))
+          call density_layer (k,2-iwater,t(k,2),salty(k,n_trace),dnsty(k))
        enddo
 
        return
@@ -1731,6 +1933,75 @@
       return
       end
 
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+!                   TIMER_INIT, TIMER_START, TIMER_STOP, TIMER_REPORT
+!     wall-clock totals and call counts of the major subroutines,
+!     accumulated in common /ltimer/ when timing_flag is true
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+      subroutine timer_init
+
+      implicit none
+      include 'Malawi.inc'
+      integer i
+
+      do i=1,ntimer
+        tm_start(i) = 0
+        tm_count(i) = 0
+        tm_ticks(i) = 0.d0
+      enddo
+
+      return
+      end
+
+      subroutine timer_start (itimer)
+
+      implicit none
+      include 'Malawi.inc'
+      integer itimer
+
+      call system_clock(tm_start(itimer))
+
+      return
+      end
+
+      subroutine timer_stop (itimer)
+
+      implicit none
+      include 'Malawi.inc'
+      integer itimer
+      integer*8 now
+
+      call system_clock(now)
+      tm_ticks(itimer) = tm_ticks(itimer) + dble(now-tm_start(itimer))
+      tm_count(itimer) = tm_count(itimer) + 1
+
+      return
+      end
+
+      subroutine timer_report
+
+      implicit none
+      include 'Malawi.inc'
+      integer i
+      integer*8 now,rate
+      character(10) names(ntimer)
+      data names /'run','read','lake_main','latsens','lake_ice', &
+                  'eddy','temp_prof','tracer','mixer','column_avg', &
+                  'output'/
+
+      call system_clock(now,rate)
+      open(unit=60,file='lake_timing.txt',status='unknown')
+      write(60,'(a10,a12,a14)') 'name','calls','seconds'
+      do i=1,ntimer
+        write(60,'(a10,i12,f14.4)') names(i),tm_count(i), &
+                                     tm_ticks(i)/dble(rate)
+      enddo
+      close(60)
+
+      return
+      end
+
 !~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 !                   TRACER_AVG
 !     average water and ice for fractional cover
@@ -1769,7 +2040,7 @@
       real tr_av (n_trace), ave_tr (n_trace), salty(max_dep,n_trace)
 
       do k=1,depth
-         call density(t(k,1),salty(k,n_trace),dnsty(k))
+         call density_layer(k,2-iwater,t(k,1),salty(k,n_trace),dnsty(k))
       enddo
 
       mixprev = 1 ! top depth of local instability, may not be 1
@@ -1807,18 +2078,11 @@
 !------------------------------------------------------------------------
 
         do m = mixprev, k+1 ! mix from top of instab to bot of inst
-           call specheat (t(m,2),salty(m,n_trace),cp)
-           if (m.eq.1) then
-              vol = surf*(1.e3+dnsty(m))*cp*area(m+max_dep-depth) ! joules / deg
-              vol_tr = surf * area(m+max_dep-depth)
+           call specheat_layer (m,2-iwater,t(m,2),salty(m,n_trace),cp)
+           vol = zl(m)*(1.e3+dnsty(m))*cp*area_l(m) ! joules / deg
+           vol_tr = zl(m) * area_l(m)
 !  calculate the total heat in each layer of unstable water (vol) and the
-!  total volume of each layer (vol_tr)
-           else
-              vol = dz*(1.e3+dnsty(m))*cp*area(m+max_dep-depth)   ! joules / deg
-              vol_tr = dz * area(m+max_dep-depth)
-!  same as above, but using dz instead of surf to reflect the fact that we
-!  are in a layer below the surface
-           endif
+!  total volume of each layer (vol_tr), with the thickness of the layer
            avet=avet+t(m,2)*vol
            avev=avev+vol
 
@@ -1895,7 +2159,7 @@
 !  once mixing is completely done, calculate the new density profile for the
 !  mixed water
 
-        call density (t(k,1),salty(k,n_trace),dnsty(k))
+        call density_layer (k,2-iwater,t(k,1),salty(k,n_trace),dnsty(k))
       enddo
 
       return
@@ -1905,6 +2169,9 @@
 !               TRACER_PROFILE
 !     computes diffusive mixing of passive tracers
 !     this is a crank-nicholson version -- sept 5 1996
+!     the diffusion matrix is the one temp_profile has just
+!     factored for the same column, so all tracers are solved
+!     together with its factors
 !~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
       subroutine tracer_profile (de, depth, iwater)
@@ -1912,156 +2179,119 @@
       implicit none
       include 'Malawi.inc'
       real dist12,area_1,area_2,cnextra
-      integer az,i_tr,k,i_water,iwater,ktop
+      integer az,i_tr,k,iwater
       parameter (az = 1000) ! length of arrays first dimensioned here
 
       real de(max_dep)
       real z(az), zhalf(az) ! dz, and dz.5
-      real a(az), b(az), c(az), d(az)  ! arrays for tridia matrix
-      real tnew(az)
-      real tr_work (max_dep)
+      real d(n_trace,az)  ! right hand sides, one per tracer
+      real tnew(n_trace,az)
+      real tr_work (n_trace,max_dep)
 
-! z is an array of delz with depth
+! z is an array of delz with depth (the layer grid zl, see init_grid)
 ! zhalf is array of delz between i and i+1
 ! so, zhalf(3) = dist from mid of 3 to mid of 4
 ! zhalf = .5*(dz(i)+dz(i+1))
-! here all 1 except for zhalf(1) = .8
+! all dz for the uniform grid except for zhalf(1) = .5*(surf+dz)
 
 !-----------------------------------------------------------------------
-!   0.  Loop through the different tracers
-!------------------------------------------------------------------------
-
-      do 1 i_tr = 1, num_tra
-
-!-----------------------------------------------------------------------
-!   1.  Place correct tracer into work arrray
+!   1.  Place tracers into work arrray
 !------------------------------------------------------------------------
 
       dist12=surf*0.5+dz*0.5 ! dist for grad t calc between
-      ktop = max_dep-depth
 
       do 10 k= 1,depth ! init density, spec_ht, zhalf through col
-        z(k)=dz
-        zhalf(k)=dz
-        if (iwater.eq.1) tr_work(k) = trace (k,i_tr)  ! open water calc
-        if (iwater.eq.0) tr_work(k) = trace_i (k,i_tr)  ! ice calc
+        z(k)=zl(k)
+        do i_tr = 1, num_tra
+          if (iwater.eq.1) tr_work(i_tr,k) = trace (k,i_tr)  ! open water calc
+          if (iwater.eq.0) tr_work(i_tr,k) = trace_i (k,i_tr)  ! ice calc
+        enddo
  10   continue
 
-      z(1)=surf                ! make top slice z = surf
-      zhalf(1)=0.5*(z(1)+z(2)) ! calc zhalf between 1 and 2
+      do k=1,depth-1
+        zhalf(k)=0.5*(z(k)+z(k+1))
+      enddo
+      zhalf(depth)=z(depth)
 
 !-----------------------------------------------------------------------
-!   2. calculate d array, which includes heating terms
-!      so seperate for ice and water fraction of cell
+!   2. calculate d array for each tracer
 !     cnextra is extra term in d array for crank-nicholson
 !------------------------------------------------------------------------
 
+      do 1 i_tr = 1, num_tra
+
       k = 1   ! top slice
-      area_1 =(area(k+ktop) + area(k+ktop)) / 2.
-      area_2 =(area(k+ktop) + area(k+ktop+1)) / 2.
+      area_1 =(area_l(k) + area_l(k)) / 2.
+      area_2 =(area_l(k) + area_l(k+1)) / 2.
 
-      cnextra = 0.5 * area_2/area(k+ktop) * & ! for k = 1, top slice in column
-       ((de(1)/zhalf(1)) * (dt/z(1))*(tr_work(2) - tr_work(1)))
+      cnextra = 0.5 * area_2/area_l(k) * & ! for k = 1, top slice in column
+       ((de(1)/zhalf(1)) * (dtstep/z(1))*(tr_work(i_tr,2) - tr_work(i_tr,1)))
 
-      d(1) = tr_work(1)+cnextra
+      d(i_tr,1) = tr_work(i_tr,1)+cnextra
 
       do 11 k=2,depth-1           ! loop through water column
 
-        area_1 =(area(k+ktop-1) + area(k+ktop)) / 2.
-        area_2 =(area(k+ktop)  + area(k+ktop+1)) / 2.
+        area_1 =(area_l(k-1) + area_l(k)) / 2.
+        area_2 =(area_l(k)  + area_l(k+1)) / 2.
 
-        cnextra = 0.5 *1./area(k+ktop)*                     &
-                 (((de(k)/zhalf(k))*(dt/z(k))*         &
-                 (tr_work(k+1)-tr_work(k)))*area_2 -   &
-                 ((de(k-1)/zhalf(k-1))*(dt/z(k))*      &
-                 (tr_work(k)-tr_work(k-1)))*area_1)
+        cnextra = 0.5 *1./area_l(k)*                     &
+                 (((de(k)/zhalf(k))*(dtstep/z(k))*         &
+                 (tr_work(i_tr,k+1)-tr_work(i_tr,k)))*area_2 -   &
+                 ((de(k-1)/zhalf(k-1))*(dtstep/z(k))*      &
+                 (tr_work(i_tr,k)-tr_work(i_tr,k-1)))*area_1)
 
-        d(k) = tr_work(k)+cnextra
+        d(i_tr,k) = tr_work(i_tr,k)+cnextra
 
  11   continue
 
        k = depth  !  bottom slice
-       area_1 =(area(k+ktop-1) + area(k+ktop)) / 2.
-
-       cnextra = 0.5 * area_1/area(k+ktop) *   & ! for k = depth
-       ((de(k-1)/zhalf(k-1))*(dt/z(k))*(tr_work(k)-tr_work(k-1)))
-
-       d(k) = tr_work(k)+cnextra
-
-!-----------------------------------------------------------------------
-!   3. calculate arrays for tridiagonal matrix, top and bot slice seperate
-!------------------------------------------------------------------------
+       area_1 =(area_l(k-1) + area_l(k)) / 2.
 
-      k = 1  ! top slice
-      area_2 =(area(k+ktop) + area(k+ktop+1)) / 2.
+       cnextra = 0.5 * area_1/area_l(k) *   & ! for k = depth
+       ((de(k-1)/zhalf(k-1))*(dtstep/z(k))*(tr_work(i_tr,k)-tr_work(i_tr,k-1)))
 
-      b(1) = -0.5 * (de(1)/zhalf(1)) *   &
-              (dt/z(1)) * area_2/area(k+ktop)
-      a(1) = 1. - b(1)  ! no factor of 0.5 here, already done
+       d(i_tr,k) = tr_work(i_tr,k)+cnextra
 
-      do 13 k = 2,depth-1  ! all but top and bottom slices
-
-         area_1 =(area(k+ktop-1) + area(k+ktop)) / 2.
-         area_2 =(area(k+ktop) + area(k+ktop+1)) / 2.
-
-         b(k) = -0.5 * (de(k)/zhalf(k)) *   &
-              (dt/z(k))*area_2/area(k+ktop)
-         c(k) = -0.5 * (de(k-1)/zhalf(k-1)) *  &
-              (dt/z(k))*area_1/area(k+ktop)
-         a(k) = 1. - b(k) - c(k) ! no 0.5 here, already done
-
- 13   continue
-
-      k=depth  ! bottom slice
-      area_1 =(area(k+ktop-1) + area(k+ktop)) / 2.
-
-      c(depth) = -0.5 * (de(depth)/zhalf(depth)) *   &
-              (dt/z(depth)) * area_1/area(k+ktop)
-      a(depth) = 1. - c(depth)
+ 1    continue    ! go back and do the next tracer
 
 !-------------------------------------------------------------
-!    4. call matrix solution, and reset temp and density arrays
+!    3. solve for all tracers with the factors from temp_profile
+!       and reset the tracer arrays
 !-------------------------------------------------------------
 
-      call tridiag_solve(1,1,depth,c,a,b,d,tnew)
+      call tridiag_subst (num_tra, n_trace, depth, dif_sub, dif_alpha, &
+                          dif_gamma, d, tnew)
 
-      do 40 k = 1, depth  ! change temps and densities
-          tr_work(k) = tnew(k)
-        if (iwater.eq.1) trace(k,i_tr) = tr_work(k) ! open water calc
-        if (iwater.eq.0) trace_i(k,i_tr) = tr_work(k) ! ice calc
+      do 40 k = 1, depth  ! change tracers
+        do i_tr = 1, num_tra
+          if (iwater.eq.1) trace(k,i_tr) = tnew(i_tr,k) ! open water calc
+          if (iwater.eq.0) trace_i(k,i_tr) = tnew(i_tr,k) ! ice calc
+        enddo
  40   continue
 
-
-!-------------------------------------------------------------
- 1    continue    ! go back and do the next tracer
-
       return
-     end
+      end
 
 !~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-!                    TRIDIAG_SOLVE
-!     to compute the solution of many tridiagonal linear systems.
-!     used to solve system of equations for eddy diffusion
+!                    TRIDIAG_FACTOR
+!     lu decomposition of a tridiagonal matrix, used with
+!     tridiag_subst to solve the eddy diffusion equations for
+!     temperature and all tracers with one decomposition
 !~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-      subroutine tridiag_solve (ns, nd, ne, a, b, c, y, x)
-
-!      ns ..... the number of systems to be solved.
-!      nd ..... first dimension of arrays (ge ns).
-!      ne ..... the number of unknowns in each system.
-!               this must be > 2. second dimension of arrays.
-!      a ...... the subdiagonals of the matrices are stored
-!               in locations a(j,2) through a(j,ne).
-!      b ...... the main diagonals of the matrices are stored
-!               in locations b(j,1) through b(j,ne).
-!      c ...... the super-diagonals of the matrices are stored in
-!               locations c(j,1) through c(j,ne-1).
-!      y ...... the right hand side of the equations is stored in
-!               y(j,1) through y(j,ne).
-!      x ...... the solutions of the systems are returned in
-!               locations x(j,1) through x(j,ne).
-!      alpha .. work array dimensioned alpha(nd,ne)
-!      gamma .. work array dimensioned gamma(nd,ne)
+      subroutine tridiag_factor (ne, a, b, c, alpha, gamma)
+
+!      ne ..... the number of unknowns. this must be > 2.
+!      a ...... the subdiagonal of the matrix is stored
+!               in locations a(2) through a(ne).
+!      b ...... the main diagonal of the matrix is stored
+!               in locations b(1) through b(ne).
+!      c ...... the super-diagonal of the matrix is stored in
+!               locations c(1) through c(ne-1).
+!      alpha .. reciprocal pivots in alpha(1) through alpha(ne-1),
+!               the last pivot itself in alpha(ne)
+!      gamma .. super-diagonal of the upper factor, gamma(1)
+!               through gamma(ne-1)
 !      history: based on a streamlined version of the old ncar
 !               ulib subr trdi used in the phoenix climate
 !               model of schneider and thompson (j.g.r., 1981).
@@ -2082,41 +2312,61 @@
 !     last revision date:      4 february 1988
 
       implicit none
-      integer ns,ne,nd,nm1,j,i,ib
-      real a(nd,ne), b(nd,ne), c(nd,ne), y(nd,ne),  &
-           x(nd,ne), alpha(nd,ne), gamma(nd,ne)
+      integer ne,nm1,i
+      real a(ne), b(ne), c(ne), alpha(ne), gamma(ne)
 
       nm1 = ne-1
 
-!        obtain the lu decompositions.
-
-      do j=1,ns
-         alpha(j,1) = 1./b(j,1)
-         gamma(j,1) = c(j,1)*alpha(j,1)
-      enddo
+      alpha(1) = 1./b(1)
+      gamma(1) = c(1)*alpha(1)
       do i=2,nm1
-         do j=1,ns
-            alpha(j,i) = 1./(b(j,i)-a(j,i)*gamma(j,i-1))
-            gamma(j,i) = c(j,i)*alpha(j,i)
-         enddo
+         alpha(i) = 1./(b(i)-a(i)*gamma(i-1))
+         gamma(i) = c(i)*alpha(i)
       enddo
+      alpha(ne) = b(ne)-a(ne)*gamma(nm1)
+
+      return
+      end
+
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+!                    TRIDIAG_SUBST
+!     solutions of a tridiagonal system factored by tridiag_factor
+!     for several right hand sides
+!~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+      subroutine tridiag_subst (ns, nd, ne, a, alpha, gamma, y, x)
+
+!      ns ..... the number of right hand sides.
+!      nd ..... first dimension of y and x (ge ns).
+!      ne ..... the number of unknowns in each system.
+!      a ...... the subdiagonal, as given to tridiag_factor.
+!      alpha, gamma .. the factors from tridiag_factor.
+!      y ...... the right hand sides of the equations are stored in
+!               y(j,1) through y(j,ne).
+!      x ...... the solutions are returned in
+!               locations x(j,1) through x(j,ne).
+
+      implicit none
+      integer ns,ne,nd,nm1,j,i,ib
+      real a(ne), alpha(ne), gamma(ne), y(nd,ne), x(nd,ne)
+
+      nm1 = ne-1
 
       do j=1,ns
-         x(j,1) = y(j,1)*alpha(j,1)
+         x(j,1) = y(j,1)*alpha(1)
       enddo
       do i=2,nm1
          do j=1,ns
-            x(j,i) = (y(j,i)-a(j,i)*x(j,i-1))*alpha(j,i)
+            x(j,i) = (y(j,i)-a(i)*x(j,i-1))*alpha(i)
          enddo
       enddo
       do j=1,ns
-         x(j,ne) = (y(j,ne)-a(j,ne)*x(j,nm1))/   &
-                   (b(j,ne)-a(j,ne)*gamma(j,nm1))
+         x(j,ne) = (y(j,ne)-a(ne)*x(j,nm1))/alpha(ne)
       enddo
       do i=1,nm1
          ib = ne-i
          do j=1,ns
-            x(j,ib) = x(j,ib)-gamma(j,ib)*x(j,ib+1)
+            x(j,ib) = x(j,ib)-gamma(ib)*x(j,ib+1)
          enddo
       enddo
 
@@ -2157,7 +2407,7 @@
 !==============================================================
 
        if (wb_flag) then
-          d_level = (run_len+prec-evap1/1.e3*dt-evap2/1.e3*dt) -  &
+          d_level = (run_len+prec-evap1/1.e3*dtstep-evap2/1.e3*dtstep) -  &
                     snowmelt*rhosnow/rhowat
           d_frac  = d_frac + d_level
           remain = mod(d_frac,dz)          !remainder over whole dzs
@@ -2180,7 +2430,7 @@
 
        if (s_flag) then
           s_surf = trace(1,n_trace) * surf  ! volume of salt (ppt*m)
-          r_salt = run_len*run_s*dt/1.e3    ! volume of runoff salt (ppt*m)
+          r_salt = run_len*run_s*dtstep/1.e3    ! volume of runoff salt (ppt*m)
           s_surf = (s_surf + r_salt)*( 1./(surf + d_level))
           trace(1,n_trace) = s_surf
        endif
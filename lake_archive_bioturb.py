@@ -8,6 +8,9 @@
 
 # ====================================================================
 
+import numpy as np
+
+
 def bioturbation(abu, iso, mxl, numb):
     '''
     function [oriabu,bioabu,oriiso,bioiso] = turbo2(abu,iso,mxl,numb)
@@ -175,6 +178,178 @@ def bioturbation(abu, iso, mxl, numb):
 
     return oriabu, bioabu, oriiso, bioiso
 
+# ====================================================================
+# Streaming bioturbation: arbitrary-length, time-varying abu/iso/mxl
+# series are read block by block and only the active mixed window is
+# held in memory. Completed layers are handed to a sink as they leave
+# the reach of the deepest possible mixed layer.
+# ====================================================================
+
+def read_turbo_csv(filename, chunksize=10000, abu_col='Abundance',
+                   iso_col='Pseudoproxy', mxl_col='MixedLayer'):
+    '''
+    Generator yielding (abu, iso, mxl) blocks from a .csv file with one
+    row per layer, oldest layer first.
+    '''
+    import pandas as pd
+
+    for chunk in pd.read_csv(filename, chunksize=chunksize,
+                             usecols=[abu_col, iso_col, mxl_col]):
+        yield (chunk[abu_col].to_numpy(dtype=float),
+               chunk[iso_col].to_numpy(dtype=float),
+               chunk[mxl_col].to_numpy(dtype=float))
+
+
+def read_turbo_binary(filename, chunksize=10000, dtype='<f8'):
+    '''
+    Generator yielding (abu, iso, mxl) blocks from a raw binary file of
+    consecutive (abu, iso, mxl) records, oldest layer first.
+    '''
+    data = np.memmap(filename, dtype=dtype, mode='r')
+    data = data.reshape(-1, 3)
+    for start in range(0, data.shape[0], chunksize):
+        block = np.array(data[start:start + chunksize], dtype=float)
+        yield block[:, 0], block[:, 1], block[:, 2]
+
+
+def csv_sink(filename):
+    '''
+    Returns a sink for bioturbation_stream that appends completed layers
+    to a .csv file, writing the header with the first block.
+    '''
+    state = {'header': True}
+
+    def sink(oriabu, bioabu, oriiso, bioiso):
+        block = np.column_stack((oriabu, bioabu, oriiso, bioiso))
+        with open(filename, 'w' if state['header'] else 'a') as out:
+            if state['header']:
+                out.write('Original Abundance 1,Original Abundance 2,'
+                          'Bioturbated Abundance 1,Bioturbated Abundance 2,'
+                          'Original 1,Original 2,'
+                          'Bioturbated Carrier 1,Bioturbated Carrier 2\n')
+                state['header'] = False
+            np.savetxt(out, block, delimiter=',')
+
+    return sink
+
+
+def _completed_layers(sedabu, sediso, abu, iso, ncols, numb):
+    '''
+    Summarises finished sediment layers exactly as the tail of
+    bioturbation does: carrier counts and the mean isotope of the first
+    numb carriers of each type.
+    '''
+    oriabu = np.column_stack((abu, ncols - abu))
+    oriiso = np.column_stack((iso, iso))
+    bioabu = np.zeros((len(abu), 2))
+    bioiso = np.zeros((len(abu), 2))
+    for carrier in (1, 2):
+        is_carrier = sedabu == carrier
+        bioabu[:, carrier - 1] = np.sum(is_carrier, axis=1)
+        found = is_carrier & ~np.isnan(sediso)
+        picked = found & (np.cumsum(found, axis=1) <= numb)
+        count = np.sum(picked, axis=1)
+        total = np.sum(np.where(picked, sediso, 0.), axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bioiso[:, carrier - 1] = np.where(count > 0, total / count, np.nan)
+    return oriabu, bioabu, oriiso, bioiso
+
+
+def bioturbation_stream(series, numb, max_mxl, max_abu, sink=None,
+                        block=1000, seed=None):
+    '''
+    Streaming version of bioturbation (TURBO2) for long records with
+    time-varying abundances and mixed layer thicknesses.
+
+    INPUTS:
+    SERIES  = iterable of (abu, iso, mxl) blocks, oldest layer first, e.g.
+              read_turbo_csv or read_turbo_binary
+    NUMB    = number of carriers to be measured
+    MAX_MXL = upper bound on the mixed layer thickness anywhere in the
+              series; sets the size of the active window
+    MAX_ABU = upper bound on the abundance anywhere in the series; sets
+              the number of particles per layer (max_abu + 50, as in
+              bioturbation)
+    SINK    = callable(oriabu, bioabu, oriiso, bioiso) receiving completed
+              layers as they are finished, e.g. csv_sink. If None the
+              outputs are collected and returned like bioturbation.
+    BLOCK   = number of layers buffered before completed ones are emitted
+    SEED    = seed for the random number generator
+
+    OUTPUT: oriabu, bioabu, oriiso, bioiso when SINK is None, otherwise
+            the number of layers passed to the sink.
+    '''
+    rng = np.random.default_rng(seed)
+    max_mxl = int(max_mxl)
+    ncols = int(max_abu + 50)
+    numb = int(numb)
+
+    # The window starts with max_mxl empty layers, as in bioturbation
+    size = max_mxl + int(block)
+    sedabu = np.full((size, ncols), np.nan)
+    sediso = np.full((size, ncols), np.nan)
+    layer_abu = np.zeros(size)
+    layer_iso = np.zeros(size)
+    top = max_mxl  # number of rows in use
+    npad = max_mxl  # empty rows still at the bottom of the window
+
+    collected = []
+    emitted = [0]
+
+    def emit(nrows):
+        # rows [0, nrows) can no longer be reached by any mixed layer
+        start = min(npad, nrows)
+        if nrows > start:
+            out = _completed_layers(sedabu[start:nrows], sediso[start:nrows],
+                                    layer_abu[start:nrows], layer_iso[start:nrows],
+                                    ncols, numb)
+            emitted[0] += nrows - start
+            if sink is None:
+                collected.append(out)
+            else:
+                sink(*out)
+        keep = top - nrows
+        sedabu[:keep] = sedabu[nrows:top]
+        sediso[:keep] = sediso[nrows:top]
+        layer_abu[:keep] = layer_abu[nrows:top]
+        layer_iso[:keep] = layer_iso[nrows:top]
+        return keep, npad - start
+
+    for abu, iso, mxl in series:
+        abu = np.asarray(abu, dtype=float)
+        iso = np.asarray(iso, dtype=float)
+        mxl = np.asarray(mxl, dtype=int)
+        if np.any(mxl > max_mxl) or np.any(mxl < 1):
+            raise ValueError('mixed layer thickness must lie between 1 and max_mxl')
+        if np.any(abu > max_abu):
+            raise ValueError('abundance exceeds max_abu')
+        for i in range(len(abu)):
+            if top == size:
+                top, npad = emit(top - max_mxl + 1)
+            # deposit a new layer of randomly ordered carriers
+            row = np.full(ncols, 2.)
+            row[:int(abu[i])] = 1.
+            sedabu[top] = row[rng.permutation(ncols)]
+            sediso[top] = iso[i]
+            layer_abu[top] = abu[i]
+            layer_iso[top] = iso[i]
+            top += 1
+            # mix the top mxl layers independently in every column
+            m = mxl[i]
+            order = np.argsort(rng.random((m, ncols)), axis=0)
+            sedabu[top - m:top] = np.take_along_axis(sedabu[top - m:top], order, axis=0)
+            sediso[top - m:top] = np.take_along_axis(sediso[top - m:top], order, axis=0)
+
+    # the remaining window is final once the series is exhausted
+    emit(top)
+
+    if sink is not None:
+        return emitted[0]
+    if not collected:
+        empty = np.zeros((0, 2))
+        return empty, empty, empty, empty
+    return tuple(np.concatenate(part) for part in zip(*collected))
+
 # =====================================================================
 # mxltext = str(np.mean(mxl))
 # numbtxt = str(numb)
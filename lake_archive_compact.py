@@ -9,34 +9,77 @@
 
 import numpy as np
 
-def porosity(depth_profile, phi_0=0.95):
-    import numpy as np
+def porosity(depth_profile, phi_0=0.95, num=100, z=None):
+    '''
+    Porosity profile of the sediment column.
+    INPUTS:
+    depth_profile: total depth of core (m), used when z is not given
+    phi_0:         surface porosity
+    num:           number of points of the uniform depth grid
+    z:             optional depth grid (m), e.g. measured sample depths
+    OUTPUT: phi, z
+    '''
     # assuming no excess pore pressure (Pe = 0) and that grain density is constant for quartz:
-    z = np.linspace(0, depth_profile, num=100)  # depth, meters
+    if z is None:
+        z = np.linspace(0, depth_profile, num=num)  # depth, meters
+    else:
+        z = np.asarray(z, dtype=float)
     ps = 2650.  # kg/m^3 (grain density of quartz, valid for most sands/seds)
     pw = 1000.  # kg/m^3
     g = 9.8  # m/s^2 (gravity)
-    phi = np.zeros(len(z))
     # phi_0  # surface porosity, set by user (for reference, shale ~ 0.6, 0.3 to 0.5 for sands, 0.2-0.5 for silts and shales)
     k1 = (1 - phi_0) / phi_0
     c = 3.68E-8
-    for i in range(len(phi)):
-        phi[i] = (np.exp(-c * g * (ps - pw) * z[i])) / (np.exp(-c * g * (ps - pw) * z[i]) + k1)
+    decay = np.exp(-c * g * (ps - pw) * z)
+    phi = decay / (decay + k1)
     return phi, z
 
-def compaction(Sbar, T, phi_0):
+def compaction(Sbar, T, phi_0, num=100, h=None):
+    '''
+    Depth scale of the core with and without compaction.
+    INPUTS:
+    Sbar:  sedimentation rate (cm/kyr)
+    T:     number of years
+    phi_0: surface porosity
+    num:   number of points of the uniform depth grid
+    h:     optional uncompacted depth grid (m), e.g. measured sample depths
+    OUTPUT: z, phi, h, h_prime
+    '''
     S = Sbar / 1000.  # Sedimentation rate, cm/yr   ** USER
     # Without compaction:
     H = S * T  # meters (DEPTH OF CORE)   ** USER
-    h = np.linspace(0, H, num=100)  ## NOTE THAT IF YOU HAVE DEPTH MEASUREMENTS THIS SHOULD BE SPECIFIED HERE
-    ## ALTERNATIVELY, ASSUME UNIFORM SPACING / UNIFORM SED LAYER HEIGHTS
+    if h is None:
+        h = np.linspace(0, H, num=num)  ## ASSUME UNIFORM SPACING / UNIFORM SED LAYER HEIGHTS
+    else:
+        h = np.asarray(h, dtype=float)  ## USER-MEASURED DEPTHS
     depth_profile = H  # total depth of core
     # porosity of sediments (phi_0) at site (typical value for lake seds = 0.99)
-    phi, z = porosity(depth_profile, phi_0)
-    # np.save('phi.npy', phi)
-    # np.save('z.npy',z)
+    phi, z = porosity(depth_profile, phi_0, z=h)
     # Now adjust the compacted sediment depth scale based on porosity
-    h_prime = np.zeros(len(phi))
-    for i in range(len(phi)):
-        h_prime[i] = h[i] * (1.0 - phi_0) / (1.0 - phi[i])
-    return z, phi, h, h_prime
\ No newline at end of file
+    h_prime = h * (1.0 - phi_0) / (1.0 - phi)
+    return z, phi, h, h_prime
+
+def proxy_to_depth(proxy, Sbar, phi_0, depths=None):
+    '''
+    Maps an annual pseudoproxy series onto the compacted depth axis.
+    INPUTS:
+    proxy:  annual pseudoproxy series, oldest year first (as returned by
+            bioturbation); the last value is the core top
+    Sbar:   sedimentation rate (cm/kyr)
+    phi_0:  surface porosity
+    depths: optional compacted depths (m) at which to sample the proxy,
+            e.g. measured sample depths
+    OUTPUT: depth (m, increasing down core) and the proxy at each depth
+    '''
+    proxy = np.asarray(proxy, dtype=float)
+    S = Sbar / 1000.
+    # mid-year age of every layer, counted down from the core top
+    age = np.arange(len(proxy))[::-1] + 0.5
+    h = S * age
+    z, phi, h, h_prime = compaction(Sbar, len(proxy), phi_0, h=h)
+    h_prime = h_prime[::-1]
+    proxy = proxy[::-1]
+    if depths is None:
+        return h_prime, proxy
+    depths = np.asarray(depths, dtype=float)
+    return depths, np.interp(depths, h_prime, proxy, left=np.nan, right=np.nan)
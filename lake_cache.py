@@ -0,0 +1,143 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# Class 'DiskCache'
+# Content-addressed store of model results as compressed .npz files
+#====================================================================
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+DEFAULT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+
+def _feed(digest, value):
+    '''
+    Adds a value to the hash in a form that does not depend on how it was
+    passed in (list or array, int or float of the same value, dict order).
+    '''
+    if isinstance(value, dict):
+        digest.update(b'{')
+        for name in sorted(value):
+            _feed(digest, str(name))
+            _feed(digest, value[name])
+        digest.update(b'}')
+    elif isinstance(value, (list, tuple, np.ndarray)):
+        array = np.asarray(value)
+        if array.dtype.kind in 'biuf':
+            array = np.ascontiguousarray(array, dtype='<f8')
+        else:
+            array = np.asarray([str(v) for v in array.ravel()]).reshape(array.shape)
+            array = np.ascontiguousarray(array.astype('U'))
+        digest.update(('%s%s' % (array.dtype.str, array.shape)).encode())
+        digest.update(array.tobytes())
+    elif isinstance(value, (bool, np.bool_)) or value is None:
+        digest.update(repr(value).encode())
+    elif isinstance(value, (int, float, np.integer, np.floating)):
+        digest.update(repr(float(value)).encode())
+    else:
+        digest.update(('%s:%s' % (type(value).__name__, value)).encode())
+    digest.update(b';')
+
+
+def make_key(*parts, **named):
+    '''
+    sha256 of the inputs of a computation. Arrays are hashed by content.
+    '''
+    digest = hashlib.sha256()
+    for part in parts:
+        _feed(digest, part)
+    _feed(digest, named)
+    return digest.hexdigest()
+
+
+class DiskCache:
+    '''
+    Directory of compressed .npz results named by key. The least recently
+    used entries are removed once the directory grows beyond max_bytes.
+    INPUTS:
+    root:      cache directory (created if missing)
+    max_bytes: size limit of the directory
+    '''
+
+    def __init__(self, root=DEFAULT_ROOT, max_bytes=500 * 2**20):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.npz')
+
+    def get(self, key):
+        '''
+        Returns the stored arrays as a dict, or None on a miss.
+        '''
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                result = {name: data[name] for name in data.files}
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            # missing, evicted by another process or truncated
+            return None
+        if '__meta__' in result:
+            result['__meta__'] = json.loads(str(result['__meta__']))
+        return result
+
+    def put(self, key, meta=None, **arrays):
+        '''
+        Stores arrays (and an optional JSON-serialisable meta dict) under key.
+        '''
+        if meta is not None:
+            arrays['__meta__'] = np.asarray(json.dumps(meta))
+        handle, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                np.savez_compressed(file, **arrays)
+            os.replace(tmp, self.path(key))  # atomic, so readers never see half a file
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict()
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def entries(self):
+        '''
+        (mtime, size, path) of every entry, oldest first.
+        '''
+        found = []
+        for name in os.listdir(self.root):
+            if name.endswith('.npz'):
+                path = os.path.join(self.root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, stat.st_size, path))
+        return sorted(found)
+
+    def size(self):
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            os.remove(path)
@@ -0,0 +1,227 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# ENVIRONMENT MODEL: Calibration of the lake parameters against observations
+# Function 'calibrate'
+# Nelder-Mead searches with restarts from several starting points. The
+# searches advance side by side and every step evaluates the candidate
+# points of all of them at once in a process pool; runs are cached by
+# their inputs, so repeated points are never run twice
+#====================================================================
+
+import os
+
+import numpy as np
+
+import lake_run
+from lake_cache import make_key
+from lake_emulator import read_forcing
+from lake_sensitivity import INTEGER_PARAMETERS, evaluate, parameter_ranges, scale_design
+
+# Nelder-Mead coefficients of reflection, expansion, contraction and shrink
+REFLECT, EXPAND, CONTRACT, SHRINK = 1., 2., 0.5, 0.5
+
+
+def read_observations(observations):
+    '''
+    Observed series as days (counted as in the day column of the forcing,
+    i.e. in years of 360 days from the first forcing year) and values.
+    INPUTS:
+    observations: path of a text file with the columns day and value (e.g.
+                  lake surface temperature in deg C), or an array of them
+    OUTPUT: days, values
+    '''
+    if isinstance(observations, str):
+        data = np.loadtxt(observations, ndmin=2)
+    else:
+        data = np.atleast_2d(np.asarray(observations, dtype=float))
+    data = data[~np.isnan(data[:, :2]).any(axis=1)]
+    return data[:, 0], data[:, 1]
+
+
+class Misfit:
+    '''
+    Root mean square difference between a modelled target ('tsurf' or
+    'mixing') and an observed series, as an output of
+    lake_sensitivity.evaluate. The model is interpolated linearly between
+    forcing records to the observed days; observations outside the run
+    are left out.
+    '''
+
+    def __init__(self, observations, target='tsurf'):
+        if target not in ('tsurf', 'mixing'):
+            raise ValueError("target must be 'tsurf' or 'mixing'")
+        self.day, self.value = read_observations(observations)
+        self.target = target
+        self.key = make_key('Misfit', target, self.day, self.value)[:16]
+
+    def __str__(self):
+        return 'Misfit(%s, %s)' % (self.target, self.key)
+
+    def __call__(self, day, tsurf, mixing):
+        modelled = tsurf if self.target == 'tsurf' else mixing
+        inside = (self.day >= day[0]) & (self.day <= day[-1])
+        if not inside.any():
+            return np.nan
+        error = np.interp(self.day[inside], day, modelled) - self.value[inside]
+        return np.sqrt(np.mean(error ** 2))
+
+
+def _simplex(x, step):
+    '''
+    Starting simplex in the unit cube around x: x and one point step away
+    along each axis (towards the inside where x is near a bound).
+    '''
+    points = [x]
+    for j in range(len(x)):
+        point = x.copy()
+        point[j] += step if x[j] + step <= 1. else -step
+        points.append(point)
+    return np.array(points)
+
+
+def calibrate(observations, forcing, lake='Malawi', names=None, ranges=None, initial=None,
+              target='tsurf', starts=None, restarts=2, max_runs=200, step=0.15, xtol=1e-3, ftol=1e-3,
+              seed=None, **options):
+    '''
+    Parameter values that minimize the misfit of the model to observations.
+    Each search is a Nelder-Mead simplex in the unit cube of the parameter
+    ranges (points outside are moved onto the bounds). At every step the
+    reflected, expanded and both contracted points of all searches are run
+    together, one per worker, so a step takes the time of one run when
+    there are 4 * starts workers (the default number of starts);
+    a search that converges restarts around its best point, which guards
+    against a collapsed simplex.
+    INPUTS:
+    observations: observed series, see read_observations
+    forcing, lake: forcing file and include template of the runs
+    names:     parameters to fit (all of lake_sensitivity.DEFAULT_RANGES
+               by default)
+    ranges:    dict of name -> (low, high), added to DEFAULT_RANGES
+    initial:   dict of starting values of the first search (by default
+               those of parameters in options, else the include file's);
+               the other searches start at random points
+    target:    'tsurf' or 'mixing' (depth in m), the modelled series to
+               compare
+    starts:    simultaneous searches (a quarter of the workers by default)
+    restarts:  restarts of each search after it converges
+    max_runs:  distinct parameter sets to run (the last step may pass it)
+    step:      size of a starting simplex, as a fraction of the ranges
+    xtol, ftol: a search has converged when its simplex is smaller than
+               xtol (fraction of the ranges) or its misfits differ by
+               less than ftol
+    seed:      seed of the random starting points
+    options:   parameters, cache, workers, batch, keep and run options,
+               see lake_sensitivity.evaluate; by default the points of a
+               step are split evenly over the workers
+    OUTPUT: dict with the best 'parameters' and their 'misfit', 'runs',
+            'iterations', the best point of every search in 'searches',
+            and every parameter set run and its misfit in 'values' and
+            'misfits'
+    '''
+    names, ranges = parameter_ranges(names, ranges)
+    k = len(names)
+    objective = Misfit(observations, target)
+    day = read_forcing(forcing)[:, 1]
+    if not ((objective.day >= day[0]) & (objective.day <= day[-1])).any():
+        raise ValueError("no observations between days %g and %g of the forcing" % (day[0], day[-1]))
+    low = np.array([ranges[name][0] for name in names], dtype=float)
+    high = np.array([ranges[name][1] for name in names], dtype=float)
+    include = options.get('include') or os.path.join(lake_run.ROOT, lake_run.TEMPLATES[lake])
+    with open(include) as file:
+        start = lake_run.include_values(file.read(), names)
+    start.update((name, value) for name, value in (options.get('parameters') or {}).items() if name in start)
+    start.update(initial or {})
+    x0 = np.clip((np.array([float(start[name]) for name in names]) - low) / (high - low), 0., 1.)
+    workers = options.get('workers') or os.cpu_count() or 1
+    if starts is None:
+        starts = max(1, workers // 4)
+    rng = np.random.default_rng(seed)
+
+    # every distinct parameter set runs once; repeats are looked up here
+    # (and across calibrations in the cache given in options)
+    seen = {}
+    tried, misfits = [], []
+
+    def run(points):
+        values = scale_design(np.clip(points, 0., 1.), names, ranges)
+        unique = {row.tobytes(): row for row in values if row.tobytes() not in seen}
+        if unique:
+            rows = np.array(list(unique.values()))
+            # spread the points over all workers rather than in batches of 4
+            batch = options.get('batch') or -(-len(rows) // workers)
+            found = evaluate(rows, names, forcing, lake, outputs=[objective],
+                             **dict(options, batch=batch))[:, 0]
+            for row, value in zip(rows, found):
+                seen[row.tobytes()] = np.inf if np.isnan(value) else value
+                tried.append(row)
+                misfits.append(value)
+        return np.array([seen[row.tobytes()] for row in values])
+
+    searches = []
+    for s in range(starts):
+        simplex = _simplex(x0 if s == 0 else rng.random(k), step)
+        searches.append({'simplex': np.clip(simplex, 0., 1.), 'restarts': 0, 'active': True})
+    initial_misfits = run(np.concatenate([search['simplex'] for search in searches]))
+    for s, search in enumerate(searches):
+        search['misfit'] = initial_misfits[s * (k + 1):(s + 1) * (k + 1)]
+
+    iterations = 0
+    while len(seen) < max_runs and any(search['active'] for search in searches):
+        iterations += 1
+        active = [search for search in searches if search['active']]
+        candidates = []
+        for search in active:
+            order = np.argsort(search['misfit'])
+            search['simplex'], search['misfit'] = search['simplex'][order], search['misfit'][order]
+            centroid = search['simplex'][:-1].mean(axis=0)
+            away = centroid - search['simplex'][-1]
+            candidates.append(np.clip([centroid + REFLECT * away, centroid + EXPAND * away,
+                                       centroid + CONTRACT * away, centroid - CONTRACT * away], 0., 1.))
+        found = run(np.concatenate(candidates)).reshape(len(active), 4)
+
+        shrinking = []
+        for search, points, (fr, fe, fo, fi) in zip(active, candidates, found):
+            simplex, misfit = search['simplex'], search['misfit']
+            if fr < misfit[0]:
+                accept = (points[1], fe) if fe < fr else (points[0], fr)
+            elif fr < misfit[-2]:
+                accept = (points[0], fr)
+            elif fr < misfit[-1]:
+                accept = (points[2], fo) if fo <= fr else None
+            else:
+                accept = (points[3], fi) if fi < misfit[-1] else None
+            if accept is None:
+                simplex[1:] = simplex[0] + SHRINK * (simplex[1:] - simplex[0])
+                shrinking.append(search)
+            else:
+                simplex[-1], misfit[-1] = accept
+        if shrinking:
+            found = run(np.concatenate([search['simplex'][1:] for search in shrinking])).reshape(len(shrinking), k)
+            for search, values in zip(shrinking, found):
+                search['misfit'][1:] = values
+
+        restarting = []
+        for search in active:
+            simplex, misfit = search['simplex'], search['misfit']
+            best = np.argmin(misfit)
+            size = np.max(np.abs(simplex - simplex[best]))
+            if size < xtol or (np.all(np.isfinite(misfit)) and np.ptp(misfit) < ftol):
+                if search['restarts'] < restarts:
+                    search['restarts'] += 1
+                    search['simplex'] = np.clip(_simplex(simplex[best], step), 0., 1.)
+                    restarting.append(search)
+                else:
+                    search['active'] = False
+        if restarting:
+            found = run(np.concatenate([search['simplex'] for search in restarting]))
+            for s, search in enumerate(restarting):
+                search['misfit'] = found[s * (k + 1):(s + 1) * (k + 1)]
+
+    values = scale_design(np.array([search['simplex'][np.argmin(search['misfit'])] for search in searches]),
+                          names, ranges)
+    best = [float(np.min(search['misfit'])) for search in searches]
+    parameters = {name: int(value) if name in INTEGER_PARAMETERS else float(value)
+                  for name, value in zip(names, values[int(np.argmin(best))])}
+    return {'parameters': parameters, 'misfit': min(best), 'runs': len(seen), 'iterations': iterations,
+            'searches': [dict(zip(names, row), misfit=misfit) for row, misfit in zip(values.tolist(), best)],
+            'values': np.array(tried).reshape(-1, k), 'misfits': np.array(misfits)}
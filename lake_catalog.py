@@ -0,0 +1,246 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# ENVIRONMENT MODEL: Catalog of lakes and multi-site runs
+# Class 'LakeCatalog', Function 'run_sites'
+# Per-site include template, parameter set and forcing files, read from a
+# JSON catalog (lakes.json), and a runner that runs any number of sites
+# side by side on all cores and combines their outputs in one table
+#====================================================================
+
+import json
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import lake_run
+from lake_cache import make_key
+from lake_emulator import read_forcing
+
+CATALOG = os.path.join(lake_run.ROOT, 'lakes.json')
+# Columns of the surf output, by the isotope flags (o18flag, deutflag)
+SURF_COLUMNS = {
+    (True, True): ['day', 'tsurf', 'fice', 'evap', 'mixing', 'hice', 'hsnow', 'd18O', 'dD', 'runout', 'mixmax',
+                   'depth', 'd_frac'],
+    (True, False): ['day', 'tsurf', 'evap', 'mixing', 'd18O', 'runout', 'mixmax', 'depth', 'd_frac'],
+    (False, True): ['day', 'tsurf', 'evap', 'mixing', 'dD', 'runout', 'mixmax', 'depth', 'd_frac'],
+    (False, False): ['day', 'tsurf', 'mixing', 'evap', 'qe', 'qh', 'sw', 'lw', 'mixmax', 'depth'],
+}
+# Column of the number of layers in the surf output, by its number of columns
+DEPTH_COLUMN = {13: 11, 9: 7, 10: 9}
+
+
+class LakeCatalog:
+    '''
+    Sites of lake model runs. Each site has
+    template:   include file the parameters are applied to
+    forcings:   dict of forcing name -> forcing file (the first is the default)
+    parameters: dict of parameter values (see lake_run.PARAMETER_NAMES)
+    start_year: calendar year of the first forcing year
+    grid:       optional layer thicknesses or grid file (see lake_run.write_grid)
+    Relative paths are relative to the catalog file.
+    '''
+
+    def __init__(self, sites=None, root=lake_run.ROOT):
+        self.sites = dict(sites or {})
+        self.root = root
+
+    @classmethod
+    def load(cls, path=CATALOG):
+        with open(path) as file:
+            return cls(json.load(file), os.path.dirname(os.path.abspath(path)))
+
+    def save(self, path=CATALOG):
+        with open(path, 'w') as file:
+            json.dump(self.sites, file, indent=1)
+            file.write('\n')
+
+    def names(self):
+        return list(self.sites)
+
+    def add(self, name, template, forcings, parameters=None, start_year=1, grid=None):
+        '''
+        Adds (or replaces) a site; forcings may be a single file.
+        '''
+        if isinstance(forcings, str):
+            forcings = {'default': forcings}
+        self.sites[name] = {'template': template, 'start_year': int(start_year), 'forcings': dict(forcings),
+                            'parameters': dict(parameters or {})}
+        if grid is not None:
+            self.sites[name]['grid'] = grid
+        return self.sites[name]
+
+    def _path(self, path):
+        return path if os.path.isabs(path) else os.path.join(self.root, path)
+
+    def site(self, name, forcing=None):
+        '''
+        Settings of a run of a site, with absolute paths.
+        INPUTS:
+        forcing: name of one of the site's forcings, or a forcing file
+        OUTPUT: dict with name, include, forcing, parameters, start_year
+                and grid
+        '''
+        if name not in self.sites:
+            raise KeyError("lake %s is not in the catalog" % name)
+        site = self.sites[name]
+        forcings = site['forcings']
+        if forcing is None:
+            forcing = forcings[next(iter(forcings))]
+        elif forcing in forcings:
+            forcing = forcings[forcing]
+        grid = site.get('grid')
+        return {'name': name, 'include': self._path(site['template']), 'forcing': self._path(forcing),
+                'parameters': dict(site.get('parameters', {})), 'start_year': site.get('start_year', 1),
+                'grid': self._path(grid) if isinstance(grid, str) else grid}
+
+    def form_values(self, name):
+        '''
+        Parameters of a site as the values of the GUI form: one per
+        lake_run.PARAMETER_NAMES (1/0 for the flags, '' where the site
+        keeps the template's value) and the start year.
+        '''
+        parameters = self.sites[name].get('parameters', {})
+        values = []
+        for parameter in lake_run.PARAMETER_NAMES:
+            value = parameters.get(parameter, '')
+            values.append(int(value) if isinstance(value, bool) else str(value))
+        values.append(str(self.sites[name].get('start_year', '')))
+        return values
+
+
+def read_profiles(path, layers):
+    '''
+    Temperature profiles of a Tprof output, where a record longer than 58
+    values continues on the next lines.
+    INPUTS:
+    path:   Tprof output
+    layers: number of layers of every record (the depth column of the
+            surf output of the same run)
+    OUTPUT: array (records, 1 + most layers): the day, then the layers from
+            the surface (NaN below the bottom of a shallower record)
+    '''
+    with open(path) as file:
+        values = np.array(file.read().split(), dtype=float)
+    layers = np.asarray(layers, dtype=int)
+    ends = np.cumsum(layers + 1)
+    if len(ends) == 0 or ends[-1] != len(values):
+        raise ValueError("%s has %d values for %d records" % (path, len(values), len(layers)))
+    profiles = np.full((len(layers), layers.max() + 1), np.nan)
+    for k, (end, count) in enumerate(zip(ends, layers)):
+        profiles[k, :count + 1] = values[end - count - 1:end]
+    return profiles
+
+
+def surf_frame(rows, include_text, forcing, start_year=1):
+    '''
+    The forcing records of a surf output (the rows after spin-up) as a
+    table with named columns and the calendar year of every record.
+    '''
+    flags = lake_run.include_values(include_text, ['o18flag', 'deutflag'])
+    data = read_forcing(forcing)
+    frame = pd.DataFrame(rows[-len(data):], columns=SURF_COLUMNS[flags['o18flag'], flags['deutflag']])
+    frame.insert(0, 'year', data[:, 0].astype(int) + start_year - 1)
+    return frame
+
+
+def _run_site(args):
+    '''
+    Runs one site. OUTPUT: name, surf rows, Tprof rows, rendered include,
+    error message (None if the run succeeded)
+    '''
+    site, run_options, keep = args
+    run = None
+    try:
+        run = lake_run.run_model(site['forcing'], parameters=site['parameters'], include=site['include'],
+                                 grid=site['grid'], **run_options)
+        with open(os.path.join(run['directory'], 'lake.inc')) as file:
+            include_text = file.read()
+        surf = np.loadtxt(run['surf'], ndmin=2)
+        profiles = read_profiles(run['tprof'], surf[:, DEPTH_COLUMN[surf.shape[1]]])
+        return site['name'], surf, profiles, include_text, None
+    except (RuntimeError, ValueError, OSError, subprocess.SubprocessError) as err:
+        return site['name'], None, None, None, str(err)
+    finally:
+        if run is not None and not keep:
+            shutil.rmtree(run['directory'], ignore_errors=True)
+
+
+def site_key(site, run_options):
+    '''
+    Cache key of a site run: model source, include template, forcing,
+    parameters, grid and run options.
+    '''
+    with open(os.path.join(lake_run.ROOT, run_options.get('source', lake_run.SOURCE))) as file:
+        source = file.read()
+    with open(site['include']) as file:
+        include = file.read()
+    return make_key('lake_catalog', source, include, read_forcing(site['forcing']), site['parameters'],
+                    site['grid'], **run_options)
+
+
+def run_sites(catalog=None, names=None, forcing=None, parameters=None, workers=None, cache=None, keep=False,
+              **run_options):
+    '''
+    Runs several sites of a catalog at the same time, one per core.
+    INPUTS:
+    catalog:    LakeCatalog (lakes.json by default)
+    names:      sites to run (all by default)
+    forcing:    forcing name (e.g. 'climatology') used where a site has it;
+                the other sites use their default forcing
+    parameters: dict of parameters set for every site, over the site's own
+    workers:    worker processes (all cores by default)
+    cache:      lake_cache.DiskCache of earlier site runs (None to run all)
+    keep:       keep the run directories
+    run_options: fflags, timeout... passed to lake_run.run_model
+    OUTPUT: dict with
+            'surf':     table of the surf outputs after spin-up of all sites,
+                        indexed by lake and record (see surf_frame)
+            'profiles': dict of lake -> temperature profiles (one row per
+                        record, first column the day)
+            'failed':   dict of lake -> error message of the runs that failed
+    '''
+    catalog = catalog or LakeCatalog.load()
+    names = list(names or catalog.names())
+    sites = []
+    for name in names:
+        chosen = forcing if forcing in catalog.sites.get(name, {}).get('forcings', {}) else None
+        site = catalog.site(name, chosen)
+        site['parameters'].update(parameters or {})
+        sites.append(site)
+
+    results = {}
+    keys = {site['name']: site_key(site, run_options) for site in sites} if cache else {}
+    todo = []
+    for site in sites:
+        stored = cache.get(keys[site['name']]) if cache else None
+        if stored is not None:
+            results[site['name']] = (site['name'], stored['surf'], stored['tprof'], str(stored['include']), None)
+        else:
+            todo.append(site)
+    jobs = [(site, run_options, keep) for site in todo]
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for result in (pool.map(_run_site, jobs) if pool else map(_run_site, jobs)):
+            results[result[0]] = result
+            if cache and result[4] is None:
+                cache.put(keys[result[0]], surf=result[1], tprof=result[2], include=np.asarray(result[3]),
+                          meta={'lake': result[0]})
+    finally:
+        if pool:
+            pool.shutdown()
+
+    frames, profiles, failed = {}, {}, {}
+    for site in sites:
+        name, surf, tprof, include_text, error = results[site['name']]
+        if error is not None:
+            failed[name] = error
+            continue
+        frames[name] = surf_frame(surf, include_text, site['forcing'], site['start_year'])
+        profiles[name] = tprof[-len(frames[name]):]
+    surf = pd.concat(frames, names=['lake', 'record']) if frames else pd.DataFrame()
+    return {'surf': surf, 'profiles': profiles, 'failed': failed}
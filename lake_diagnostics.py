@@ -0,0 +1,220 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# Class 'Recorder'
+# Wall time, CPU time, peak memory and item counts of the pipeline stages
+#====================================================================
+
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Spans the model process writes for the GUI to merge (see Recorder.merge)
+MODEL_SPANS = 'lake_stages.json'
+# Totals written by the Fortran model when built with timing_flag = .true.
+MODEL_TIMING = 'lake_timing.txt'
+
+
+def peak_rss(children=False):
+    '''
+    High-water mark of the resident set size in bytes (of this process, or
+    of its finished child processes), or None where it is not available.
+    '''
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def cpu_time(children=False):
+    '''
+    User + system CPU seconds of this process, or of its finished children.
+    '''
+    if not children:
+        return time.process_time()
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Span:
+    '''
+    One timed stage. Set items (e.g. the number of values processed) while
+    the span is open; stop() fills in wall, cpu and rss.
+    '''
+
+    def __init__(self, recorder, name, items=None, children=False, **meta):
+        self.recorder = recorder
+        self.name = name
+        self.items = items
+        self.children = children
+        self.meta = meta
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+        self.depth = recorder._depth()
+        self.start = time.time()
+        self.wall = self.cpu = self.rss = None
+        self.error = None
+        self._rss = peak_rss(children)
+        self._cpu = cpu_time(children)
+        self._clock = time.perf_counter()
+
+    def stop(self, error=None):
+        if self.wall is not None:
+            return self
+        self.wall = time.perf_counter() - self._clock
+        cpu = cpu_time(self.children)
+        self.cpu = cpu - self._cpu if cpu is not None and self._cpu is not None else None
+        rss = peak_rss(self.children)
+        # growth of the peak, i.e. how much higher this stage pushed memory
+        self.rss = rss - self._rss if rss is not None and self._rss is not None else None
+        self.error = error
+        self.recorder._close(self)
+        return self
+
+    def as_dict(self):
+        return {'name': self.name, 'start': self.start, 'wall': self.wall, 'cpu': self.cpu,
+                'rss': self.rss, 'items': self.items, 'pid': self.pid, 'tid': self.tid,
+                'depth': self.depth, 'error': self.error, 'meta': self.meta}
+
+
+class Recorder:
+    '''
+    Collects finished spans (the most recent max_spans are kept) and exports
+    them as JSON or in the Chrome trace event format (chrome://tracing,
+    Perfetto).
+    '''
+
+    def __init__(self, max_spans=10000):
+        self.spans = collections.deque(maxlen=max_spans)
+        self._open = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._open, 'stack'):
+            self._open.stack = []
+        return self._open.stack
+
+    def _depth(self):
+        return len(self._stack())
+
+    def _close(self, span):
+        stack = self._stack()
+        if span in stack:
+            stack.remove(span)
+        self.spans.append(span.as_dict())
+
+    def start(self, name, items=None, children=False, **meta):
+        '''
+        Opens a span that is closed later with its stop() method, for stages
+        that end in a callback. children=True measures CPU and memory of
+        child processes that finish while the span is open.
+        '''
+        span = Span(self, name, items, children, **meta)
+        self._stack().append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, items=None, children=False, **meta):
+        '''
+        with recorder.span('bioturbation', items=len(iso)) as s: ...
+        '''
+        span = self.start(name, items, children, **meta)
+        try:
+            yield span
+        except BaseException as err:
+            span.stop(error=repr(err))
+            raise
+        span.stop()
+
+    def clear(self):
+        self.spans.clear()
+
+    def summary(self):
+        '''
+        Totals per stage, in order of first appearance: calls, wall, cpu,
+        largest rss growth and items.
+        '''
+        totals = collections.OrderedDict()
+        for span in self.spans:
+            total = totals.setdefault(span['name'], {'name': span['name'], 'calls': 0, 'wall': 0.,
+                                                     'cpu': 0., 'rss': 0, 'items': 0, 'errors': 0})
+            total['calls'] += 1
+            total['wall'] += span['wall']
+            total['cpu'] += span['cpu'] or 0.
+            total['rss'] = max(total['rss'], span['rss'] or 0)
+            total['items'] += span['items'] or 0
+            total['errors'] += span['error'] is not None
+        return list(totals.values())
+
+    def save(self, path):
+        '''
+        All spans and the per-stage summary as JSON.
+        '''
+        with open(path, 'w') as file:
+            json.dump({'spans': list(self.spans), 'summary': self.summary()}, file, indent=1)
+
+    def merge(self, path, remove=True):
+        '''
+        Adds the spans saved by another process (e.g. the model process) and,
+        by default, deletes the file so they are only merged once.
+        OUTPUT: number of spans added
+        '''
+        if not os.path.exists(path):
+            return 0
+        with open(path) as file:
+            spans = json.load(file)['spans']
+        self.spans.extend(spans)
+        if remove:
+            os.remove(path)
+        return len(spans)
+
+    def chrome_trace(self):
+        '''
+        Spans as complete ('X') trace events, in microseconds.
+        '''
+        events = []
+        for span in self.spans:
+            args = {'cpu_s': span['cpu'], 'rss_bytes': span['rss'], 'items': span['items']}
+            args.update(span['meta'])
+            if span['error'] is not None:
+                args['error'] = span['error']
+            events.append({'name': span['name'], 'cat': 'stage', 'ph': 'X',
+                           'ts': span['start'] * 1e6, 'dur': span['wall'] * 1e6,
+                           'pid': span['pid'], 'tid': span['tid'], 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.chrome_trace(), file)
+
+
+def read_model_timing(path=MODEL_TIMING):
+    '''
+    Per-subroutine totals written by the Fortran model (timing_flag).
+    OUTPUT: list of (name, calls, seconds); empty if the file is missing
+    '''
+    rows = []
+    if not os.path.exists(path):
+        return rows
+    with open(path) as file:
+        next(file, None)  # header
+        for line in file:
+            parts = line.split()
+            if len(parts) == 3:
+                rows.append((parts[0], int(parts[1]), float(parts[2])))
+    return rows
+
+
+# Recorder shared by the GUI and the model modules
+RECORDER = Recorder()
+span = RECORDER.span
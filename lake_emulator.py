@@ -0,0 +1,278 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# ENVIRONMENT MODEL: Statistical emulator of the lake model
+# Class 'LakeEmulator'
+# Ridge regression of the lake surface temperature and mixing depth of
+# each forcing record on the forcing of that record, its lags and running
+# means, trained on an ensemble of full model runs
+#====================================================================
+
+import json
+import os
+
+import numpy as np
+
+import lake_run
+
+# Columns of the ERA_INTERIM_* forcing files (prec and runin only with wb_flag)
+FORCING_COLUMNS = ['year', 'day', 'ta', 'rh', 'ua', 'sw', 'rlwd', 'ps', 'prec', 'runin']
+# Forcing variables the emulator uses
+VARIABLES = ['ta', 'rh', 'ua', 'sw', 'rlwd', 'ps']
+TARGETS = ['tsurf', 'mixing']
+# Column of the mean mixing depth in the surf output, by its number of
+# columns (the format depends on o18flag and deutflag)
+MIXING_COLUMN = {10: 2, 9: 3, 13: 4}
+# The forcing files count days in years of 12 months of 30 days
+YEAR_DAYS = 360.
+
+
+def read_forcing(forcing):
+    '''
+    Forcing records as an array (one row per record, FORCING_COLUMNS).
+    INPUTS:
+    forcing: path of a forcing text file, or an array already read
+    '''
+    if isinstance(forcing, str):
+        return np.loadtxt(forcing, ndmin=2)
+    return np.atleast_2d(np.asarray(forcing, dtype=float))
+
+
+def read_targets(surf, nrecords, grid=None):
+    '''
+    Surface temperature and mean mixing depth (m) of the last nrecords rows
+    of a surf output, i.e. of the forcing records of the run after spin-up
+    (each row averages the interval ending at one forcing record).
+    INPUTS:
+    grid: layer grid of the run, to convert the mixing depth from layers
+          to m (see lake_run.mixing_metres); None for the uniform grid
+    OUTPUT: array (nrecords, len(TARGETS))
+    '''
+    rows = np.loadtxt(surf, ndmin=2) if isinstance(surf, str) else np.atleast_2d(surf)
+    if len(rows) < nrecords:
+        raise ValueError("surf output has %d rows for %d forcing records" % (len(rows), nrecords))
+    rows = rows[-nrecords:]
+    return np.column_stack((rows[:, 1], lake_run.mixing_metres(rows[:, MIXING_COLUMN[rows.shape[1]]], grid)))
+
+
+def forcing_features(forcing, lags=(1, 2, 3), memory=(6, 24)):
+    '''
+    Regression features of every forcing record: the forcing variables,
+    their values lags records earlier, their exponential running means
+    over memory records (the lake's thermal inertia) and the seasonal
+    cycle. Records before the first are taken equal to it.
+    INPUTS:
+    forcing: forcing path or array, see read_forcing
+    lags:    record lags of the variables
+    memory:  e-folding lengths (in records) of the running means
+    OUTPUT: features (nrecords, nfeatures), feature names
+    '''
+    data = read_forcing(forcing)
+    values = data[:, [FORCING_COLUMNS.index(name) for name in VARIABLES]]
+    columns = [values]
+    names = list(VARIABLES)
+    for lag in lags:
+        lagged = np.concatenate((np.repeat(values[:1], lag, axis=0), values[:-lag]))[:len(values)]
+        columns.append(lagged)
+        names += ['%s_lag%d' % (name, lag) for name in VARIABLES]
+    for span in memory:
+        weight = 1. / span
+        running = np.empty_like(values)
+        running[0] = values[0]
+        for k in range(1, len(values)):
+            running[k] = running[k - 1] + weight * (values[k] - running[k - 1])
+        columns.append(running)
+        names += ['%s_mean%d' % (name, span) for name in VARIABLES]
+    phase = 2. * np.pi * (data[:, 1] % YEAR_DAYS) / YEAR_DAYS
+    columns.append(np.column_stack((np.cos(phase), np.sin(phase))))
+    names += ['season_cos', 'season_sin']
+    return np.concatenate(columns, axis=1), names
+
+
+def ridge(X, Y, alpha):
+    '''
+    Ridge regression coefficients of standardized features X (no
+    intercept) for the centred targets Y.
+    '''
+    gram = X.T.dot(X)
+    gram[np.diag_indices_from(gram)] += alpha
+    return np.linalg.solve(gram, X.T.dot(Y))
+
+
+class LakeEmulator:
+    '''
+    Emulator of the monthly surface temperature and mixing depth (m) of one
+    lake configuration (include file, parameters and grid). Predictions
+    are a matrix product, so they take microseconds where the model takes
+    minutes; the fit reports its own cross-validated error in validation.
+    '''
+
+    def __init__(self, lags=(1, 2, 3), memory=(6, 24), alphas=np.logspace(-3, 3, 13)):
+        self.lags = tuple(lags)
+        self.memory = tuple(memory)
+        self.alphas = np.asarray(alphas, dtype=float)
+        self.names = None
+        self.validation = None
+
+    def features(self, forcing):
+        return forcing_features(forcing, self.lags, self.memory)[0]
+
+    def fit(self, forcings, surfs, folds=5, grid=None):
+        '''
+        Trains on runs of the model.
+        INPUTS:
+        forcings: forcing paths or arrays of the runs
+        surfs:    surf output paths or arrays of the same runs
+        folds:    number of contiguous blocks held out in turn when there is
+                  only one run; with several runs each run is held out
+        grid:     layer grid of the runs (see read_targets)
+        OUTPUT: self
+        '''
+        X, Y, groups = [], [], []
+        for k, (forcing, surf) in enumerate(zip(forcings, surfs)):
+            features, self.names = forcing_features(forcing, self.lags, self.memory)
+            X.append(features)
+            Y.append(read_targets(surf, len(features), grid))
+            groups.append(np.full(len(features), k))
+        X, Y, groups = np.concatenate(X), np.concatenate(Y), np.concatenate(groups)
+        if len(forcings) > 1:
+            method = 'leave-one-run-out'
+        else:
+            groups = np.arange(len(X)) * folds // len(X)
+            method = '%d contiguous folds' % folds
+
+        # alpha of each target by cross-validation, then a fit on all runs
+        errors = np.array([self._cv_predict(X, Y, groups, alpha) - Y for alpha in self.alphas])
+        rmse = np.sqrt(np.mean(errors ** 2, axis=1))
+        best = np.argmin(rmse, axis=0)
+        self.alpha = self.alphas[best]
+        self._solve(X, Y)
+        self.validation = {'method': method, 'runs': len(forcings), 'records': len(X)}
+        for j, target in enumerate(TARGETS):
+            error = errors[best[j], :, j]
+            self.validation[target] = {
+                'rmse': float(np.sqrt(np.mean(error ** 2))), 'mae': float(np.mean(np.abs(error))),
+                'max': float(np.max(np.abs(error))),
+                'r2': float(1. - np.sum(error ** 2) / np.sum((Y[:, j] - Y[:, j].mean()) ** 2)),
+                'alpha': float(self.alpha[j])}
+        return self
+
+    def _standardize(self, X, Y):
+        self.x_mean = X.mean(axis=0)
+        self.x_std = X.std(axis=0)
+        self.x_std[self.x_std == 0.] = 1.
+        self.y_mean = Y.mean(axis=0)
+
+    def _solve(self, X, Y, alpha=None):
+        alpha = self.alpha if alpha is None else np.broadcast_to(alpha, (len(TARGETS),))
+        self._standardize(X, Y)
+        Z = (X - self.x_mean) / self.x_std
+        self.coef = np.column_stack([ridge(Z, Y[:, [j]] - self.y_mean[j], alpha[j])[:, 0]
+                                     for j in range(len(TARGETS))])
+
+    def _cv_predict(self, X, Y, groups, alpha):
+        predicted = np.empty_like(Y)
+        for group in np.unique(groups):
+            held = groups == group
+            self._solve(X[~held], Y[~held], alpha)
+            predicted[held] = self._predict(X[held])
+        return predicted
+
+    def _predict(self, X):
+        return ((X - self.x_mean) / self.x_std).dot(self.coef) + self.y_mean
+
+    def predict(self, forcing):
+        '''
+        Emulated targets of every record of a forcing file or array.
+        OUTPUT: dict of TARGETS -> array (nrecords,), plus 'day'
+        '''
+        if self.names is None:
+            raise RuntimeError("the emulator has not been trained (fit or load)")
+        data = read_forcing(forcing)
+        predicted = self._predict(self.features(data))
+        result = {target: predicted[:, j] for j, target in enumerate(TARGETS)}
+        result['day'] = data[:, 1]
+        return result
+
+    def save(self, path):
+        '''
+        Coefficients, scaling and validation as a .npz file.
+        '''
+        meta = {'lags': self.lags, 'memory': self.memory, 'names': self.names,
+                'validation': self.validation}
+        np.savez(path, alphas=self.alphas, alpha=self.alpha, coef=self.coef, x_mean=self.x_mean,
+                 x_std=self.x_std, y_mean=self.y_mean, meta=json.dumps(meta))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            emulator = cls(meta['lags'], meta['memory'], data['alphas'])
+            for name in ('alpha', 'coef', 'x_mean', 'x_std', 'y_mean'):
+                setattr(emulator, name, data[name])
+        emulator.names = meta['names']
+        emulator.validation = meta['validation']
+        return emulator
+
+
+def scenario_forcings(forcing, n, directory, seed=0, scale=None, persistence=0.8):
+    '''
+    Training scenarios around a forcing file: each adds to the variables a
+    constant offset and AR(1) anomalies of standard deviation scale[name]
+    (persistence from one record to the next). Precipitation and runoff
+    are left as they are.
+    OUTPUT: paths of the n forcing files written to directory
+    '''
+    scale = dict({'ta': 1.0, 'rh': 3.0, 'ua': 0.3, 'sw': 10.0, 'rlwd': 8.0, 'ps': 0.}, **(scale or {}))
+    data = read_forcing(forcing)
+    rng = np.random.RandomState(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for k in range(n):
+        scenario = data.copy()
+        for name in VARIABLES:
+            if not scale[name]:
+                continue
+            noise = rng.normal(0., scale[name], len(data)) * np.sqrt(1. - persistence ** 2)
+            for i in range(1, len(data)):
+                noise[i] += persistence * noise[i - 1]
+            scenario[:, FORCING_COLUMNS.index(name)] += rng.normal(0., scale[name]) + noise
+        column = FORCING_COLUMNS.index
+        scenario[:, column('rh')] = np.clip(scenario[:, column('rh')], 1., 100.)
+        scenario[:, [column('ua'), column('sw')]] = np.maximum(scenario[:, [column('ua'), column('sw')]], 0.)
+        path = os.path.join(directory, 'scenario_%03d.txt' % k)
+        np.savetxt(path, scenario, fmt='%10.2f', delimiter='\t')
+        paths.append(path)
+    return paths
+
+
+def train(forcings, lake='Malawi', parameters=None, emulator=None, **run_options):
+    '''
+    Runs the full model for every forcing and trains an emulator on them.
+    INPUTS:
+    forcings:    forcing paths (e.g. from scenario_forcings)
+    lake, parameters, run_options: passed to lake_run.run_model (grid,
+                 include, fflags...)
+    emulator:    untrained LakeEmulator to use (default settings if None)
+    OUTPUT: trained emulator, list of the run results
+    '''
+    runs = [lake_run.run_model(forcing, lake, parameters, **run_options) for forcing in forcings]
+    emulator = emulator or LakeEmulator()
+    emulator.fit(forcings, [run['surf'] for run in runs], grid=run_options.get('grid'))
+    return emulator, runs
+
+
+def confirm(emulator, forcing, lake='Malawi', parameters=None, **run_options):
+    '''
+    Full model run of a forcing, to check an emulated result.
+    OUTPUT: dict with the run result, the emulated and modelled targets,
+            and the rmse and largest difference of each target
+    '''
+    run = lake_run.run_model(forcing, lake, parameters, **run_options)
+    predicted = emulator.predict(forcing)
+    modelled = read_targets(run['surf'], len(predicted['day']), run_options.get('grid'))
+    result = {'run': run, 'emulated': predicted, 'modelled': {}}
+    for j, target in enumerate(TARGETS):
+        error = predicted[target] - modelled[:, j]
+        result['modelled'][target] = modelled[:, j]
+        result[target] = {'rmse': float(np.sqrt(np.mean(error ** 2))), 'max': float(np.max(np.abs(error)))}
+    return result
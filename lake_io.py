@@ -0,0 +1,89 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# Functions 'get_output_data', 'convert_to_monthly', 'convert_to_annual'
+# Reading of the model output and conversion of series to dated monthly
+# and annual values, as plotted by the GUI (no tkinter needed)
+#====================================================================
+
+import copy
+import datetime as dt
+from os.path import basename
+from statistics import mean
+
+import lake_diagnostics as diag
+
+
+def get_output_data(time, data, column, filename):
+    """
+    Retrieves data from surf.dat from years where lake is at equilibrium
+    Inputs
+    - time: an empty array which is populated with day #'s
+    - data: an empty array which is populated with a certain column of data from surf.dat
+    - column: the specific column of data in surf.dat which should populate "data"
+    - filename: the file which contains the desired data
+    """
+    with diag.span("output load", file=basename(filename)) as stage:
+        with open(filename) as file:
+            lines = file.readlines()
+            cur_row = lines[len(lines) - 1].split()
+            next_row = lines[len(lines) - 2].split()
+            i = 2
+            while int(float(cur_row[0])) > int(float(next_row[0])):
+                data.insert(0, float(cur_row[column]))
+                time.insert(0, int(float(cur_row[0])))
+                cur_row = copy.copy(next_row)
+                i += 1
+                next_row = lines[len(lines) - i].split()
+            data.insert(0, float(cur_row[column]))
+            time.insert(0, int(float(cur_row[0])))
+        stage.items = len(data)
+
+
+def convert_to_monthly(time, start):
+    """
+    Converts timeseries x-axis into monthly units with proper labels
+    Input:
+    - time: an array of day numbers (15, 45, 75, etc.)
+    - start: the year of day 1
+    """
+    start_date = dt.date(start, 1, 1)
+    dates = []
+    for day in time:
+        new_date = start_date + dt.timedelta(days=day-1)
+        dates.append(new_date)
+    return dates
+
+
+def convert_to_annual(data, start):
+    """
+    Converts timeseries data into annually averaged data with proper axis labels
+    Input:
+    - data: the y-axis of the timeseries data
+    - start: the year of the first month
+    """
+    start_date = dt.date(start - 1, 7, 2)
+    with diag.span("annual conversion", items=sum(len(column) for column in data)):
+        all_year_avgs = []
+        for column in data:
+            years = []
+            year_data = []
+            year_avgs = []
+            for i in range(len(column)):
+                year_data.append(column[i])
+                if (i + 1) % 12 == 0:
+                    year_avgs.append(mean(year_data))
+                    years.append(start_date+dt.timedelta(days=365*((i+1)/12)))
+                    year_data.clear()
+            all_year_avgs.append(year_avgs)
+        return years, all_year_avgs
+
+
+def annual_dates(count, start):
+    """
+    Axis labels of annually averaged data, as made by convert_to_annual
+    Input:
+    - count: the number of years
+    - start: the year of the first month
+    """
+    start_date = dt.date(start - 1, 7, 2)
+    return [start_date + dt.timedelta(days=365 * (i + 1)) for i in range(count)]
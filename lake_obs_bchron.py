@@ -0,0 +1,461 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# OBSERVATION MODEL: Bayesian age-depth model
+# Function 'bchronology'
+# In-process replacement for the R package Bchron (Haslett and Parnell, 2008)
+#====================================================================
+
+import datetime as dt
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from lake_cache import make_key
+
+# Tweedie power of the compound Poisson-gamma increments (fixed in Bchron)
+TWEEDIE_P = 1.2
+GAMMA_SHAPE = (2. - TWEEDIE_P) / (TWEEDIE_P - 1.)
+
+# MCMC settings of bchronology and the stored summary, part of every cache key
+DEFAULT_SETTINGS = {'iterations': 10000, 'burn': 2000, 'thin': 8, 'chains': 4, 'seed': None,
+                    'keep': 500, 'probs': (0.025, 0.5, 0.975), 'block': 1000, 'max_values': 2000000}
+
+
+def _lgamma(x):
+    '''
+    Vectorized log-gamma for positive arguments: shift up by recurrence,
+    then apply the Stirling series.
+    '''
+    x = np.asarray(x, dtype=float)
+    shift = np.zeros_like(x)
+    z = x.copy()
+    for _ in range(7):
+        small = z < 7.
+        shift = shift + np.where(small, np.log(np.where(small, z, 1.)), 0.)
+        z = np.where(small, z + 1., z)
+    z2 = 1. / (z * z)
+    series = (1. / 12. - z2 * (1. / 360. - z2 * (1. / 1260. - z2 / 1680.))) / z
+    return (z - 0.5) * np.log(z) - z + 0.5 * math.log(2. * math.pi) + series - shift
+
+
+def _log_increments(delta, count, scale, lg_shape):
+    '''
+    Log density of the age increments given the number of compound
+    Poisson events in each depth interval (lg_shape is the log-gamma of
+    the gamma shape, which only changes with the event counts).
+    '''
+    ok = count > 0
+    positive = delta > 0.
+    safe_delta = np.where(positive, delta, 1.)
+    shape = count * GAMMA_SHAPE
+    logp = ((shape - 1.) * np.log(safe_delta) - safe_delta / scale
+            - shape * np.log(scale) - lg_shape)
+    logp = np.where(ok & positive, logp, -np.inf)
+    return np.where(~ok & (delta == 0.), 0., logp)
+
+
+def _bridge_events(rng, count, width):
+    '''
+    Compound Poisson events inside a depth interval for every sample:
+    locations are uniform in depth and sizes Dirichlet-distributed, which is
+    the exact conditional given the number of events and the total
+    increment. Locations are offset by sample number so that a single sorted
+    array serves all samples.
+    '''
+    count = count.astype(int)
+    owner = np.repeat(np.arange(len(count)), count)
+    keys = np.sort(owner * width + rng.uniform(0., width, owner.size))
+    sizes = np.concatenate(([0.], np.cumsum(rng.gamma(GAMMA_SHAPE, 1., owner.size))))
+    first = np.concatenate(([0], np.cumsum(count)[:-1]))
+    total = sizes[first + count] - sizes[first]
+    return keys, sizes, first, total
+
+
+def _bridge(events, start, delta, top, width, positions):
+    '''
+    Ages at positions inside [top, top + width) for every sample, given the
+    events of the interval and its total increment.
+    '''
+    keys, sizes, first, total = events
+    where = np.arange(len(start))[:, None] * width + (positions[None, :] - top)
+    below = np.searchsorted(keys, where, side='right')
+    below = np.maximum(below, first[:, None])
+    fraction = (sizes[below] - sizes[first][:, None]) / np.where(total > 0., total, 1.)[:, None]
+    return start[:, None] + delta[:, None] * fraction
+
+
+def _extrapolate(rng, lam, scale, distance, reached=0.):
+    '''
+    Cumulative compound Poisson-gamma age increments over increasing
+    distances from a dated position, one row per sample, starting from a
+    distance already reached.
+    '''
+    steps = np.diff(np.concatenate(([reached], distance)))
+    events = rng.poisson(lam[:, None] * steps[None, :])
+    sizes = rng.gamma(events * GAMMA_SHAPE + (events == 0), 1.) * (events > 0)
+    return np.cumsum(sizes * scale[:, None], axis=1)
+
+
+def _chunks(columns, block):
+    return [columns[i:i + block] for i in range(0, len(columns), block)]
+
+
+def _blocks(chains, workers):
+    '''
+    Numbers of chains of the jobs of a run: one job per worker (one per
+    chain by default), each a block of chains run together.
+    '''
+    return [len(block) for block in np.array_split(np.arange(chains), max(1, min(workers or chains, chains)))]
+
+
+def _run_chains(args):
+    '''
+    Runs a block of chains stacked along the first axis. Every update is
+    vectorized across the chains of the block and, by alternating odd and
+    even dated positions, across the dates as well.
+    '''
+    (ages, sds, positions, extract, iterations, burn, thin, nchains, seed) = args
+    rng = np.random.default_rng(seed)
+    ndate = len(ages)
+    width = np.diff(positions)
+
+    # Hyperparameter priors centred on the observed accumulation rate
+    mu0 = max((ages[-1] - ages[0]) / (positions[-1] - positions[0]), 1e-3)
+    lam0 = 5. * (ndate - 1) / (positions[-1] - positions[0])
+
+    theta = np.tile(np.maximum.accumulate(ages), (nchains, 1))
+    theta = np.maximum(theta + np.arange(ndate) * 1e-6, extract)
+    theta = theta + rng.normal(0., 1e-3, theta.shape) * sds
+    theta = np.sort(theta, axis=1)
+    mu = np.full(nchains, mu0)
+    lam = np.full(nchains, lam0)
+    count = np.tile(np.maximum(np.round(lam0 * width), 1.), (nchains, 1))
+
+    def scale_of(mu, lam):
+        return mu / (lam * GAMMA_SHAPE)
+
+    def lgammas(count):
+        return _lgamma(np.maximum(count * GAMMA_SHAPE, 1e-12)), _lgamma(count + 1.)
+
+    def dates(theta):
+        like = -0.5 * ((theta - ages) / sds) ** 2
+        return np.where(theta >= extract, like, -np.inf)
+
+    def intervals(theta, count, mu, lam, lg):
+        # log density of every interval: increments plus event counts
+        incr = _log_increments(np.diff(theta, axis=1), count,
+                               scale_of(mu, lam)[:, None], lg[0])
+        rate = lam[:, None] * width
+        return incr + count * np.log(rate) - rate - lg[1]
+
+    def hyper_prior(mu, lam):
+        return (-0.5 * (np.log(mu / mu0)) ** 2 - 0.5 * (np.log(lam / lam0)) ** 2)
+
+    step = 0.5 * sds
+    parity = np.arange(ndate) % 2
+    pad = np.zeros((nchains, 1))
+    lg = lgammas(count)
+    like = dates(theta)
+    incr = intervals(theta, count, mu, lam, lg)
+    keep_theta = []
+    keep_count = []
+    keep_hyper = []
+    for it in range(iterations):
+        # 1. dated positions, checkerboard so the updates are independent
+        for half in (0, 1):
+            move = (parity == half)[None, :]
+            prop = np.where(move, theta + rng.normal(0., 1., theta.shape) * step, theta)
+            like_p = dates(prop)
+            incr_p = intervals(prop, count, mu, lam, lg)
+            old = like + np.hstack((incr, pad)) + np.hstack((pad, incr))
+            new = like_p + np.hstack((incr_p, pad)) + np.hstack((pad, incr_p))
+            with np.errstate(invalid='ignore'):
+                accept = move & (np.log(rng.uniform(size=theta.shape)) < new - old)
+            theta = np.where(accept, prop, theta)
+            like = np.where(accept, like_p, like)
+            incr = intervals(theta, count, mu, lam, lg)
+        # 2. number of compound Poisson events in every interval
+        prop_count = np.maximum(count + rng.choice((-1., 1.), size=count.shape), 0.)
+        lg_p = lgammas(prop_count)
+        incr_p = intervals(theta, prop_count, mu, lam, lg_p)
+        with np.errstate(invalid='ignore'):
+            accept = np.log(rng.uniform(size=count.shape)) < incr_p - incr
+        count = np.where(accept, prop_count, count)
+        lg = (np.where(accept, lg_p[0], lg[0]), np.where(accept, lg_p[1], lg[1]))
+        incr = np.where(accept, incr_p, incr)
+        # 3. mean accumulation rate and event rate
+        for which in (0, 1):
+            factor = np.exp(rng.normal(0., 0.1, nchains))
+            mu_p = mu * factor if which == 0 else mu
+            lam_p = lam * factor if which == 1 else lam
+            incr_p = intervals(theta, count, mu_p, lam_p, lg)
+            with np.errstate(invalid='ignore'):
+                ratio = (incr_p.sum(axis=1) + hyper_prior(mu_p, lam_p)
+                         - incr.sum(axis=1) - hyper_prior(mu, lam))
+            accept = np.log(rng.uniform(size=nchains)) < ratio
+            mu = np.where(accept, mu_p, mu)
+            lam = np.where(accept, lam_p, lam)
+            incr = np.where(accept[:, None], incr_p, incr)
+        if it >= burn and (it - burn) % thin == 0:
+            keep_theta.append(theta)
+            keep_count.append(count)
+            keep_hyper.append(np.column_stack((mu, lam)))
+
+    return np.concatenate(keep_theta), np.concatenate(keep_count), np.concatenate(keep_hyper)
+
+
+def posterior(ages, ageSds, positions, calCurves=None, extractDate=None, iterations=10000,
+              burn=2000, thin=8, chains=4, workers=None, seed=None):
+    '''
+    Samples the posterior of the dated ages and of the accumulation process.
+    Ages at other depths are drawn from it afterwards by predict_blocks.
+    INPUTS: as bchronology
+    OUTPUT: dict with 'theta' (samples x dates, sorted by position),
+            'count' (events per interval), 'mu', 'lam', 'positions',
+            'order' (sorting of the input dates), 'extractDate' and 'seed'
+    '''
+    ages = np.asarray(ages, dtype=float)
+    sds = np.asarray(ageSds, dtype=float)
+    positions = np.asarray(positions, dtype=float)
+    if calCurves is not None and any(str(c) != 'normal' for c in calCurves):
+        raise ValueError("Only 'normal' calibration curves are supported by the native age model")
+    if len(ages) < 2:
+        raise ValueError("At least two dated positions are needed")
+    order = np.argsort(positions, kind='stable')
+    ages, sds, positions = ages[order], sds[order], positions[order]
+    if np.any(np.diff(positions) <= 0.):
+        raise ValueError("Dated positions must be distinct")
+    if extractDate is None:
+        extractDate = 1950 - dt.date.today().year
+
+    sizes = _blocks(chains, workers)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes) + 1)
+    jobs = [(ages, sds, positions, float(extractDate), int(iterations),
+             int(burn), int(thin), size, s) for size, s in zip(sizes, seeds[:-1])]
+    if len(jobs) == 1:
+        results = [_run_chains(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=len(jobs)) as pool:
+            results = list(pool.map(_run_chains, jobs))
+
+    hyper = np.concatenate([r[2] for r in results])
+    return {'theta': np.concatenate([r[0] for r in results]),
+            'count': np.concatenate([r[1] for r in results]),
+            'mu': hyper[:, 0], 'lam': hyper[:, 1], 'positions': positions,
+            'order': order, 'extractDate': float(extractDate), 'seed': seeds[-1]}
+
+
+def predict_blocks(model, predictPositions, block=1000, rng=None):
+    '''
+    Predicted ages in blocks of at most block positions, so only
+    samples x block ages are held at a time. The events of every interval
+    are drawn once, so age paths stay continuous across blocks.
+    INPUTS:
+    model:            output of posterior
+    predictPositions: depths at which to predict ages
+    block:            number of positions per block
+    rng:              numpy Generator (defaults to one seeded from the model)
+    OUTPUT: yields (columns, ages), columns indexing predictPositions and
+            ages of shape samples x len(columns)
+    '''
+    if rng is None:
+        rng = np.random.default_rng(model['seed'])
+    theta, count, positions = model['theta'], model['count'], model['positions']
+    lam = model['lam']
+    scale = model['mu'] / (lam * GAMMA_SHAPE)
+    predict = np.asarray(predictPositions, dtype=float)
+    order = np.argsort(predict, kind='stable')
+    ordered = predict[order]
+
+    # above the first date, walking up the core from it
+    carry, reached = np.zeros(len(theta)), 0.
+    for columns in _chunks(order[ordered < positions[0]][::-1], block):
+        distance = positions[0] - predict[columns]
+        increments = carry[:, None] + _extrapolate(rng, lam, scale, distance, reached)
+        carry, reached = increments[:, -1], distance[-1]
+        yield columns, np.maximum(theta[:, :1] - increments, model['extractDate'])
+    # between dates, with the compound Poisson-gamma bridge
+    for j in range(len(positions) - 1):
+        inside = order[(ordered >= positions[j]) & (ordered < positions[j + 1])]
+        if inside.size == 0:
+            continue
+        width = positions[j + 1] - positions[j]
+        events = _bridge_events(rng, count[:, j], width)
+        for columns in _chunks(inside, block):
+            yield columns, _bridge(events, theta[:, j], theta[:, j + 1] - theta[:, j],
+                                   positions[j], width, predict[columns])
+    # below the last date
+    carry, reached = np.zeros(len(theta)), 0.
+    for columns in _chunks(order[ordered >= positions[-1]], block):
+        distance = predict[columns] - positions[-1]
+        increments = carry[:, None] + _extrapolate(rng, lam, scale, distance, reached)
+        carry, reached = increments[:, -1], distance[-1]
+        yield columns, theta[:, -1:] + increments
+
+
+def bchronology(ages, ageSds, positions, calCurves=None, predictPositions=None,
+                extractDate=None, iterations=10000, burn=2000, thin=8, chains=4,
+                workers=None, seed=None):
+    '''
+    Bayesian age-depth model with compound Poisson-gamma accumulation, in
+    the style of Bchron::Bchronology.
+
+    INPUTS:
+    ages:             dated ages (years BP)
+    ageSds:           1-sigma age uncertainties
+    positions:        depths of the dated samples
+    calCurves:        calibration curve for each date; only 'normal' is
+                      available without R
+    predictPositions: depths at which to predict ages
+    extractDate:      date the core was extracted (years BP); no age can be
+                      younger. Defaults to the current year.
+    iterations, burn, thin: MCMC run length, burn-in and thinning per chain
+    chains:           number of independent chains
+    workers:          processes for the chains (None uses one per chain,
+                      1 runs all chains together in this process); the
+                      chains are split evenly between them, so the draws
+                      of a seed depend on workers
+    seed:             seed for the random number generator
+    OUTPUT: dict with 'theta' (samples x dates), 'thetaPredict'
+            (samples x predictPositions), 'predictPositions', 'mu' and 'lam'
+    '''
+    model = posterior(ages, ageSds, positions, calCurves, extractDate, iterations, burn,
+                      thin, chains, workers, seed)
+    if predictPositions is None:
+        predictPositions = np.linspace(model['positions'][0], model['positions'][-1], 100)
+    predict = np.asarray(predictPositions, dtype=float)
+    predicted = np.empty((len(model['theta']), len(predict)))
+    for columns, block_ages in predict_blocks(model, predict, block=max(len(predict), 1)):
+        predicted[:, columns] = block_ages
+    inverse = np.argsort(model['order'])
+    return {'theta': model['theta'][:, inverse], 'thetaPredict': predicted,
+            'predictPositions': predict, 'mu': model['mu'], 'lam': model['lam']}
+
+
+def summarize_blocks(blocks, nsamples, npredict, probs=(0.025, 0.5, 0.975), keep=500,
+                     max_values=2000000, rng=None):
+    '''
+    Quantiles of predicted ages from (columns, ages) blocks, plus a random
+    subset of at most keep posterior age paths. Paths are recorded at every
+    stride-th position so that they hold at most max_values ages however
+    long the core is.
+    OUTPUT: quantiles (len(probs) x npredict), paths (keep x npaths), the
+            indices of the kept samples and of the positions the paths are
+            recorded at
+    '''
+    if rng is None:
+        rng = np.random.default_rng()
+    keep = min(keep, nsamples)
+    kept = np.sort(rng.choice(nsamples, keep, replace=False))
+    stride = max(1, int(np.ceil(keep * npredict / float(max_values)))) if keep else 1
+    recorded = np.arange(0, npredict, stride)
+    slot = np.full(npredict, -1)
+    slot[recorded] = np.arange(len(recorded))
+    quantiles = np.empty((len(probs), npredict))
+    paths = np.empty((keep, len(recorded)))
+    for columns, block_ages in blocks:
+        quantiles[:, columns] = np.quantile(block_ages, probs, axis=0)
+        on_path = slot[columns] >= 0
+        if keep and np.any(on_path):
+            paths[:, slot[columns[on_path]]] = block_ages[np.ix_(kept, np.flatnonzero(on_path))]
+    return quantiles, paths, kept, recorded
+
+
+def bchronology_summary(ages, ageSds, positions, calCurves=None, predictPositions=None,
+                        extractDate=None, probs=(0.025, 0.5, 0.975), keep=500, block=1000,
+                        max_values=2000000, **settings):
+    '''
+    bchronology for long predictions: ages are predicted block by block and
+    reduced to quantiles straight away, so memory does not grow with the
+    number of predicted positions.
+    INPUTS: as bchronology, plus
+    probs:      quantiles to compute
+    keep:       number of posterior age paths to keep
+    block:      number of positions predicted at a time
+    max_values: bound on the number of kept path ages
+    OUTPUT: dict with 'quantiles' (rows follow probs), 'probs',
+            'predictPositions', 'theta' and 'thetaPredict' for the kept paths,
+            recorded at 'pathPositions'
+    '''
+    model = posterior(ages, ageSds, positions, calCurves, extractDate, **settings)
+    if predictPositions is None:
+        predictPositions = np.linspace(model['positions'][0], model['positions'][-1], 100)
+    predict = np.asarray(predictPositions, dtype=float)
+    rng = np.random.default_rng(model['seed'])
+    nsamples = len(model['theta'])
+    quantiles, paths, kept, recorded = summarize_blocks(
+        predict_blocks(model, predict, block, rng), nsamples, len(predict), probs, keep,
+        max_values, rng)
+    inverse = np.argsort(model['order'])
+    return {'quantiles': quantiles, 'probs': np.asarray(probs), 'predictPositions': predict,
+            'theta': model['theta'][kept][:, inverse], 'thetaPredict': paths,
+            'pathPositions': predict[recorded]}
+
+
+def chron_quantiles(thetaPredict, probs=(0.025, 0.5, 0.975)):
+    '''
+    Quantiles of the predicted ages at every position (rows follow probs),
+    as plotted by PageObservation.
+    '''
+    return np.quantile(np.asarray(thetaPredict), probs, axis=0)
+
+
+def age_model_key(ages, ageSds, positions, calCurves, predictPositions, extractDate,
+                  engine='native', **settings):
+    '''
+    Cache key of an age-depth model run: the dated positions, ages, SDs,
+    calibration curves, prediction positions, extraction date, engine and
+    MCMC settings.
+    '''
+    settings = dict(DEFAULT_SETTINGS, **settings)
+    # the chains are split into blocks by workers, which draw differently
+    settings['workers'] = len(_blocks(settings['chains'], settings.pop('workers', None)))
+    return make_key('bchronology', engine, ages, ageSds, positions, calCurves,
+                    predictPositions, extractDate, **settings)
+
+
+def summarize_result(result, probs=(0.025, 0.5, 0.975), keep=500, block=1000, max_values=2000000):
+    '''
+    Reduces a full bchronology result (e.g. from the R worker) to the
+    output of bchronology_summary, block of positions by block.
+    '''
+    thetaPredict = np.asarray(result['thetaPredict'])
+    predict = np.asarray(result['predictPositions'], dtype=float)
+    blocks = ((columns, thetaPredict[:, columns]) for columns in _chunks(np.arange(len(predict)), block))
+    quantiles, paths, kept, recorded = summarize_blocks(blocks, len(thetaPredict), len(predict),
+                                                        probs, keep, max_values)
+    return {'quantiles': quantiles, 'probs': np.asarray(probs), 'predictPositions': predict,
+            'theta': np.asarray(result['theta'])[kept], 'thetaPredict': paths,
+            'pathPositions': predict[recorded]}
+
+
+def store_age_model(cache, key, result):
+    '''
+    Stores the output of bchronology_summary (or a full bchronology result,
+    summarized first) and returns what was stored, the same dict cache.get
+    gives.
+    '''
+    if 'quantiles' not in result:
+        result = summarize_result(result)
+    stored = {name: result[name] for name in ('quantiles', 'probs', 'predictPositions', 'theta',
+                                              'thetaPredict', 'pathPositions')}
+    cache.put(key, **stored)
+    return stored
+
+
+def cached_bchronology(cache, ages, ageSds, positions, calCurves=None, predictPositions=None,
+                       extractDate=None, **settings):
+    '''
+    bchronology_summary through a DiskCache: an identical run is read back
+    from disk instead of being sampled again.
+    OUTPUT: as bchronology_summary
+    '''
+    key = age_model_key(ages, ageSds, positions, calCurves, predictPositions, extractDate, **settings)
+    stored = cache.get(key)
+    if stored is None:
+        result = bchronology_summary(ages, ageSds, positions, calCurves=calCurves,
+                                     predictPositions=predictPositions, extractDate=extractDate,
+                                     **settings)
+        stored = store_age_model(cache, key, result)
+    return stored
@@ -0,0 +1,180 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# OBSERVATION MODEL: Bayesian age-depth model
+# Class 'RWorker'
+# Long-lived R session running Bchron::Bchronology outside the GUI process
+#====================================================================
+
+import itertools
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+
+# Packages the worker needs; installed once by provision()
+R_PACKAGES = ('Bchron',)
+
+
+def provision(repos, lib=None, rscript='Rscript'):
+    '''
+    Installs the R packages needed by the worker from a local package
+    repository (e.g. a directory created with miniCRAN or
+    tools::write_PACKAGES). Run once at install time; nothing is downloaded
+    when the GUI is in use.
+    INPUTS:
+    repos:   path or file:// URL of the local package repository
+    lib:     optional R library directory to install into
+    rscript: Rscript executable
+    '''
+    if '://' not in repos:
+        repos = 'file://' + os.path.abspath(repos).replace(os.sep, '/')
+    packages = ', '.join("'%s'" % p for p in R_PACKAGES)
+    command = "install.packages(c(%s), repos='%s', type='source'" % (packages, repos)
+    if lib is not None:
+        lib = os.path.abspath(lib).replace(os.sep, '/')
+        os.makedirs(lib, exist_ok=True)
+        command += ", lib='%s'" % lib
+    command += ")"
+    subprocess.run([rscript, '-e', command], check=True)
+    check = "quit(status=!all(sapply(c(%s), requireNamespace%s)))" % (
+        packages, ", lib.loc='%s'" % lib if lib is not None else '')
+    subprocess.run([rscript, '-e', check], check=True)
+
+
+def _serve(requests, responses, lib):
+    '''
+    Worker loop: import Bchron once, then run Bchronology for every request
+    until None is received.
+    '''
+    try:
+        import numpy as np
+        import lake_obs_bchron as bchron
+        from rpy2.robjects import FloatVector
+        from rpy2.robjects.vectors import StrVector
+        from rpy2.robjects.packages import importr
+        import rpy2.robjects.numpy2ri
+        rpy2.robjects.numpy2ri.activate()
+        if lib is not None:
+            Bchron = importr('Bchron', lib_loc=lib)
+        else:
+            Bchron = importr('Bchron')
+    except Exception as err:
+        responses.put((None, None, "R worker could not load Bchron (run provision first): %s" % err))
+        return
+    responses.put((None, 'ready', None))
+
+    while True:
+        job = requests.get()
+        if job is None:
+            break
+        job_id, kwargs = job
+        try:
+            ages = Bchron.Bchronology(ages=FloatVector(kwargs['ages']), ageSds=FloatVector(kwargs['ageSds']),
+                                      positions=FloatVector(kwargs['positions']),
+                                      calCurves=StrVector(kwargs['calCurves']),
+                                      predictPositions=FloatVector(kwargs['predictPositions']),
+                                      extractDate=float(kwargs['extractDate']))
+            result = {'theta': np.array(ages[0]), 'thetaPredict': np.array(ages[4]),
+                      'predictPositions': np.asarray(kwargs['predictPositions'], dtype=float)}
+            # only quantiles and a bounded set of paths cross the process boundary
+            responses.put((job_id, bchron.summarize_result(result), None))
+        except Exception as err:
+            responses.put((job_id, None, str(err)))
+
+
+class RWorker:
+    '''
+    Handle on a background process holding a warm R session. Jobs are
+    submitted without blocking and their results collected with poll(),
+    which suits a tkinter after() loop.
+    '''
+
+    def __init__(self, lib=None):
+        self.lib = lib
+        self.process = None
+        self.ready = False
+        self.results = {}
+        self._ids = itertools.count(1)
+
+    def start(self):
+        if self.alive():
+            return
+        # spawn, so the worker does not inherit the GUI's Tk state
+        ctx = multiprocessing.get_context('spawn')
+        self.requests = ctx.Queue()
+        self.responses = ctx.Queue()
+        self.ready = False
+        self.process = ctx.Process(target=_serve, args=(self.requests, self.responses, self.lib),
+                                   daemon=True)
+        self.process.start()
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def submit(self, ages, ageSds, positions, calCurves, predictPositions, extractDate):
+        '''
+        Queues a Bchronology run and returns its job id immediately.
+        '''
+        self.start()
+        job_id = next(self._ids)
+        self.requests.put((job_id, {'ages': list(map(float, ages)), 'ageSds': list(map(float, ageSds)),
+                                    'positions': list(map(float, positions)),
+                                    'calCurves': [str(c) for c in calCurves],
+                                    'predictPositions': list(map(float, predictPositions)),
+                                    'extractDate': float(extractDate)}))
+        return job_id
+
+    def poll(self, job_id):
+        '''
+        Non-blocking check for a job. Returns (done, result); raises
+        RuntimeError if the job or the worker failed.
+        '''
+        while True:
+            try:
+                done_id, result, error = self.responses.get_nowait()
+            except queue.Empty:
+                break
+            if done_id is None:
+                if error is not None:
+                    raise RuntimeError(error)
+                self.ready = True
+                continue
+            self.results[done_id] = (result, error)
+        if job_id in self.results:
+            result, error = self.results.pop(job_id)
+            if error is not None:
+                raise RuntimeError(error)
+            return True, result
+        if not self.alive():
+            raise RuntimeError("R worker exited unexpectedly")
+        return False, None
+
+    def close(self):
+        if self.alive():
+            self.requests.put(None)
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.process = None
+
+
+_worker = None
+
+
+def get_worker(lib=None):
+    '''
+    Shared worker, started on first use and reused for the life of the GUI.
+    '''
+    global _worker
+    if _worker is None:
+        _worker = RWorker(lib=lib or os.environ.get('LAKEPSM_R_LIB'))
+    _worker.start()
+    return _worker
+
+
+if __name__ == '__main__':
+    # python lake_obs_rworker.py <local package repository> [library directory]
+    if len(sys.argv) < 2:
+        sys.exit("usage: python lake_obs_rworker.py REPOSITORY [LIBRARY]")
+    provision(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,99 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# OBSERVATION MODEL: Discrete core sampling
+# Function 'sample_core'
+# Averages a simulated record over the finite slices a real core is cut into
+#====================================================================
+
+import numpy as np
+
+
+def cell_edges(x):
+    '''
+    Edges of the cells represented by the points x (increasing): midpoints
+    between neighbours, with the outer cells as wide as their neighbour.
+    '''
+    x = np.asarray(x, dtype=float)
+    if len(x) == 1:
+        return np.array([x[0] - 0.5, x[0] + 0.5])
+    mid = 0.5 * (x[1:] + x[:-1])
+    return np.concatenate(([2. * x[0] - mid[0]], mid, [2. * x[-1] - mid[-1]]))
+
+
+def interval_means(x, values, top, bottom, edges=None):
+    '''
+    Mean of a piecewise-constant record over intervals [top, bottom). The
+    record is integrated once with a cumulative sum; every interval is then
+    the difference of the integral at its two ends, so the cost does not
+    depend on how many cells an interval spans.
+    INPUTS:
+    x:      positions of the record (years or depth), increasing
+    values: record at x, shape (N,) or (K, N) for an ensemble
+    top, bottom: interval ends (same units as x)
+    edges:  optional cell edges (N + 1); defaults to cell_edges(x)
+    OUTPUT: means, shape (len(top),) or (K, len(top)); NaN for intervals
+            outside the record
+    '''
+    values = np.asarray(values, dtype=float)
+    if edges is None:
+        edges = cell_edges(x)
+    edges = np.asarray(edges, dtype=float)
+    top = np.asarray(top, dtype=float)
+    bottom = np.asarray(bottom, dtype=float)
+    width = np.diff(edges)
+    integral = np.concatenate((np.zeros(values.shape[:-1] + (1,)),
+                               np.cumsum(values * width, axis=-1)), axis=-1)
+
+    def integral_at(z):
+        # exact for piecewise-constant cells; weights are shared by all members
+        cell = np.clip(np.searchsorted(edges, z, side='right') - 1, 0, len(width) - 1)
+        fraction = (z - edges[cell]) / width[cell]
+        return integral[..., cell] + fraction * (integral[..., cell + 1] - integral[..., cell])
+
+    length = bottom - top
+    means = (integral_at(bottom) - integral_at(top)) / np.where(length > 0., length, np.nan)
+    outside = (top < edges[0]) | (bottom > edges[-1]) | (length <= 0.)
+    means[..., outside] = np.nan
+    return means
+
+
+def slice_intervals(start, stop, thickness):
+    '''
+    Contiguous slices of constant thickness from start to stop (a partial
+    last slice is dropped, as it would be when cutting a core).
+    OUTPUT: top, bottom
+    '''
+    nslice = int(np.floor((stop - start) / thickness + 1e-9))
+    top = start + thickness * np.arange(nslice)
+    return top, top + thickness
+
+
+def sample_core(x, values, thickness=None, depths=None, width=None, top=None, bottom=None):
+    '''
+    Discrete sampling of an annual or depth-domain record (or an ensemble of
+    records on the same axis). Give exactly one of:
+    thickness:     contiguous slices of this thickness over the whole record
+    depths, width: samples centred on depths, each width thick (scalar or
+                   one width per sample)
+    top, bottom:   explicit sample intervals
+    INPUTS:
+    x:      positions of the record (years or depth), increasing
+    values: record at x, shape (N,) or (K, N)
+    OUTPUT: sample midpoints, sampled values (shape (nsample,) or
+            (K, nsample))
+    '''
+    x = np.asarray(x, dtype=float)
+    edges = cell_edges(x)
+    if thickness is not None:
+        top, bottom = slice_intervals(edges[0], edges[-1], thickness)
+    elif depths is not None:
+        if width is None:
+            raise ValueError("width is needed with depths")
+        depths = np.asarray(depths, dtype=float)
+        half = 0.5 * np.broadcast_to(np.asarray(width, dtype=float), depths.shape)
+        top, bottom = depths - half, depths + half
+    elif top is None or bottom is None:
+        raise ValueError("Give thickness, depths and width, or top and bottom")
+    top = np.asarray(top, dtype=float)
+    bottom = np.asarray(bottom, dtype=float)
+    return 0.5 * (top + bottom), interval_means(x, values, top, bottom, edges)
@@ -0,0 +1,312 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# Class 'Pipeline'
+# Stage graph of the PSM (environment model output -> sensor -> annual
+# means -> bioturbation, and compaction). Every node is cached on disk by
+# a hash of its settings, its input files and the keys of the nodes it
+# reads, so a changed setting recomputes only the nodes downstream of it
+#====================================================================
+
+import collections
+import os
+
+import numpy as np
+import pandas as pd
+
+import lake_archive_bioturb as bio
+import lake_archive_compact as comp
+import lake_diagnostics as diag
+import lake_run
+import sensor_carbonate as carb
+import sensor_gdgt as gdgt
+import sensor_leafwax as leafwax
+from lake_cache import make_key
+
+
+class Stage:
+    '''
+    One node of a pipeline.
+    INPUTS:
+    name:     stage name, also the key of its settings (see Pipeline.run)
+    function: function(settings, *input results) returning a dict of arrays
+    inputs:   names of the stages it reads, or of slots bound to a stage
+              when the pipeline runs (e.g. 'sensor')
+    files:    settings that are paths of input files; the node is stale
+              once such a file is modified
+    defaults: default settings
+    prepare:  function(settings) returning the settings that matter, e.g.
+              without those a chosen model does not use
+    label:    name of the stage in the diagnostics
+    version:  raise to set aside results cached by older code
+    '''
+
+    def __init__(self, name, function, inputs=(), files=(), defaults=None, prepare=None, label=None,
+                 version=1):
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.files = tuple(files)
+        self.defaults = dict(defaults or {})
+        self.prepare = prepare
+        self.label = label or name
+        self.version = version
+
+    def settings(self, settings):
+        settings = dict(self.defaults, **(settings or {}))
+        return self.prepare(settings) if self.prepare else settings
+
+
+def file_stamp(path):
+    '''
+    Identity of an input file in a cache key: absolute path, size and
+    modification time (cheaper than hashing the contents on every click).
+    '''
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+class Pipeline:
+    '''
+    Stages and the cache of their results.
+    INPUTS:
+    stages: Stage objects
+    cache:  lake_cache.DiskCache of results kept between sessions (None to
+            keep results of this session only)
+    memory: results kept in memory, most recently used first
+    '''
+
+    def __init__(self, stages=(), cache=None, memory=32):
+        self.stages = collections.OrderedDict()
+        self.cache = cache
+        self.memory = collections.OrderedDict()
+        self.memory_size = memory
+        # names of the stages the last run computed (the others were cached)
+        self.computed = []
+        for stage in stages:
+            self.add(stage)
+
+    def add(self, stage):
+        self.stages[stage.name] = stage
+        return stage
+
+    def stage(self, name, using=None):
+        '''
+        Stage of a name, or of the stage bound to a slot in using.
+        '''
+        name = (using or {}).get(name, name)
+        if name not in self.stages:
+            raise KeyError("no stage %s in the pipeline (bind slots with using)" % name)
+        return self.stages[name]
+
+    def key(self, name, settings, using=None):
+        '''
+        Cache key of a node: its stage, settings and input files, and the
+        keys of the nodes it reads.
+        '''
+        stage = self.stage(name, using)
+        own = stage.settings(settings.get(stage.name))
+        for field in stage.files:
+            if isinstance(own.get(field), str) and own[field]:
+                own[field] = file_stamp(own[field])
+        upstream = [self.key(name, settings, using) for name in stage.inputs]
+        return make_key('lake_pipeline', stage.name, stage.version, own, upstream)
+
+    def run(self, name, settings, using=None):
+        '''
+        Result of a node. It is read from memory or the disk cache if the
+        node's key is known; otherwise the nodes it reads are run (in turn
+        only if they are not cached) and it is computed and stored.
+        INPUTS:
+        name:     stage to run
+        settings: dict of stage name -> dict of settings of that stage
+                  (stages without an entry use their defaults)
+        using:    dict binding slots to stages, e.g. {'env': 'surf_file',
+                  'sensor': 'carbonate'}
+        OUTPUT: dict of arrays
+        '''
+        self.computed = []
+        return self._run(name, settings, using)
+
+    def _run(self, name, settings, using):
+        stage = self.stage(name, using)
+        key = self.key(name, settings, using)
+        result = self._lookup(key, stage)
+        if result is not None:
+            return result
+        inputs = [self._run(name, settings, using) for name in stage.inputs]
+        with diag.span(stage.label, stage=stage.name) as span:
+            result = {field: np.asarray(value) for field, value in
+                      stage.function(stage.settings(settings.get(stage.name)), *inputs).items()}
+            span.items = max([np.size(value) for value in result.values()] or [0])
+        self.computed.append(stage.name)
+        self._remember(key, result)
+        if self.cache is not None:
+            self.cache.put(key, meta={'stage': stage.name}, **result)
+        return result
+
+    def _lookup(self, key, stage):
+        if key in self.memory:
+            self.memory.move_to_end(key, last=False)
+            return self.memory[key]
+        if self.cache is None:
+            return None
+        with diag.span("cache lookup", stage=stage.name) as span:
+            result = self.cache.get(key)
+            span.meta['hit'] = result is not None
+        if result is None:
+            return None
+        result.pop('__meta__', None)
+        self._remember(key, result)
+        return result
+
+    def _remember(self, key, result):
+        self.memory[key] = result
+        self.memory.move_to_end(key, last=False)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem()
+
+    def clear(self):
+        '''
+        Forgets the results kept in memory (the disk cache is kept).
+        '''
+        self.memory.clear()
+
+
+def _seeded(seed, function, *args):
+    '''
+    Calls a function that draws from numpy's global random state with that
+    state seeded, so a cached result is the one the same settings give; the
+    caller's random state is restored afterwards.
+    '''
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        return function(*args)
+    finally:
+        np.random.set_state(state)
+
+
+def equilibrium_rows(rows):
+    '''
+    Rows of a surf output from the last model year(s) after spin-up: the
+    last run of increasing day numbers (the day count restarts with every
+    spin-up cycle).
+    '''
+    day = rows[:, 0].astype(int)
+    restarts = np.flatnonzero(day[1:] <= day[:-1])
+    return rows[restarts[-1] + 1 if len(restarts) else 0:]
+
+
+def run_env(settings):
+    run = lake_run.run_model(settings['forcing'], settings['lake'], settings['parameters'],
+                             include=settings['include'], source=settings['source'], grid=settings['grid'])
+    return {'surf': np.loadtxt(run['surf'], ndmin=2)}
+
+
+def _prepare_env(settings):
+    settings = dict(settings)
+    # the template and source are files of the node, so editing them reruns it
+    settings['include'] = settings['include'] or os.path.join(lake_run.ROOT, lake_run.TEMPLATES[settings['lake']])
+    settings['source'] = os.path.join(lake_run.ROOT, settings['source'])
+    return settings
+
+
+def read_surf(settings):
+    return {'surf': np.loadtxt(settings['path'], ndmin=2)}
+
+
+def model_output(settings, env):
+    rows = equilibrium_rows(env['surf'])
+    return {'days': rows[:, 0].astype(int), 'values': rows[:, settings['column']]}
+
+
+def carbonate(settings, output):
+    return {'days': output['days'],
+            'proxy': carb.carb_sensor(output['values'], settings['d18Ow'], model=settings['model'])}
+
+
+def gdgt_proxy(settings, output):
+    days, maat = output['days'], []
+    if 'MBT' in settings['model']:
+        # the MBT calibrations use the air temperature of the forcing
+        forcing = np.loadtxt(settings['forcing'], ndmin=2)
+        days, maat = forcing[:, 1].astype(int), forcing[:, 2]
+    return {'days': days, 'proxy': gdgt.gdgt_sensor(output['values'], maat, settings['beta'],
+                                                    model=settings['model'])}
+
+
+def _prepare_gdgt(settings):
+    if 'MBT' not in settings['model']:
+        settings = dict(settings, forcing=None)
+    return settings
+
+
+def leafwax_proxy(settings):
+    dDp = np.loadtxt(settings['dDp'])
+    args = (dDp, settings['fC_3'], settings['fC_4'], settings['eps_c3'], settings['eps_c4'])
+    # Q1 and Q2 are the 2.5th and 97.5th percentiles of the Monte Carlo realizations
+    mc, q1, q2 = _seeded(settings['seed'], leafwax.wax_uncertainty,
+                         *(args + (settings['eps_c3_err'], settings['eps_c4_err'])))
+    return {'days': 30 * np.arange(len(dDp)) + 15, 'proxy': leafwax.wax_sensor(*args), 'q1': q1, 'q2': q2}
+
+
+def read_proxy(settings):
+    return {'proxy': pd.read_csv(settings['path'])[settings['column']].to_numpy(dtype=float)}
+
+
+def annual_means(settings, sensor):
+    '''
+    Means of every complete year (12 records) of each series of a sensor.
+    '''
+    result = {}
+    for name, values in sensor.items():
+        if name == 'days':
+            continue
+        years = len(values) // 12
+        result[name] = np.asarray(values[:years * 12], dtype=float).reshape(years, 12).mean(axis=1)
+    return result
+
+
+def bioturbation(settings, annual):
+    age = settings['end'] - settings['start']
+    mxl = np.ones(age) * settings['mxl']
+    abu = np.ones(age) * settings['abundance']
+    oriabu, bioabu, oriiso, bioiso = _seeded(settings['seed'], bio.bioturbation, abu, annual['proxy'], mxl,
+                                             settings['carriers'])
+    return {'oriabu': oriabu, 'bioabu': bioabu, 'oriiso': oriiso, 'bioiso': bioiso}
+
+
+def compaction(settings):
+    z, phi, h, h_prime = comp.compaction(settings['sbar'], settings['years'], settings['phi_0'])
+    return {'z': z, 'phi': phi, 'h': h, 'h_prime': h_prime}
+
+
+def default_stages():
+    '''
+    Stages of the GUI. The model output reads the slot 'env' (the 'env'
+    stage, or 'surf_file' for an existing surf output) and the annual
+    means read the slot 'sensor' (a sensor stage, or 'proxy_csv').
+    '''
+    return [
+        Stage('env', run_env, files=('forcing', 'include', 'source', 'grid'), prepare=_prepare_env,
+              defaults={'lake': 'Malawi', 'parameters': {}, 'include': None, 'source': lake_run.SOURCE,
+                        'grid': None}, label="model run"),
+        Stage('surf_file', read_surf, files=('path',), label="output load"),
+        Stage('output', model_output, inputs=('env',), defaults={'column': 1}, label="output load"),
+        Stage('carbonate', carbonate, inputs=('output',), defaults={'model': 'ONeil', 'd18Ow': -2.},
+              label="sensor"),
+        Stage('gdgt', gdgt_proxy, inputs=('output',), files=('forcing',), prepare=_prepare_gdgt,
+              defaults={'model': 'TEX86-loomis', 'beta': 1. / 50., 'forcing': None}, label="sensor"),
+        Stage('leafwax', leafwax_proxy, files=('dDp',),
+              defaults={'fC_3': 0.7, 'fC_4': 0.3, 'eps_c3': -112.8, 'eps_c4': -124.5, 'eps_c3_err': 34.7,
+                        'eps_c4_err': 28.2, 'seed': 0}, label="sensor"),
+        Stage('proxy_csv', read_proxy, files=('path',), defaults={'column': 'Pseudoproxy'},
+              label="output load"),
+        Stage('annual', annual_means, inputs=('sensor',), label="annual conversion"),
+        Stage('bioturbation', bioturbation, inputs=('annual',), defaults={'seed': 0}),
+        Stage('compaction', compaction),
+    ]
+
+
+def default_pipeline(cache=None):
+    return Pipeline(default_stages(), cache)
@@ -0,0 +1,279 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# ENVIRONMENT MODEL: Isolated lake model runs
+# Function 'run_model'
+# Builds and runs the Fortran lake model in a private working directory, so
+# the shared source, include and settings files are never edited and any
+# number of runs can proceed side by side
+#====================================================================
+
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+RUNS_ROOT = os.path.join(ROOT, 'runs')
+BUILD_ROOT = os.path.join(RUNS_ROOT, 'build')
+
+SOURCE = 'env_heatflux.f90'
+TEMPLATES = {'Malawi': 'Malawi.inc', 'Tanganyika': 'Tanganyika.inc'}
+# Every run reads its forcing under this name from its own directory
+FORCING = 'forcing.txt'
+# Optional layer thicknesses (m, surface layer first) the model reads from
+# its run directory instead of the uniform 1 m grid (see init_grid)
+GRID = 'lake_grid.txt'
+SURF = 'ERA-HIST-Tlake_surf.dat'
+TPROF = 'ERA-HIST-Tlake_Tprof.dat'
+EXE = 'lake.exe' if os.name == 'nt' else 'lake'
+
+# Parameters that may be set per run, in the order of the GUI form
+PARAMETER_NAMES = ["oblq", "xlat", "xlon", "gmt", "max_dep", "basedep", "b_area", "cdrn", "eta", "f",
+                   "alb_slush", "alb_snow", "depth_begin", "salty_begin", "o18air", "deutair", "tempinit",
+                   "deutinit", "o18init", "nspin", "bndry_flag", "sigma", "wb_flag", "iceflag", "s_flag",
+                   "o18flag", "deutflag", "z_screen"]
+
+
+def fortran_value(value):
+    '''
+    Python value as it is written in a Fortran parameter statement.
+    '''
+    if isinstance(value, bool):
+        return '.true.' if value else '.false.'
+    return str(value).strip()
+
+
+def render_include(text, parameters=None, datafile=None):
+    '''
+    Include file with parameters replaced by name (the comments are kept).
+    INPUTS:
+    text:       include file template, e.g. the contents of Malawi.inc
+    parameters: dict of parameter name -> value (bool for the flags);
+                None or '' values keep the template's value
+    datafile:   forcing file name the model opens
+    OUTPUT: rendered include file
+    '''
+    for name, value in (parameters or {}).items():
+        if value is None or value == '':
+            continue
+        pattern = re.compile(r'(parameter\s*\(\s*%s\s*=\s*)[^)]*(\))' % re.escape(name), re.I)
+        if not pattern.search(text):
+            raise KeyError("parameter %s is not in the include file" % name)
+        text = pattern.sub(lambda m: m.group(1) + fortran_value(value) + m.group(2), text)
+        if name == 'max_dep':
+            # a uniform area table has one value per layer
+            text = re.sub(r'(data\s+area\s*/\s*)\d+(\s*\*)', r'\g<1>%d\2' % int(float(value)), text,
+                          flags=re.I)
+    if datafile is not None:
+        text = re.sub(r"character\s*\(\s*\d+\s*\)\s*::\s*datafile\s*=\s*'[^']*'",
+                      "character(%d) :: datafile='%s'" % (max(38, len(datafile)), datafile), text,
+                      flags=re.I)
+    return text
+
+
+def include_values(text, names):
+    '''
+    Values of parameters in an include file, the inverse of render_include.
+    OUTPUT: dict of name -> float (bool for the flags)
+    '''
+    values = {}
+    for name in names:
+        match = re.search(r'parameter\s*\(\s*%s\s*=\s*([^)]*)\)' % re.escape(name), text, re.I)
+        if not match:
+            raise KeyError("parameter %s is not in the include file" % name)
+        value = match.group(1).strip().lower()
+        if value in ('.true.', '.false.'):
+            values[name] = value == '.true.'
+        else:
+            values[name] = float(value.replace('d', 'e'))
+    return values
+
+
+def render_source(text, include='lake.inc'):
+    '''
+    Model source with every include statement pointed at include.
+    '''
+    return re.sub(r"include\s+'[^']+\.inc'", "include '%s'" % include, text)
+
+
+def stretched_grid(depth, surface=1., fine_depth=50., growth=1.1, max_thickness=20.):
+    '''
+    Layer thicknesses of a stretched grid for a deep lake: layers of the
+    surface thickness down to fine_depth, where the mixed layer and
+    thermocline are, then each layer growth times thicker than the one
+    above (at most max_thickness), ending exactly at depth. A thin last
+    layer is merged into the one above.
+    INPUTS:
+    depth:  depth of the lake in m (depth_begin)
+    OUTPUT: list of thicknesses in m, surface layer first
+    '''
+    thickness = []
+    bottom = 0.
+    layer = surface
+    while depth - bottom > 1e-6:
+        if bottom >= fine_depth:
+            layer = min(round(layer * growth, 2), max_thickness)
+        thickness.append(min(layer, depth - bottom))
+        bottom += thickness[-1]
+    if len(thickness) > 1 and thickness[-1] < 0.5 * thickness[-2]:
+        last = thickness.pop()
+        thickness[-1] += last
+    return thickness
+
+
+def layer_depths(thickness):
+    '''
+    Depths of the layer midpoints of a grid, e.g. for the columns of the
+    Tprof output of a run on that grid.
+    '''
+    bottom = 0.
+    depths = []
+    for layer in thickness:
+        depths.append(bottom + 0.5 * layer)
+        bottom += layer
+    return depths
+
+
+def mixing_metres(mixing, grid=None):
+    '''
+    Mixing depth of a surf output, a (time-averaged) layer number, in m:
+    the bottom of that layer on the run's grid (see write_grid),
+    interpolated between layers. On the uniform 1 m grid (None) the layer
+    number already is the depth in m.
+    '''
+    if grid is None:
+        return mixing
+    thickness = np.loadtxt(grid, ndmin=1) if isinstance(grid, str) else np.asarray(grid, dtype=float)
+    bottoms = np.concatenate(([0.], np.cumsum(thickness)))
+    return np.interp(mixing, np.arange(len(bottoms)), bottoms)
+
+
+def write_grid(path, grid):
+    '''
+    Writes a layer grid (a sequence of thicknesses, or the path of a grid
+    file to copy) as the model's lake_grid.txt.
+    '''
+    if isinstance(grid, str):
+        shutil.copy(grid, path)
+        return
+    with open(path, 'w') as file:
+        for layer in grid:
+            file.write('%.6f\n' % layer)
+
+
+def new_run_dir(root=RUNS_ROOT, prefix='run_'):
+    '''
+    Fresh, uniquely named directory for one run.
+    '''
+    os.makedirs(root, exist_ok=True)
+    return tempfile.mkdtemp(prefix=prefix + time.strftime('%Y%m%d-%H%M%S_'), dir=root)
+
+
+def build(source_text, include_text, fc='gfortran', fflags='-O2', root=BUILD_ROOT):
+    '''
+    Compiled model for a rendered source and include file. Executables are
+    shared between runs with the same source, include, compiler and flags;
+    each is built in a private directory and moved into place, so
+    concurrent runs never see a half-written build.
+    OUTPUT: path of the executable
+    '''
+    key = hashlib.sha256('\0'.join((source_text, include_text, fc, fflags)).encode()).hexdigest()[:16]
+    target = os.path.join(root, key)
+    exe = os.path.join(target, EXE)
+    if os.path.exists(exe):
+        return exe
+    os.makedirs(root, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='.build_', dir=root)
+    try:
+        with open(os.path.join(staging, 'lake.f90'), 'w') as file:
+            file.write(source_text)
+        with open(os.path.join(staging, 'lake.inc'), 'w') as file:
+            file.write(include_text)
+        result = subprocess.run([fc] + fflags.split() + ['-ffree-line-length-none', 'lake.f90', '-o', EXE],
+                                cwd=staging, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError("lake model failed to compile:\n" + result.stderr.strip()[-4000:])
+        try:
+            os.rename(staging, target)
+        except OSError:
+            # another run finished the same build first
+            if not os.path.exists(exe):
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return exe
+
+
+def prepare_run(directory, forcing, lake='Malawi', parameters=None, include=None, source=SOURCE,
+                grid=None):
+    '''
+    Stages a run in directory: the rendered lake.f90 and lake.inc (kept for
+    the record) and a copy of the forcing file.
+    INPUTS:
+    directory:  run directory (created if needed)
+    forcing:    path of the forcing text file
+    lake:       name of the include template in TEMPLATES
+    parameters: dict of parameter values, see render_include
+    include:    path of an include template, instead of lake
+    source:     model source file
+    grid:       layer thicknesses or the path of a grid file (see
+                write_grid); None for the uniform 1 m grid. The layers must
+                add up to depth_begin, wb_flag must be off, and the Tprof
+                output then has one column per layer (see layer_depths)
+    OUTPUT: source text, include text
+    '''
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(ROOT, source)) as file:
+        source_text = render_source(file.read())
+    with open(include or os.path.join(ROOT, TEMPLATES[lake])) as file:
+        include_text = render_include(file.read(), parameters, datafile=FORCING)
+    with open(os.path.join(directory, 'lake.f90'), 'w') as file:
+        file.write(source_text)
+    with open(os.path.join(directory, 'lake.inc'), 'w') as file:
+        file.write(include_text)
+    shutil.copy(forcing, os.path.join(directory, FORCING))
+    if grid is not None:
+        write_grid(os.path.join(directory, GRID), grid)
+    return source_text, include_text
+
+
+def run_model(forcing, lake='Malawi', parameters=None, directory=None, include=None, source=SOURCE,
+              fc='gfortran', fflags='-O2', timeout=None, grid=None, build_root=BUILD_ROOT):
+    '''
+    Runs the lake model once, entirely inside its own directory.
+    INPUTS:
+    forcing:    path of the forcing text file
+    lake:       'Malawi' or 'Tanganyika' (include template)
+    parameters: dict of parameter values (see PARAMETER_NAMES)
+    directory:  run directory; a new one under runs/ by default
+    include, source, fc, fflags, grid: see prepare_run and build
+    build_root: directory of the builds (see build)
+    timeout:    seconds allowed for the model run
+    OUTPUT: see execute
+    '''
+    if directory is None:
+        directory = new_run_dir()
+    source_text, include_text = prepare_run(directory, forcing, lake, parameters, include, source, grid)
+    return execute(build(source_text, include_text, fc, fflags, build_root), directory, timeout)
+
+
+def execute(exe, directory, timeout=None):
+    '''
+    Runs a built model with directory as its working directory, where it
+    finds forcing.txt and writes its outputs and lake.log.
+    OUTPUT: dict with the run directory and the paths of the surf and
+            Tprof outputs and of the log
+    '''
+    log = os.path.join(directory, 'lake.log')
+    with open(log, 'w') as output:
+        result = subprocess.run([exe], cwd=directory, stdout=output, stderr=subprocess.STDOUT,
+                                timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError("lake model exited with status %d, see %s" % (result.returncode, log))
+    return {'directory': directory, 'surf': os.path.join(directory, SURF),
+            'tprof': os.path.join(directory, TPROF), 'log': log}
@@ -0,0 +1,370 @@
+# PRYSM
+# PSM for Lacustrine Sedimentary Archives
+# ENVIRONMENT MODEL: Global sensitivity analysis of the lake parameters
+# Functions 'morris' and 'sobol'
+# Elementary-effects screening (Morris, 1991) and variance-based indices
+# (Saltelli et al., 2010) of lake model outputs such as the mean surface
+# temperature, its seasonal amplitude and the mixing depth. Model runs are
+# cached by their inputs and dispatched in batches to worker processes
+#====================================================================
+
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import lake_run
+from lake_cache import make_key
+from lake_emulator import YEAR_DAYS, read_forcing, read_targets
+
+# Plausible ranges of the continuous parameters of the GUI form
+# (lake_run.PARAMETER_NAMES) that act on temperature and mixing; the
+# isotope parameters (f, o18air, deutair) only act on the isotope outputs.
+# Pass ranges to choose others or narrow these
+DEFAULT_RANGES = {
+    'eta': (0.02, 0.10),          # shortwave extinction coefficient (1/m)
+    'cdrn': (1.0e-3, 2.5e-3),     # neutral drag coefficient
+    'alb_slush': (0.3, 0.5),
+    'alb_snow': (0.5, 0.9),
+    'z_screen': (2., 10.),        # height of the forcing wind and temperature (m)
+    'tempinit': (4., 26.),
+}
+# Parameters that are integers in the include file
+INTEGER_PARAMETERS = ('max_dep', 'depth_begin', 'nspin', 'gmt')
+
+
+def mean_lst(day, tsurf, mixing):
+    return np.mean(tsurf)
+
+
+def seasonal_amplitude(day, tsurf, mixing):
+    '''
+    Range of the mean seasonal cycle (records grouped by month of the year).
+    '''
+    month = np.floor((day % YEAR_DAYS) / (YEAR_DAYS / 12.)).astype(int)
+    cycle = [np.mean(tsurf[month == m]) for m in np.unique(month)]
+    return np.max(cycle) - np.min(cycle)
+
+
+def mean_mixing_depth(day, tsurf, mixing):
+    return np.mean(mixing)
+
+
+OUTPUTS = {'mean_lst': mean_lst, 'seasonal_amplitude': seasonal_amplitude,
+           'mixing_depth': mean_mixing_depth}
+
+
+def scale_design(unit, names, ranges):
+    '''
+    Parameter values of a design in the unit hypercube.
+    OUTPUT: array (nrun, len(names))
+    '''
+    low = np.array([ranges[name][0] for name in names], dtype=float)
+    high = np.array([ranges[name][1] for name in names], dtype=float)
+    values = low + unit * (high - low)
+    for j, name in enumerate(names):
+        if name in INTEGER_PARAMETERS:
+            values[:, j] = np.round(values[:, j])
+    return values
+
+
+def morris_design(k, trajectories=10, levels=4, seed=None):
+    '''
+    Morris trajectories in the unit hypercube: each starts at a random
+    point of the levels-level grid and moves one parameter at a time, in
+    random order, by delta = levels / (2 (levels - 1)).
+    OUTPUT: points (trajectories * (k + 1), k), and for every step the
+            parameter moved and the signed step (trajectories, k) each
+    '''
+    rng = np.random.default_rng(seed)
+    delta = levels / (2. * (levels - 1.))
+    grid = np.arange(levels // 2) / (levels - 1.)  # starts that leave room for +delta
+    points, moved, steps = [], [], []
+    for _ in range(trajectories):
+        start = rng.choice(grid, size=k)
+        sign = rng.choice([-1., 1.], size=k)
+        # a step down starts from the upper half so it stays in [0, 1]
+        x = np.where(sign > 0., start, start + delta)
+        order = rng.permutation(k)
+        path = [x.copy()]
+        for j in order:
+            x[j] += sign[j] * delta
+            path.append(x.copy())
+        points.append(np.array(path))
+        moved.append(order)
+        steps.append(sign[order] * delta)
+    return np.concatenate(points), np.array(moved), np.array(steps)
+
+
+def morris_indices(Y, moved, steps):
+    '''
+    Elementary-effects statistics of one output. Trajectories with a
+    failed run (NaN) are left out.
+    INPUTS:
+    Y:     output of every design point, in design order
+    moved, steps: as returned by morris_design
+    OUTPUT: dict of mu, mu_star and sigma per parameter
+    '''
+    trajectories, k = moved.shape
+    Y = np.asarray(Y, dtype=float).reshape(trajectories, k + 1)
+    keep = ~np.isnan(Y).any(axis=1)
+    effects = np.full((trajectories, k), np.nan)
+    for t in np.flatnonzero(keep):
+        effects[t, moved[t]] = np.diff(Y[t]) / steps[t]
+    effects = effects[keep]
+    return {'mu': effects.mean(axis=0), 'mu_star': np.abs(effects).mean(axis=0),
+            'sigma': effects.std(axis=0, ddof=1) if len(effects) > 1 else np.zeros(k),
+            'trajectories': int(keep.sum())}
+
+
+def sobol_design(k, n, seed=None):
+    '''
+    Saltelli design in the unit hypercube: base samples A and B (n rows
+    each) and, for every parameter i, A with column i taken from B.
+    OUTPUT: points (n * (k + 2), k) ordered A, B, AB_1 ... AB_k
+    '''
+    rng = np.random.default_rng(seed)
+    A = rng.random((n, k))
+    B = rng.random((n, k))
+    blocks = [A, B]
+    for i in range(k):
+        AB = A.copy()
+        AB[:, i] = B[:, i]
+        blocks.append(AB)
+    return np.concatenate(blocks)
+
+
+def sobol_indices(Y, k, resamples=200, seed=None):
+    '''
+    First-order (Saltelli et al., 2010) and total (Jansen, 1999) indices of
+    one output, with bootstrap standard errors. Sample rows with a failed
+    run (NaN) are left out.
+    INPUTS:
+    Y: output of every design point, in the order of sobol_design
+    k: number of parameters
+    OUTPUT: dict of S1, ST and their standard errors S1_se, ST_se
+    '''
+    Y = np.asarray(Y, dtype=float).reshape(k + 2, -1)
+    Y = Y[:, ~np.isnan(Y).any(axis=0)]
+    fA, fB, fAB = Y[0], Y[1], Y[2:]
+
+    def indices(rows):
+        both = np.concatenate((fA[rows], fB[rows]))
+        var = np.var(both)
+        if var == 0.:
+            return np.zeros(k), np.zeros(k)
+        # centring leaves the estimator unbiased but much less noisy for
+        # outputs far from zero, such as temperatures
+        first = np.mean((fB[rows] - both.mean()) * (fAB[:, rows] - fA[rows]), axis=1) / var
+        total = 0.5 * np.mean((fA[rows] - fAB[:, rows]) ** 2, axis=1) / var
+        return first, total
+
+    n = Y.shape[1]
+    S1, ST = indices(np.arange(n))
+    rng = np.random.default_rng(seed)
+    boot = [indices(rng.integers(0, n, n)) for _ in range(resamples)]
+    return {'S1': S1, 'ST': ST, 'S1_se': np.std([b[0] for b in boot], axis=0),
+            'ST_se': np.std([b[1] for b in boot], axis=0), 'samples': n}
+
+
+def model_inputs(forcing, lake, run_options):
+    '''
+    Model source, include template and forcing of a set of runs, the
+    parts of every cache key that are shared (so a changed model or
+    forcing is never read back from the cache).
+    '''
+    with open(os.path.join(lake_run.ROOT, run_options.get('source', lake_run.SOURCE))) as file:
+        source = file.read()
+    with open(run_options.get('include') or os.path.join(lake_run.ROOT, lake_run.TEMPLATES[lake])) as file:
+        include = file.read()
+    return source, include, read_forcing(forcing)
+
+
+def output_name(output):
+    '''
+    Name of an output in a cache key, the same in every session: the name
+    in OUTPUTS, module.qualname of a function, or the str of an object
+    that defines __str__ (as lake_calibrate.Misfit does).
+    '''
+    if isinstance(output, str):
+        return output
+    if type(output).__str__ is not object.__str__:
+        return str(output)
+    if hasattr(output, '__qualname__'):
+        return '%s.%s' % (output.__module__, output.__qualname__)
+    raise TypeError("output %r needs a __str__ that tells it apart in the cache" % (output,))
+
+
+def run_key(inputs, parameters, outputs, run_options):
+    '''
+    Cache key of the outputs of one run: the model inputs (see
+    model_inputs), the parameters, the run options and the outputs.
+    '''
+    # version 2: the mixing depth is in m on any grid
+    return make_key('lake_sensitivity', 2, *inputs, parameters, [output_name(output) for output in outputs],
+                    **run_options)
+
+
+def _run_batch(args):
+    '''
+    Runs a batch of parameter sets one after the other and reduces every
+    run to its outputs; the run directories are removed unless keep. Every
+    parameter set is a different build, so the batch builds in a private
+    directory that is removed afterwards.
+    OUTPUT: list of output arrays (NaN for a failed run)
+    '''
+    forcing, lake, batch, outputs, run_options, keep = args
+    day = read_forcing(forcing)[:, 1]
+    functions = [OUTPUTS[output] if isinstance(output, str) else output for output in outputs]
+    build_root = lake_run.new_run_dir(prefix='build_')
+    results = []
+    try:
+        for parameters in batch:
+            run = None
+            try:
+                run = lake_run.run_model(forcing, lake, parameters, build_root=build_root, **run_options)
+                targets = read_targets(run['surf'], len(day), run_options.get('grid'))
+                results.append(np.array([function(day, targets[:, 0], targets[:, 1])
+                                         for function in functions]))
+            except (RuntimeError, ValueError, OSError, subprocess.SubprocessError):
+                results.append(np.full(len(outputs), np.nan))
+            finally:
+                if run is not None and not keep:
+                    shutil.rmtree(run['directory'], ignore_errors=True)
+    finally:
+        shutil.rmtree(build_root, ignore_errors=True)
+    return results
+
+
+def evaluate(values, names, forcing, lake='Malawi', parameters=None, outputs=tuple(OUTPUTS),
+             cache=None, workers=None, batch=4, keep=False, **run_options):
+    '''
+    Outputs of the model for every row of a design.
+    INPUTS:
+    values:     parameter values (nrun, len(names)), e.g. from scale_design
+    names:      parameter names of the columns
+    forcing:    path of the forcing file
+    lake:       include template (see lake_run.TEMPLATES)
+    parameters: dict of the other parameters to set in every run
+    outputs:    names in OUTPUTS, or picklable functions of (day, tsurf,
+                mixing depth in m), see output_name
+    cache:      lake_cache.DiskCache of earlier runs (None to run all)
+    workers:    worker processes (all cores by default; 1 runs in-process)
+    batch:      runs per task sent to a worker
+    keep:       keep the run directories
+    run_options: grid, fflags... passed to lake_run.run_model
+    OUTPUT: array (nrun, len(outputs)), NaN where a run failed
+    '''
+    outputs = list(outputs)
+    results = np.full((len(values), len(outputs)), np.nan)
+    inputs = model_inputs(forcing, lake, run_options) if cache else None
+    sets, keys, todo = [], [], []
+    for i, row in enumerate(values):
+        run_parameters = dict(parameters or {})
+        for name, value in zip(names, row):
+            run_parameters[name] = int(value) if name in INTEGER_PARAMETERS else float(value)
+        sets.append(run_parameters)
+        keys.append(run_key(inputs, run_parameters, outputs, run_options) if cache else None)
+        stored = cache.get(keys[-1]) if cache else None
+        if stored is not None:
+            results[i] = stored['outputs']
+        else:
+            todo.append(i)
+
+    # identical rows (e.g. rounded integer parameters) run once
+    unique = {}
+    for i in todo:
+        unique.setdefault(repr(sorted(sets[i].items())), []).append(i)
+    groups = list(unique.values())
+    jobs = [(forcing, lake, [sets[group[0]] for group in groups[start:start + batch]], outputs,
+             run_options, keep) for start in range(0, len(groups), batch)]
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(jobs) > 1 else None
+    try:
+        done = pool.map(_run_batch, jobs) if pool else map(_run_batch, jobs)
+        # results are stored as each batch finishes, so an interrupted
+        # analysis restarts from where it stopped
+        for start, batch_results in zip(range(0, len(groups), batch), done):
+            for group, result in zip(groups[start:start + batch], batch_results):
+                results[group] = result
+                if cache and not np.isnan(result).any():
+                    cache.put(keys[group[0]], outputs=result, meta={'parameters': sets[group[0]]})
+    finally:
+        if pool:
+            pool.shutdown()
+    return results
+
+
+def parameter_ranges(names=None, ranges=None):
+    '''
+    Parameter names (all of the ranges by default) and their ranges, with
+    ranges added to DEFAULT_RANGES.
+    '''
+    ranges = dict(DEFAULT_RANGES, **(ranges or {}))
+    names = list(names or sorted(ranges))
+    missing = [name for name in names if name not in ranges]
+    if missing:
+        raise KeyError("no range for parameters %s" % ', '.join(missing))
+    return names, ranges
+
+
+def morris(forcing, lake='Malawi', names=None, ranges=None, trajectories=10, levels=4, seed=None,
+           **options):
+    '''
+    Morris screening of parameters for every output.
+    INPUTS:
+    forcing, lake: see evaluate
+    names:  parameters to screen (default: all of DEFAULT_RANGES)
+    ranges: dict of name -> (low, high), added to DEFAULT_RANGES
+    trajectories, levels, seed: see morris_design
+    options: parameters, outputs, cache, workers, batch... of evaluate
+    OUTPUT: dict with 'names', 'values', 'results' and one dict of
+            indices (see morris_indices) per output
+    '''
+    names, ranges = parameter_ranges(names, ranges)
+    unit, moved, steps = morris_design(len(names), trajectories, levels, seed)
+    values = scale_design(unit, names, ranges)
+    outputs = list(options.pop('outputs', OUTPUTS))
+    results = evaluate(values, names, forcing, lake, outputs=outputs, **options)
+    found = {'names': names, 'values': values, 'results': results}
+    for j, output in enumerate(outputs):
+        # elementary effects per unit of the parameter's range
+        found[output] = morris_indices(results[:, j], moved, steps)
+    return found
+
+
+def sobol(forcing, lake='Malawi', names=None, ranges=None, n=64, seed=None, resamples=200, **options):
+    '''
+    First-order and total Sobol indices of parameters for every output,
+    from n * (len(names) + 2) runs.
+    INPUTS: as morris; n is the base sample size of sobol_design
+    OUTPUT: dict with 'names', 'values', 'results' and one dict of
+            indices (see sobol_indices) per output
+    '''
+    names, ranges = parameter_ranges(names, ranges)
+    values = scale_design(sobol_design(len(names), n, seed), names, ranges)
+    outputs = list(options.pop('outputs', OUTPUTS))
+    results = evaluate(values, names, forcing, lake, outputs=outputs, **options)
+    found = {'names': names, 'values': values, 'results': results}
+    for j, output in enumerate(outputs):
+        found[output] = sobol_indices(results[:, j], len(names), resamples, seed)
+    return found
+
+
+def report(found, outputs=None):
+    '''
+    Table of the indices of a morris or sobol result, one line per
+    parameter and output, most influential first.
+    '''
+    lines = []
+    for output in outputs or [name for name in OUTPUTS if name in found]:
+        indices = found[output]
+        rank = 'mu_star' if 'mu_star' in indices else 'ST'
+        lines.append('%s (%s)' % (output, ', '.join(name for name in indices if name not in
+                                                    ('trajectories', 'samples'))))
+        for j in np.argsort(-np.nan_to_num(indices[rank])):
+            lines.append('  %-12s' % found['names'][j] + ''.join(
+                ' %10.4g' % indices[name][j] for name in indices if name not in ('trajectories', 'samples')))
+    return '\n'.join(lines)
@@ -4,14 +4,23 @@ from tkinter import Canvas, Image, PhotoImage, font
 import tkinter.filedialog as fd
 from tkinter import ttk
 
-# Sensor Model Scripts
-import sensor_carbonate as carb
-import sensor_gdgt as gdgt
-import sensor_leafwax as leafwax
+# Environment Model Scripts
+import lake_run
+import lake_catalog
 
-#Archive Model Scripts
-import lake_archive_bioturb as bio
-import lake_archive_compact as comp
+#Observation Model Scripts
+import lake_obs_bchron as bchron
+import lake_obs_rworker as rworker
+import lake_cache
+
+#Diagnostics
+import lake_diagnostics as diag
+
+#Output reading and date conversion
+from lake_io import get_output_data, convert_to_monthly, convert_to_annual, annual_dates
+
+#Stage graph with cached results
+import lake_pipeline
 
 # Data Analytics
 import pandas as pd
@@ -28,23 +37,13 @@ from statistics import mean
 plt.style.use('seaborn-whitegrid')
 matplotlib.use('TkAgg')  # Necessary for Ma
 
-# Imports for Observation Model
-from rpy2.robjects import FloatVector
-from rpy2.robjects.vectors import StrVector
-import rpy2.robjects as robjects
-from rpy2.robjects.packages import importr
-import rpy2.robjects.numpy2ri
-rpy2.robjects.numpy2ri.activate()
-
 
 #Miscellaneous imports
 import os
 from os.path import basename
 import webbrowser
 import copy
-import subprocess
 import multiprocessing
-from subprocess import PIPE, Popen
 from tkinter.ttk import Label
 from PIL import Image, ImageTk
 from tkinter.filedialog import asksaveasfilename
@@ -72,8 +71,8 @@ def check_float(str):
 
 def initialize_global_variables():
     """
-    Reads global_vars.txt to initialize global variables with pre-existing values
-    from previous runs of the GUI
+    Reads global_vars.txt to initialize global variables with default values
+    (the file is only read; choices made in the GUI are kept in memory)
     """
     with open("global_vars.txt", "r") as start:
         lines = start.readlines()
@@ -94,29 +93,6 @@ def write_to_file(file, data):
     file.writelines(data)
     file.close()
 
-def get_output_data(time, data, column, filename):
-    """
-    Retrieves data from surf.dat from years where lake is at equilibrium
-    Inputs
-    - time: an empty array which is populated with day #'s
-    - data: an empty array which is populated with a certain column of data from surf.dat
-    - column: the specific column of data in surf.dat which should populate "data"
-    - filename: the file which contains the desired data
-    """
-    with open(filename) as file:
-        lines = file.readlines()
-        cur_row = lines[len(lines) - 1].split()
-        next_row = lines[len(lines) - 2].split()
-        i = 2
-        while int(float(cur_row[0])) > int(float(next_row[0])):
-            data.insert(0, float(cur_row[column]))
-            time.insert(0, int(float(cur_row[0])))
-            cur_row = copy.copy(next_row)
-            i += 1
-            next_row = lines[len(lines) - i].split()
-        data.insert(0, float(cur_row[column]))
-        time.insert(0, int(float(cur_row[0])))
-
 def uploadTxt(type, frame, file_label, sample=None, file_types=None):
     """
     Allows the user to upload sample data or data of their own choice
@@ -174,81 +150,38 @@ def plot_draw(frame, axes, figure, title, x_axis, y_axis, x_data, y_data, plot_t
     - error_lines: an array with 2 values that demarcates the CI, None if no CI is necessary for plot
     - overlay: indicates whether this plot should be overlaid on pre-existing plots, False by default
     """
-    canvas = FigureCanvasTkAgg(figure, frame)
-    canvas.get_tk_widget().grid(row=1, column=3, rowspan=16, columnspan=15, sticky="nw")
-    if not overlay:
-        plt.cla()
-    axes.set_title(title)
-    axes.set_xlabel(x_axis)
-    axes.set_ylabel(y_axis)
-    i = 0
-    for line in y_data:
-        if "normal" in plot_type:
-            if "monthly" in plot_type:
-                date_format = mdates.DateFormatter('%b,%Y')
-                axes.xaxis.set_major_formatter(date_format)
-                axes.plot_date(x_data, line, linestyle="solid", color=colors[i], linewidth=widths[i], label=labels[i],
-                               marker=None)
-            elif "month-only" in plot_type:
-                date_format = mdates.DateFormatter('%b')
-                axes.xaxis.set_major_formatter(date_format)
-                axes.plot_date(x_data, line, linestyle="solid", color=colors[i], linewidth=widths[i], label=labels[i])
-            elif "non-month" in plot_type:
-                axes.plot(x_data, line, linestyle="solid", color=colors[i], linewidth=widths[i], label=labels[i])
-            else:
-                axes.plot_date(x_data, line, linestyle="solid", color=colors[i], linewidth=widths[i], label=labels[i])
-        if "scatter" in plot_type:
-            axes.scatter(x_data, line, color=colors[i])
-            pass
-        i += 1
-    if error_lines != None:
-        axes.fill_between(x_data, error_lines[0], error_lines[1], facecolor='grey', edgecolor='none', alpha=0.20)
-    axes.legend()
-
+    with diag.span("plotting", items=sum(len(line) for line in y_data), title=title):
+        canvas = FigureCanvasTkAgg(figure, frame)
+        canvas.get_tk_widget().grid(row=1, column=3, rowspan=16, columnspan=15, sticky="nw")
+        if not overlay:
+            plt.cla()
+        axes.set_title(title)
+        axes.set_xlabel(x_axis)
+        axes.set_ylabel(y_axis)
+        i = 0
+        for line in y_data:
+            if "normal" in plot_type:
+                if "monthly" in plot_type:
+                    date_format = mdates.DateFormatter('%b,%Y')
+                    axes.xaxis.set_major_formatter(date_format)
+                    axes.plot_date(x_data, line, linestyle="solid", color=colors[i], linewidth=widths[i], label=labels[i],
+                                   marker=None)
+                elif "month-only" in plot_type:
+                    date_format = mdates.DateFormatter('%b')
+                    axes.xaxis.set_major_formatter(date_format)
+                    axes.plot_date(x_data, line, linestyle="solid", color=colors[i], linewidth=widths[i], label=labels[i])
+                elif "non-month" in plot_type:
+                    axes.plot(x_data, line, linestyle="solid", color=colors[i], linewidth=widths[i], label=labels[i])
+                else:
+                    axes.plot_date(x_data, line, linestyle="solid", color=colors[i], linewidth=widths[i], label=labels[i])
+            if "scatter" in plot_type:
+                axes.scatter(x_data, line, color=colors[i])
+                pass
+            i += 1
+        if error_lines != None:
+            axes.fill_between(x_data, error_lines[0], error_lines[1], facecolor='grey', edgecolor='none', alpha=0.20)
+        axes.legend()
 
-def convert_to_monthly(time, start=None):
-    """
-    Converts timeseries x-axis into monthly units with proper labels
-    Input:
-    - time: an array of day numbers (15, 45, 75, etc.)
-    """
-    start_date = None
-    if start==None:
-        global START_YEAR
-        start_date = dt.date(START_YEAR, 1, 1)
-    else:
-        start_date = dt.date(start, 1, 1)
-    dates = []
-    for day in time:
-        new_date = start_date + dt.timedelta(days=day-1)
-        dates.append(new_date)
-    return dates
-
-def convert_to_annual(data, start=None):
-    """
-    Converts timeseries data into annually averaged data with proper axis labels
-    Input:
-    - data: the y-axis of the timeseries data
-    """
-    start_date = None
-    if start==None:
-        global START_YEAR
-        start_date = dt.date(START_YEAR-1, 7, 2)
-    else:
-        start_date = dt.date(start - 1, 7, 2)
-    all_year_avgs = []
-    for column in data:
-        years = []
-        year_data = []
-        year_avgs = []
-        for i in range(len(column)):
-            year_data.append(column[i])
-            if (i + 1) % 12 == 0:
-                year_avgs.append(mean(year_data))
-                years.append(start_date+dt.timedelta(days=365*((i+1)/12)))
-                year_data.clear()
-        all_year_avgs.append(year_avgs)
-    return years, all_year_avgs
 
 #================GLOBAL VARIABLES==================================================
 TITLE_FONT = ("Courier New", 43) #43
@@ -259,7 +192,13 @@ f_slant = ("Consolas", 12, "italic") #12
 START_YEAR = None
 INPUT = None
 PARAMETERS = []
+# directory of the last lake model run (None before the first run)
+RUN_DIR = None
 initialize_global_variables()
+# results of the pipeline stages, kept on disk between sessions
+PIPELINE = lake_pipeline.default_pipeline(lake_cache.DiskCache())
+# parameter presets, templates and forcings of the lakes (lakes.json)
+CATALOG = lake_catalog.LakeCatalog.load()
 
 """
 Creates a GUI object
@@ -284,7 +223,7 @@ class SampleApp(tk.Tk):
         self.frames = {}
         self.pages = [StartPage, PageEnvModel, PageEnvTimeSeries, PageEnvSeasonalCycle,
                       PageCarbonate, PageGDGT, PageLeafwax, PageObservation, PageBioturbation,
-                      PageCompaction]
+                      PageCompaction, PageDiagnostics]
         for F in self.pages:
             page_name = F.__name__
             frame = F(parent=self)
@@ -292,7 +231,7 @@ class SampleApp(tk.Tk):
 
         self.show_frame(["StartPage", "PageEnvModel", "PageEnvTimeSeries", "PageEnvSeasonalCycle",
                          "PageCarbonate","PageGDGT","PageLeafwax", "PageObservation", "PageBioturbation",
-                         "PageCompaction"], "StartPage")
+                         "PageCompaction", "PageDiagnostics"], "StartPage")
 
         self.protocol('WM_DELETE_WINDOW', self.close_app)
 
@@ -406,11 +345,11 @@ class StartPage(tk.Frame):
 
         buttonText = ["Run Lake Environment Model", "Plot Environment Time Series", "Plot Environment Seasonal Cycle",
                       "Run Carbonate Model", "Run GDGT Model", "Run Leafwax Model", "Run Observation Model",
-                      "Run Bioturbation Model", "Run Compaction Model"]
+                      "Run Bioturbation Model", "Run Compaction Model", "Pipeline Diagnostics"]
 
         pageNames = ["PageEnvModel", "PageEnvTimeSeries", "PageEnvSeasonalCycle",
                      "PageCarbonate", "PageGDGT", "PageLeafwax", "PageObservation", "PageBioturbation",
-                     "PageCompaction"]
+                     "PageCompaction", "PageDiagnostics"]
 
         for i in range(len(buttonText)):
             page = pageNames[i]
@@ -445,6 +384,7 @@ class PageEnvModel(tk.Frame):
 
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
+        self.lake = "Tanganyika"  # include file template the parameters are applied to
         self.populate()
         self.pack(fill="both", expand=True)
 
@@ -553,7 +493,7 @@ class PageEnvModel(tk.Frame):
 
         # Submit entries for .inc file
         submitButton = tk.Button(self.scrollable_frame, text="Save Parameters", font=f,
-                                 command=lambda: self.editInc([p.get() for p in param_values], parameters))
+                                 command=lambda: self.editInc([p.get() for p in param_values]))
         submitButton.grid(row=rowIdx, column=0, padx=1120, ipadx=30, ipady=3, sticky="W")
         rowIdx += 1
 
@@ -588,40 +528,12 @@ class PageEnvModel(tk.Frame):
         # Open the file choosen by the user
         self.txtfilename = fd.askopenfilename(
             filetypes=(('text files', 'txt'),))
+        if self.txtfilename == "":
+            return
+        # Each run copies this file into its own directory, so nothing shared is edited
         global INPUT
         INPUT = self.txtfilename
-        with open("global_vars.txt", "r+") as vars:
-            new = vars.readlines()
-            new[0] = INPUT + "\n"
-            write_to_file(vars, new)
-
-        base = basename(self.txtfilename)
-        nonbase = (self.txtfilename.replace("/", "\\")).replace(base, '')[:-1]
-        self.currentTxtFileLabel.configure(text=base)
-
-        # Modify the Fortran code to read the input text file
-        with open("env_heatflux.f90", "r+") as f:
-            new = f.readlines()
-            if self.txtfilename != "":
-                if nonbase == os.getcwd():
-                    new[19] = "      !data_input_filename = '" + base + "'\n"
-                else:
-                    new[19] = "      !data_input_filename = '" + self.txtfilename + "'\n"
-            write_to_file(f, new)
-
-        # Modify the include file to read the input text file
-        with open("Malawi.inc", "r+") as f:
-            new = f.readlines()
-            if self.txtfilename != "":
-                if nonbase == os.getcwd():
-                    new[
-                        55] = "      character(38) :: datafile='" + base + "' ! the data file to open in FILE_OPEN subroutine\n"
-                    new[56] = "      character(38) :: datafile='" + base + "'\n"
-                else:
-                    new[
-                        55] = "      character(38) :: datafile='" + self.txtfilename + "' ! the data file to open in FILE_OPEN subroutine\n"
-                    new[56] = "      character(38) :: datafile='" + self.txtfilename + "'\n"
-            write_to_file(f, new)
+        self.currentTxtFileLabel.configure(text=basename(self.txtfilename))
 
     """
     Checks if any parameter value is invalid
@@ -648,63 +560,50 @@ class PageEnvModel(tk.Frame):
                     return False
         global START_YEAR
         START_YEAR = int(parameters[28])
-        with open("global_vars.txt", "r+") as vars:
-            new = vars.readlines()
-            new[1] = str(START_YEAR)
-            write_to_file(vars, new)
         return True
 
     """
-    Edits the parameters in the .inc file based on user input
+    Saves the parameters for the next model run (they are applied to a copy of the
+    .inc file in the run's own directory)
 
     Inputs: 
     - parameters: the values for the model parameters
-    - comments: the comments in the Fortran code associated with each parameter
     """
 
-    def editInc(self, parameters, comments):
+    def editInc(self, parameters):
         if not self.validate_params(parameters):
             return
-        with open("Malawi.inc", "r+") as f:
-            new = f.readlines()
-            # names of the parameters that need to be modified
-            names = ["oblq", "xlat", "xlon", "gmt", "max_dep", "basedep", "b_area", "cdrn", "eta", "f", "alb_slush",
-                     "alb_snow", "depth_begin", "salty_begin", "o18air", "deutair", "tempinit", "deutinit", "o18init",
-                     "nspin", "bndry_flag", "sigma", "wb_flag", "iceflag", "s_flag", "o18flag", "deutflag", "z_screen"]
-            # line numbers in the .inc file that need to be modified
-            rows = [28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 41, 42, 44, 45, 57, 58, 59, 62, 63, 64, 65, 66, 67,
-                    68, 69, 70]
-            global PARAMETERS
-            PARAMETERS = copy.copy(parameters)
-            for i in range(len(parameters) - 1):
-                if len(str(parameters[i])) != 0:
-                    comments[i] = comments[i].replace("\u0394", "D")
-                    comments[i] = comments[i].replace("¹⁸", "18")
-                    comments[i] = comments[i].replace("Check Mark", "true")
-                    comments[i] = comments[i].replace("\n","")
-                    if i == 20 or (i > 21 and i < 27):
-                        if parameters[i] == 1:
-                            new[rows[i]] = "      parameter (" + names[i] + " = .true.)   ! " + comments[i] + "\n"
-                        else:
-                            new[rows[i]] = "      parameter (" + names[i] + " = .false.)   ! " + comments[i] + "\n"
-                    else:
-                        new[rows[i]] = "      parameter (" + names[i] + " = " + parameters[i] + ")   ! " + comments[i] + "\n"
-            write_to_file(f, new)
+        global PARAMETERS
+        PARAMETERS = copy.copy(parameters)
 
     """
-    Fills in parameter values with either Malawi or Tanganyika parameters
+    Converts the saved form values into parameters for lake_run
+
+    Inputs:
+    - parameters: the values for the model parameters, in the order of lake_run.PARAMETER_NAMES
+    Returns:
+    - dict of parameter name and value; empty values keep the .inc file's value
+    """
+
+    def run_parameters(self, parameters):
+        values = {}
+        for i, name in enumerate(lake_run.PARAMETER_NAMES):
+            if i >= len(parameters):
+                break
+            if i == 20 or (i > 21 and i < 27):
+                values[name] = parameters[i] == 1
+            else:
+                values[name] = str(parameters[i])
+        return values
+
+    """
+    Fills in parameter values with the parameters of a lake in the catalog (e.g. Malawi or Tanganyika)
     """
 
     def fill(self, lake, containers):
-        if lake == "Malawi":
-            values = ["23.4", "-12.11", "34.22", "+3", "292", "468.", "2960000.",
-                      "1.7e-3", "0.04", "0.1", "0.4", "0.7", "292", "0.0", "-28.",
-                      "-190.", "-4.8", "-96.1", "-11.3", "10", 0, "0.96", 0, 1,
-                      0, 0, 0, "5.0", "1979"]
-        elif lake=="Tanganyika":
-            values = ["23.4", "-6.30", "29.5", "+3", "999", "733.", "23100000.",
-                      "2.0e-3", "0.065", "0.3", "0.4", "0.7", "570", "0.0", "-14.0", "-96.",
-                      "23.0", "24.0", "3.7", "10", 0, "0.9925561", 0, 0, 0, 0, 0, "5.0", "1979"]
+        if lake in CATALOG.sites:
+            self.lake = lake
+            values = CATALOG.form_values(lake)
         elif lake=="Refill":
             values = copy.copy(PARAMETERS)
         else:
@@ -726,9 +625,19 @@ class PageEnvModel(tk.Frame):
     """
 
     def runModel(self, btn):
+        global RUN_DIR
+        forcing = (INPUT or "").replace("\n", "")
+        if not os.path.exists(forcing):
+            tk.messagebox.showerror(title="Run Lake Model", message="Upload a .txt file with the input data first")
+            return
         btn["state"]="disabled"
-        model_process = multiprocessing.Process(target=self.computeModel)
-        model_process.start()
+        # every run gets its own directory, so several runs can proceed side by side
+        self.run_dir = RUN_DIR = lake_run.new_run_dir()
+        self.model_process = multiprocessing.Process(target=self.computeModel,
+                                                     args=(self.run_dir, forcing, self.lake,
+                                                           self.run_parameters(PARAMETERS)))
+        self.model_process.start()
+        self.parent.after(1000, lambda: self.check_model(btn))
         """
         pbar = ttk.Progressbar(self, orient="horizontal", length=100, mode="indeterminate")
         pbar.grid(row=30,column=1, sticky="W")
@@ -739,19 +648,43 @@ class PageEnvModel(tk.Frame):
 
 
     """
-    Compiles a Fortran wrapper and runs the model
+    Compiles and runs the model in its run directory
     """
 
-    def computeModel(self):
-        # Runs f2py terminal command then (hopefully) terminates (takes a bit)
-        subprocess.run(
-            ['f2py', '-c', '-m', 'lakepsm', 'env_heatflux.f90'])
+    def computeModel(self, directory, forcing, lake, parameters):
+        diag.RECORDER.clear()
+        try:
+            # the lake's include template from the catalog
+            template = CATALOG.site(lake)["include"] if lake in CATALOG.sites else None
+            source, include = lake_run.prepare_run(directory, forcing, lake, parameters, include=template)
+            with diag.span("model compile", children=True):
+                exe = lake_run.build(source, include)
+            with diag.span("model run", children=True, directory=basename(directory)):
+                lake_run.execute(exe, directory)
+        except Exception as err:
+            with open(os.path.join(directory, "lake.log"), "a") as log:
+                log.write(str(err) + "\n")
+            raise
+        finally:
+            # the GUI merges these once this process exits
+            diag.RECORDER.save(os.path.join(directory, diag.MODEL_SPANS))
 
-        # imports the wrapper
-        import lakepsm
+    """
+    Collects the timings of the model process once it exits
+    """
 
-        # Run Environment Model (Crashes eventually)
-        lakepsm.lakemodel()
+    def check_model(self, btn):
+        if self.model_process.is_alive():
+            self.parent.after(1000, lambda: self.check_model(btn))
+            return
+        diag.RECORDER.merge(os.path.join(self.run_dir, diag.MODEL_SPANS))
+        if btn.winfo_exists():
+            btn["state"]="normal"
+        if self.model_process.exitcode != 0:
+            tk.messagebox.showerror(title="Run Lake Model", message="The lake model failed, see " +
+                                    os.path.join(self.run_dir, "lake.log"))
+        else:
+            tk.messagebox.showinfo("Success", "Model output written to " + self.run_dir)
 
     def check_file(self, file, past_size, progress, btn):
         current_size = os.path.getsize(file)
@@ -766,7 +699,10 @@ class PageEnvModel(tk.Frame):
     Downloads 'surface_output.dat' as a CSV to the user's desired location
     """
     def download_csv(self):
-        read_file = pd.read_csv("ERA-HIST-Tlake_surf.dat")
+        if RUN_DIR is None or not os.path.exists(os.path.join(RUN_DIR, lake_run.SURF)):
+            tk.messagebox.showerror(title="Download CSV", message="Run the lake model first")
+            return
+        read_file = pd.read_csv(os.path.join(RUN_DIR, lake_run.SURF))
         export_file_path = fd.asksaveasfilename(defaultextension='.csv')
         read_file.to_csv(export_file_path, index=None)
 
@@ -891,11 +827,11 @@ class PageEnvTimeSeries(tk.Frame):
 
         get_output_data(self.days, self.yaxis, column, self.txtfilename)
 
-        self.months = convert_to_monthly(self.days)
+        self.months = convert_to_monthly(self.days, START_YEAR)
         plot_draw(self.scrollable_frame, self.axis, self.f, varstring + " over Time", "Month", varstring, self.months, [self.yaxis],
                   "normal monthly", ["#b22222"], [1], ["Monthly Data"])
 
-        self.years, self.yaxes = convert_to_annual([self.yaxis])
+        self.years, self.yaxes = convert_to_annual([self.yaxis], START_YEAR)
         plot_draw(self.scrollable_frame, self.axis, self.f, varstring + " over Time", "Year", varstring, self.years, self.yaxes,
                   "normal", ["#000000"], [3], ["Annually Averaged Data"], overlay=True)
 
@@ -1163,18 +1099,19 @@ class PageCarbonate(tk.Frame):
     """
 
     def generate_graph(self):
-        surf_tempr = []
-        self.days = []
-        get_output_data(self.days, surf_tempr, 1, self.txtfilename)
-        self.LST = np.array(surf_tempr, dtype=float)
         self.d180w = -2
-        self.carb_proxy = carb.carb_sensor(self.LST, self.d180w, model=self.model.get())
-
-        self.months = convert_to_monthly(self.days)
+        # switching the calibration recomputes the sensor only, not the model output
+        settings = {"surf_file": {"path": self.txtfilename},
+                    "carbonate": {"model": self.model.get(), "d18Ow": self.d180w}}
+        result = PIPELINE.run("carbonate", settings, using={"env": "surf_file"})
+        self.days = result["days"].tolist()
+        self.carb_proxy = result["proxy"]
+
+        self.months = convert_to_monthly(self.days, START_YEAR)
         plot_draw(self.scrollable_frame, self.axis, self.f, "SENSOR", "Month", "Simulated Carbonate Data", self.months, [self.carb_proxy],
                   "normal monthly", ["#b22222"], [1], ["Monthly Data"])
 
-        self.years, self.yaxis = convert_to_annual([self.carb_proxy])
+        self.years, self.yaxis = convert_to_annual([self.carb_proxy], START_YEAR)
         plot_draw(self.scrollable_frame, self.axis, self.f, "SENSOR", "Year", "Simulated Carbonate Data", self.years, self.yaxis,
                   "normal", ["#000000"], [3], ["Annually Averaged Data"], overlay=True)
         
@@ -1290,35 +1227,20 @@ class PageGDGT(tk.Frame):
     """
 
     def generate_graph(self):
-        surf_tempr = []
-        self.days = []
-        get_output_data(self.days, surf_tempr, 1, self.txtfilename)
-        self.LST = np.array(surf_tempr, dtype=float)
-
-        # unchanged
-        climate_input = INPUT.replace("\n", "")
-        air_tempr = []
-        if "MBT" in self.model.get():
-            with open(climate_input, 'r') as data:
-                self.days = []
-                airtemp_yr = []
-                for line in data:
-                    line_vals = line.split()
-                    airtemp_yr.append(line_vals[2])
-                    self.days.append(int(float((line_vals[1]))))
-                air_tempr.append(airtemp_yr)
-            air_tempr = np.array(air_tempr[0], dtype=float)
-
-        self.MAAT = air_tempr
         self.beta = 1. / 50.
-        self.gdgt_proxy = gdgt.gdgt_sensor(self.LST, self.MAAT, self.beta, model=self.model.get())
-
-        self.months = convert_to_monthly(self.days)
+        # the MBT calibrations use the air temperature of the climate input
+        settings = {"surf_file": {"path": self.txtfilename},
+                    "gdgt": {"model": self.model.get(), "beta": self.beta, "forcing": INPUT.replace("\n", "")}}
+        result = PIPELINE.run("gdgt", settings, using={"env": "surf_file"})
+        self.days = result["days"].tolist()
+        self.gdgt_proxy = result["proxy"]
+
+        self.months = convert_to_monthly(self.days, START_YEAR)
         plot_draw(self.scrollable_frame, self.axis, self.f, "SENSOR", "Month", "Simulated GDGT Data", self.months,
                   [self.gdgt_proxy],
                   "normal monthly", ["#b22222"], [1], ["Monthly Data"])
 
-        self.years, self.yaxis = convert_to_annual([self.gdgt_proxy])
+        self.years, self.yaxis = convert_to_annual([self.gdgt_proxy], START_YEAR)
         plot_draw(self.scrollable_frame, self.axis, self.f, "SENSOR", "Year", "Simulated GDGT Data", self.years,
                   self.yaxis,
                   "normal", ["#000000"], [3], ["Annually Averaged Data"], overlay=True)
@@ -1448,7 +1370,6 @@ class PageLeafwax(tk.Frame):
             tk.messagebox.showerror(title="Run Leafwax Model", message="Year must be a positive integer value")
             return
         start_year = int(start_year)
-        self.dDp = np.loadtxt(self.txtfilename)
         self.fC_3 = 0.7  # fraction of C3 plants
         self.fC_4 = 0.3  # fraction of C4 plants
         self.eps_c3 = -112.8  # pm 34.7
@@ -1458,21 +1379,20 @@ class PageLeafwax(tk.Frame):
         self.eps_c3_err = 34.7
         self.eps_c4_err = 28.2
 
-        self.leafwax_proxy = leafwax.wax_sensor(self.dDp, self.fC_3, self.fC_4, self.eps_c3, self.eps_c4)
-
-        # add uncertainties in apparent fractionation via monte-carlo resampling process:
-        self.delta_d_wax_mc, self.Q1, self.Q2 = leafwax.wax_uncertainty(self.dDp, self.fC_3, self.fC_4, self.eps_c3,
-                                                                        self.eps_c4, self.eps_c3_err, self.eps_c4_err)
+        # add uncertainties in apparent fractionation via monte-carlo resampling process
+        # (seeded, so the same settings give the same, cached, realizations):
+        settings = {"leafwax": {"dDp": self.txtfilename, "fC_3": self.fC_3, "fC_4": self.fC_4, "eps_c3": self.eps_c3,
+                                "eps_c4": self.eps_c4, "eps_c3_err": self.eps_c3_err, "eps_c4_err": self.eps_c4_err}}
+        result = PIPELINE.run("leafwax", settings)
+        self.leafwax_proxy = result["proxy"]
         # where Q1 is the 2.5th percentile, Q2 is the 97.5th percentile of the 1000 MC realizations
-        self.days = []
-        with open(self.txtfilename) as input:
-            for i in range(len(input.readlines())):
-                self.days.append(30 * i + 15)
-        self.months = convert_to_monthly(self.days, start=start_year)
+        self.Q1, self.Q2 = result["q1"], result["q2"]
+        self.days = result["days"].tolist()
+        self.months = convert_to_monthly(self.days, start_year)
         plot_draw(self.scrollable_frame, self.axis, self.f, "SENSOR", "Month", "Simulated Leaf Wax Data", self.months, [self.leafwax_proxy],
                   "normal monthly", ["#b22222"], [1], ["Monthly Data"])
 
-        self.years, self.leafwax_array = convert_to_annual([self.leafwax_proxy, self.Q1, self.Q2], start=start_year)
+        self.years, self.leafwax_array = convert_to_annual([self.leafwax_proxy, self.Q1, self.Q2], start_year)
         plot_draw(self.scrollable_frame, self.axis, self.f, "SENSOR", "Year", "Simulated Leaf Wax Data", self.years, [self.leafwax_array[0]],
                   "normal", ["#000000"], [3], ["Annually Averaged Data"], error_lines=self.leafwax_array[1:], overlay=True)
 
@@ -1567,6 +1487,14 @@ class PageObservation(tk.Frame):
         plot_setup(self.scrollable_frame, self.axis, self.f, "Observation Model", "Age (cal years BP)", "Depth in Core (cm)")
 
 
+        self.cache = lake_cache.DiskCache()
+        self.engine = tk.StringVar()
+        self.engine.set("Native (NumPy)")
+        for name in ["Native (NumPy)", "Bchron (R)"]:
+            tk.Radiobutton(self.scrollable_frame, text=name, value=name, font=MED_FONT, variable=self.engine).grid(
+                row=rowIdx, column=0, pady=1, ipadx=20, ipady=5, sticky="W")
+            rowIdx += 1
+
         tk.Button(self.scrollable_frame, text="Graph Observation Model", font=MED_FONT, command=lambda: self.generate_graph()).grid(
             row=rowIdx, column=0, pady=1,
             ipadx=20, ipady=5, sticky="W")
@@ -1590,14 +1518,6 @@ class PageObservation(tk.Frame):
     """
 
     def generate_graph(self):
-        # R packages
-        utils = importr("utils")
-        utils.chooseCRANmirror(ind=1)
-        packnames = ('Bchron', 'stats', 'graphics')
-        utils.install_packages(StrVector(packnames))
-        Bchron = importr('Bchron')
-        r = robjects.r
-
         # Read in the data (csv file must be in the same directory as executable)
         data = np.genfromtxt(self.txtfilename, delimiter=',', names=True, dtype=None)
         year = data['AGE']
@@ -1606,32 +1526,67 @@ class PageObservation(tk.Frame):
         calCurves = np.repeat('normal', len(year))
         nyears = year[-1]
         d = depth[-1]
-        ages = FloatVector(year)
-        sd = FloatVector(sds)
-        positions = FloatVector(depth)
-        calCurves = StrVector(calCurves)
-        predictPositions = r.seq(0, d, by=d / nyears)
+        predictPositions = np.arange(0, d + d / nyears / 2, d / nyears)
         extractDate = year[0]
 
+        # Re-opening a core that was already dated reads the result from disk
+        self.dated = (year, depth)
+        # a pending R job is superseded by this request
+        self.job = None
+        engine = "r" if self.engine.get() == "Bchron (R)" else "native"
+        self.key = bchron.age_model_key(year, sds, depth, calCurves, predictPositions, extractDate, engine=engine)
+        self.ages = self.cache.get(self.key)
+        if self.ages is not None:
+            self.plot_chrons(self.ages['quantiles'], self.ages['predictPositions'])
+            return
+
+        # Runs the actual model
+        if engine == "r":
+            # Runs in the background R worker; the GUI keeps responding
+            self.worker = rworker.get_worker()
+            stage = diag.RECORDER.start("bchron", items=len(predictPositions), engine=engine)
+            self.job = self.worker.submit(year, sds, depth, calCurves, predictPositions, extractDate)
+            self.after(500, self.check_r_job, self.job, self.key, stage)
+        else:
+            with diag.span("bchron", items=len(predictPositions), engine=engine):
+                result = bchron.bchronology_summary(ages=year, ageSds=sds, positions=depth, calCurves=calCurves,
+                                                    predictPositions=predictPositions, extractDate=extractDate)
+            self.ages = bchron.store_age_model(self.cache, self.key, result)
+            self.plot_chrons(self.ages['quantiles'], self.ages['predictPositions'])
+
+    """
+    Collects the result of a background R job once it is done; the result
+    of a job superseded by a later request is cached but not plotted
+    """
 
-        # Runs the actual model (takes several minutes)
-        self.ages = Bchron.Bchronology(ages=ages, ageSds=sd, positions=positions,
-                          calCurves=calCurves, predictPositions=predictPositions, extractDate=extractDate)
+    def check_r_job(self, job, key, stage):
+        try:
+            done, result = self.worker.poll(job)
+        except RuntimeError as err:
+            stage.stop(error=str(err))
+            if job == self.job:
+                tk.messagebox.showerror(title="Bchron (R)", message=str(err))
+            return
+        if not done:
+            self.after(500, self.check_r_job, job, key, stage)
+            return
+        stage.stop()
+        ages = bchron.store_age_model(self.cache, key, result)
+        if job == self.job:
+            self.ages = ages
+            self.plot_chrons(self.ages['quantiles'], self.ages['predictPositions'])
 
+    def plot_chrons(self, quantiles, predictPositions):
         # Creating arrays for plotting
-        thetaPredict = self.ages[4]
-        thetaPredict = np.array(thetaPredict)
-        depths = np.array(predictPositions)
-        self.depth_horizons = depths[:-1]
-        chrons = thetaPredict[:, :-1]
-        self.chronsQ = np.quantile(chrons.transpose(), [0.025, 0.5, 0.975], axis=1)
+        self.depth_horizons = predictPositions[:-1]
+        self.chronsQ = quantiles[:, :-1]
 
         # Actual Plotting
         self.axis.fill_betweenx(self.depth_horizons, self.chronsQ[0], self.chronsQ[2],
                           facecolor='Silver', edgecolor='Silver', lw=0.0) # horizontal fill between 2.5% - 97.5% of data
 
         self.axis.plot(self.chronsQ[1], self.depth_horizons, color="black", lw=0.75) # median line
-        self.axis.scatter(data['AGE'], data['DP'], marker="s") # squares
+        self.axis.scatter(self.dated[0], self.dated[1], marker="s") # squares
         self.axis.legend(['Median', '95% CI', 'Dated Positions'])
         self.axis.invert_xaxis()
         self.axis.invert_yaxis()
@@ -1799,22 +1754,25 @@ class PageBioturbation(tk.Frame):
         return True
 
     def run_bioturb_model(self, params):
-        # check whether csv file can be opened
-        try:
-            pseudoproxy = pd.read_csv(self.txtfilename)["Pseudoproxy"]
-        except:
-            tk.messagebox.showerror(title="Run Bioturbation Model", message="Error with reading csv file")
-
-        year = []
-        self.days, self.iso = convert_to_annual([pseudoproxy])
         if not self.validate_params(params):
             return
         self.age = int(params[1]) - int(params[0])
-        self.mxl = np.ones(self.age) * float(params[2])
-        self.abu = np.ones(self.age) * float(params[3])
         self.numb = int(params[4])
-        # Run the bioturbation model
-        self.oriabu, self.bioabu, self.oriiso, self.bioiso = bio.bioturbation(self.abu, self.iso[0], self.mxl, self.numb)
+        # Run the bioturbation model on the annual means of the csv file; changing a
+        # parameter reruns the bioturbation only
+        settings = {"proxy_csv": {"path": self.txtfilename},
+                    "bioturbation": {"start": int(params[0]), "end": int(params[1]), "mxl": float(params[2]),
+                                     "abundance": float(params[3]), "carriers": self.numb}}
+        using = {"sensor": "proxy_csv"}
+        # check whether csv file can be opened
+        try:
+            result = PIPELINE.run("bioturbation", settings, using)
+        except (OSError, KeyError, pd.errors.ParserError):
+            tk.messagebox.showerror(title="Run Bioturbation Model", message="Error with reading csv file")
+            return
+        self.days = annual_dates(len(PIPELINE.run("annual", settings, using)["proxy"]), START_YEAR)
+        self.oriabu, self.bioabu, self.oriiso, self.bioiso = [result[name] for name in
+                                                              ("oriabu", "bioabu", "oriiso", "bioiso")]
 
         # Plot the bioturbation model
         self.bio1 = self.bioiso[:, 0]
@@ -1922,7 +1880,8 @@ class PageCompaction(tk.Frame):
         sbar = float(params[0])
         year = int(params[1])
         phi_0 = float(params[2])
-        self.z, self.phi, self.h, self.h_prime = comp.compaction(sbar, year, phi_0)
+        result = PIPELINE.run("compaction", {"compaction": {"sbar": sbar, "years": year, "phi_0": phi_0}})
+        self.z, self.phi, self.h, self.h_prime = [result[name] for name in ("z", "phi", "h", "h_prime")]
         plot_draw(self.scrollable_frame, self.axis[0], self.f, "Porosity ($\phi$) Profile in Sediment Core", "Depth (m)",
                   r'Porosity Profile ($\phi$) (unitless)', self.z, [self.phi],
                   "normal non-month", ["#000000"], [3], ["Porosity Profile"])
@@ -1945,6 +1904,109 @@ class PageCompaction(tk.Frame):
             tk.messagebox.showinfo("Sucess", "Saved graph")
 
 
+"""
+Page showing how long each pipeline stage took and how much memory it used
+"""
+
+
+class PageDiagnostics(tk.Frame):
+
+    def __init__(self, parent, *args, **kwargs):
+        super().__init__(parent, *args, **kwargs)
+        self.parent = parent
+        canvas = tk.Canvas(self, bg="white", bd=50)
+        scrollbar = ttk.Scrollbar(self, orient="vertical", command=canvas.yview)
+        s = ttk.Style()
+        s.configure('new.TFrame', background='#FFFFFF')
+        self.scrollable_frame = ttk.Frame(canvas, style='new.TFrame')
+
+        self.scrollable_frame.bind(
+            "<Configure>",
+            lambda e: canvas.configure(
+                scrollregion=canvas.bbox("all")
+            )
+        )
+
+        canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
+
+        canvas.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+        self.populate()
+        self.pack(fill="both", expand=True)
+
+    def populate(self):
+        # Title
+        label = tk.Label(
+            self.scrollable_frame, text="Pipeline Diagnostics", font=LARGE_FONT)
+        label.grid(sticky="W", columnspan=3, pady=(1, 20))
+
+        tk.Label(self.scrollable_frame, text="Stages run in this session:", font=f).grid(
+            row=1, column=0, columnspan=3, sticky="W")
+        columns = ("calls", "wall", "cpu", "rss", "items")
+        headings = ("Calls", "Wall (s)", "CPU (s)", "Peak RSS + (MB)", "Items")
+        self.stages = ttk.Treeview(self.scrollable_frame, columns=columns, height=12)
+        self.stages.heading("#0", text="Stage")
+        for column, heading in zip(columns, headings):
+            self.stages.heading(column, text=heading)
+            self.stages.column(column, width=130, anchor="e")
+        self.stages.grid(row=2, column=0, columnspan=6, pady=(2, 20), sticky="W")
+
+        tk.Label(self.scrollable_frame, text="Lake model subroutines (built with timing_flag = .true.):",
+                 font=f).grid(row=3, column=0, columnspan=3, sticky="W")
+        self.subroutines = ttk.Treeview(self.scrollable_frame, columns=("calls", "seconds"), height=11)
+        self.subroutines.heading("#0", text="Subroutine")
+        self.subroutines.heading("calls", text="Calls")
+        self.subroutines.heading("seconds", text="Seconds")
+        self.subroutines.grid(row=4, column=0, columnspan=6, pady=2, sticky="W")
+
+        tk.Button(self.scrollable_frame, text="Refresh", font=f, command=self.refresh).grid(
+            row=5, column=0, ipadx=10, ipady=3, pady=10, sticky="W")
+        tk.Button(self.scrollable_frame, text="Clear", font=f, command=self.clear).grid(
+            row=5, column=1, ipadx=10, ipady=3, pady=10, sticky="W")
+
+        # Export as JSON and Chrome trace
+        tk.Button(self.scrollable_frame, text="Save as .json", font=MED_FONT, command=self.download_json).grid(
+            row=0, column=6, ipadx=10, ipady=3, sticky="NE")
+
+        tk.Button(self.scrollable_frame, text="Save Chrome trace", font=MED_FONT, command=self.download_trace).grid(
+            row=0, column=7, ipadx=10, ipady=3, sticky="NE")
+
+        # Return to Start Page
+        homeButton = tk.Button(self.scrollable_frame, text="Back to start page", font=f, bg="azure",
+                               command=lambda: self.parent.show_frame(["PageDiagnostics"], "StartPage"))
+        homeButton.grid(row=0, column=8, ipadx=10, ipady=3, sticky="NE")
+
+        self.refresh()
+
+    def refresh(self):
+        self.stages.delete(*self.stages.get_children())
+        for stage in diag.RECORDER.summary():
+            self.stages.insert("", tk.END, text=stage["name"],
+                               values=(stage["calls"], "%.3f" % stage["wall"], "%.3f" % stage["cpu"],
+                                       "%.1f" % (stage["rss"] / 2**20), stage["items"]))
+        self.subroutines.delete(*self.subroutines.get_children())
+        # the model writes its subroutine timings in its run directory
+        timing = os.path.join(RUN_DIR, diag.MODEL_TIMING) if RUN_DIR else None
+        for name, calls, seconds in (diag.read_model_timing(timing) if timing else []):
+            self.subroutines.insert("", tk.END, text=name, values=(calls, "%.3f" % seconds))
+
+    def clear(self):
+        diag.RECORDER.clear()
+        self.refresh()
+
+    def download_json(self):
+        file = asksaveasfilename(initialfile="stages.json", defaultextension=".json")
+        if file:
+            diag.RECORDER.save(file)
+            tk.messagebox.showinfo("Success", "Saved stage timings")
+
+    def download_trace(self):
+        file = asksaveasfilename(initialfile="trace.json", defaultextension=".json")
+        if file:
+            diag.RECORDER.save_chrome_trace(file)
+            tk.messagebox.showinfo("Success", "Saved Chrome trace (open in chrome://tracing or Perfetto)")
+
+
 if __name__ == "__main__":
     app = SampleApp()
     app.mainloop()
\ No newline at end of file